@@ -27,12 +27,18 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg,  NavigationTool
 # implement the default mpl key bindings
 from matplotlib.backend_bases import key_press_handler
 import Tkinter as tk
-from tkMessageBox import showerror
+from tkMessageBox import showerror, askyesno
 import os
+import time
 import tkFileDialog as tfd
 import matplotlib.image as mpimg
 # load image analysis module
 import piaImage
+import piaTrack
+import piaFrames
+import piaResults
+import piaProfile
+import piaShift
 
 #=============================================================================#
 #                           Define UC colors
@@ -55,6 +61,53 @@ cMaps = {'gray': mpl.cm.gray,
          'blue': mpl.cm.Blues_r,
          'green': mpl.cm.Greens_r}
 
+#=============================================================================#
+#                     Define traces per tracking mode
+#=============================================================================#
+def traceSeries(mode, data, offset=0):
+    """raw ('Data') and ratio ('Flow') traces of a tracking mode for some data columns.
+    
+    Returns a list of (axis, values, line style, color of the smoothed
+    overlay or None). Traces only depend on their own frame, except for the
+    offset of the second neuron in '2 Neurons (Ratio)'.
+    """
+    _, redBg1, redFl1, _,_,_, greenBg1, greenFl1, _,_,_,  redBg2, redFl2, _,_,_, greenBg2, greenFl2,_,_,_ = data
+    if mode=='Single Neuron (Ratio)':
+        return [('Data', redFl1, dict(c=UCred[2], label = 'Red F'), None),
+                ('Data', redBg1, dict(c=UCorange[0], linestyle = '--',label = 'Red Bg'), None),
+                ('Data', greenFl1, dict(c=UCgreen[0], label = 'Green F'), None),
+                ('Data', greenBg1, dict(c=UCgreen[2], linestyle = '--',label = 'Green Bg'), None),
+                ('Flow', redFl1/redBg1 - 1, dict(c=UCred[0], label = 'Channel 1 - Red'), UCred[2]),
+                ('Flow', greenFl1/greenBg1 - 1, dict(c=UCgreen[0], label = 'Channel 2 - Green'), UCgreen[2]),
+                ('Flow', (greenFl1 - greenBg1)/(redFl1 - redBg1), dict(c=UCblue[0], label = '(Green-GreenBg)/(Red-RedBg)'), UCblue[2])]
+    elif mode=='2 Neurons (Ratio)':
+        return [('Data', redFl1, dict(c=UCred[2], label = 'Red F'), None),
+                ('Data', redBg1, dict(c=UCorange[0], linestyle = '--',label = 'Red Bg'), None),
+                ('Data', greenFl1, dict(c=UCgreen[0], label = 'Green F'), None),
+                ('Data', greenBg1, dict(c=UCgreen[2], linestyle = '--',label = 'Green Bg'), None),
+                ('Data', redFl2+offset, dict(c=UCred[2], label = 'Red F 2'), None),
+                ('Data', redBg2+offset, dict(c=UCorange[0], linestyle = '--',label = 'Red Bg2'), None),
+                ('Data', greenFl2+offset, dict(c=UCgreen[0], label = 'Green F 2'), None),
+                ('Data', greenBg2+offset, dict(c=UCgreen[2], linestyle = '--',label = 'Green Bg 2'), None),
+                ('Flow', (greenFl1 - greenBg1)/(redFl1 - redBg1)+0.5, dict(c=UCblue[0], label = '(Green1-GreenBg)/(Red1-RedBg)'), UCblue[2]),
+                ('Flow', (greenFl2 - greenBg2)/(redFl2 - redBg2), dict(c=UCorange[0], label = '(Green2-GreenBg)/(Red2-RedBg)'), UCorange[2])]
+    elif mode == '2 Neurons':
+        return [('Data', greenFl1, dict(c=UCred[2], label = 'F1'), None),
+                ('Data', greenBg1, dict(c=UCorange[0], linestyle = '--',label = 'Bg1'), None),
+                ('Data', greenFl2, dict(c=UCmain, label = 'F2'), None),
+                ('Data', greenBg2, dict(c=UCorange[1], linestyle = '--',label = 'Bg2'), None),
+                ('Flow', greenFl1/greenBg1 - 1+0.5, dict(c=UCblue[0], label = 'Neuron 1 - Green'), UCblue[2]),
+                ('Flow', greenFl2/greenBg2 - 1, dict(c=UCorange[0], label = 'Neuron 2 - Green'), UCorange[2])]
+    return [('Data', greenFl1, dict(c=UCred[2], label = 'F'), None),
+            ('Data', greenBg1, dict(c=UCorange[0], linestyle = '--',label = 'Bg'), None),
+            ('Flow', greenFl1/greenBg1 - 1, dict(c=UCblue[0], label = 'Channel 1 - GCamp'), UCblue[2])]
+
+def traceOffset(mode, data):
+    """offset of the second neuron's raw traces."""
+    if mode=='2 Neurons (Ratio)':
+        return 2*np.max(data[2])
+    return 0
+
 #=============================================================================#
 #                     Define tk window class
 #         ----------------------------------------------------------
@@ -94,6 +147,9 @@ class Window():
         self.nextImgOnClick.set(1)
         self.colorMap = tk.StringVar()
         self.colorMap.set('gray')
+        # trace redraws per second during autorun
+        self.plotRate = tk.IntVar()
+        self.plotRate.set(5)
         
         # alternative tracking options
         # track the process too
@@ -104,6 +160,9 @@ class Window():
         self.dualX.set(-10)
         self.dualY = tk.IntVar()
         self.dualY.set(-510)
+        # dual color shift estimated from the images
+        self.shiftEstimate = tk.StringVar()
+        self.shiftEstimate.set('')
         # tracking parameters
         self.boxShow = tk.IntVar()
         self.signalThreshold = tk.IntVar()
@@ -114,6 +173,16 @@ class Window():
         self.boxBG.set(200)
         self.boxNeuron.set(50)
         self.signalThreshold.set(95)
+        # search in a smaller box while objects are found cleanly
+        self.adaptiveBox = tk.IntVar()
+        self.adaptiveBox.set(0)
+        # locate objects coarse to fine in a wider box, 0 to switch off
+        self.boxWide = tk.IntVar()
+        self.boxWide.set(0)
+        # per stage timing of the tracker and the display
+        self.timeStages = tk.IntVar()
+        self.timeStages.set(0)
+        self.stageTimes = tk.StringVar()
         
         # internal data variables/ storage
         self.imageData = []
@@ -121,20 +190,48 @@ class Window():
         self.data = []
         self.oldData = []
         self.ncols = 21
+        # manual corrections often re-track the same frame, reuse its histogram
+        self.thresholdEstimator = piaImage.IncrementalThreshold()
+        # tracked frames by their inputs, re-runs only track frames whose inputs changed
+        self.resultCache = piaTrack.ResultCache()
         # matplotlib variables
         self.imageNames = []
+        self.frames = None
+        # journal of tracked frames of the current recording
+        self.checkpoint = None
         self.mainImage = None
         self.pause = 0
         self.cidPress = {}
         self.vLine = []
+        self.traces = []
+        self.traceMode = None
+        self.traceOffset = 0
+        self.smoothing = 10
+        self.lastTraceDraw = 0
         self.rect = []
         self.canvas = {}
+        # canvas backgrounds without the moving overlays, for blitting
+        self.background = {}
+        # parts of the display that changed since the last render
+        self.dirty = set()
+        self.renderIndex = 0
+        self.renderJob = None
         self.ax = {}
         self.figure = {}
         self.toolbar = {}
         
         self.newAutoRun = False
         self.AutoRunActive = False
+        # tracking thread of an autorun and the job collecting its results
+        self.tracker = None
+        self.pollJob = None
+        self.pollInterval = 40
+        # stack conversion on a worker thread
+        self.converter = None
+        self.convertJob = None
+        # dual color shift estimation on a worker thread
+        self.shiftEstimator = None
+        self.shiftJob = None
         self.ROILocationData = []
         self.ROI = []
         
@@ -183,18 +280,17 @@ class Window():
 
         #--------------------- Control Buttons  ------------------------  
         controlSubFrame1 = tk.Frame(ControlFrame)
-        controlSubFrame1.grid(column=2,row=0,rowspan=4,sticky=tk.NSEW)
+        controlSubFrame1.grid(column=2,row=0,rowspan=5,sticky=tk.NSEW)
         controlSubFrame1.columnconfigure(0, weight=1)
         controlSubFrame1.columnconfigure(1, weight=1)
-        buttonText = ['Run', 'Pause', 'Reset Data', 'Overwrite Data', 'Write to new file','','Jump To Start','Run Tracker']
-        buttonCommands = [self.runControl, self.pauseControl, self.resetControl, self.writeControl, self.writeNewData,None,self.jumpToStart,self.AutoRunControl]
-        for i in range(4):
+        buttonText = ['Run', 'Pause', 'Reset Data', 'Overwrite Data', 'Write to new file','Convert Stack','Jump To Start','Run Tracker','Stop Tracker','Resume Tracker']
+        buttonCommands = [self.runControl, self.pauseControl, self.resetControl, self.writeControl, self.writeNewData,self.convertStack,self.jumpToStart,self.AutoRunControl,self.stopAutoRun,self.resumeControl]
+        for i in range(5):
             controlSubFrame1.rowconfigure(i, weight=1)
             runControlButton = tk.Button(controlSubFrame1, text = buttonText[2*i], fg = 'black', command= buttonCommands[2*i],width=buttonWidth)
             runControlButton.grid(column=0,row=i,sticky=tk.NSEW)  
-            if i!=2:
-                pauseControlButton = tk.Button(controlSubFrame1, text = buttonText[2*i+1], fg = 'black', command= buttonCommands[2*i+1],width=buttonWidth)
-                pauseControlButton.grid(column=1,row=i,sticky=tk.NSEW)
+            pauseControlButton = tk.Button(controlSubFrame1, text = buttonText[2*i+1], fg = 'black', command= buttonCommands[2*i+1],width=buttonWidth)
+            pauseControlButton.grid(column=1,row=i,sticky=tk.NSEW)
       
         #--------------------- Select options ---------------------------------
         optionsFrame = tk.Frame(ControlFrame)
@@ -209,11 +305,15 @@ class Window():
                             'Current index':[(0,1), self.currentIndex, 'entry'],
                             'Playback Speed':[(0,2),self.playbackSpeed, 'entry'],
                             'Skip Frames' :[(0,3),self.skipFrames, 'entry'],
+                            'Plot rate [Hz]' :[(0,4),self.plotRate, 'entry'],
                             'Next image on click':[(0,5),self.nextImgOnClick, 'check'],
                             'Show Fl/BG boxes':[(2,0),self.boxShow, 'check'],
                             'Neuron box size':[(2,1),self.boxNeuron, 'entry'],
                             'BG box size':[(2,2),self.boxBG, 'entry'],
-                            'Signal Th. [%]':[(2,3),self.signalThreshold, 'entry']
+                            'Signal Th. [%]':[(2,3),self.signalThreshold, 'entry'],
+                            'Time stages':[(2,4),self.timeStages, 'check'],
+                            'Adaptive box':[(2,5),self.adaptiveBox, 'check'],
+                            'Wide box size':[(4,4),self.boxWide, 'entry']
                             }
         for key in optionsLocations.keys():
             nCol, nRow= optionsLocations[key][0]
@@ -249,13 +349,17 @@ class Window():
         dualvecOptionsEntry.grid(column=1,row=0, sticky=tk.NSEW)
         dualvecOptionsEntry = tk.Entry(vecFrame,textvariable=self.dualY,justify=tk.CENTER,width=5)
         dualvecOptionsEntry.grid(column=2,row=0, sticky=tk.NSEW) 
+        shiftEstimateButton = tk.Button(vecFrame, text='Estimate', fg='black', command=self.estimateShift)
+        shiftEstimateButton.grid(column=3,row=0, sticky=tk.NSEW)
+        shiftEstimateLabel = tk.Label(vecFrame,textvariable=self.shiftEstimate,anchor=tk.W,justify=tk.LEFT)
+        shiftEstimateLabel.grid(column=4,row=0, sticky=tk.NSEW)
 
             #--------- Image type ---------
         imTypeOptionsText = tk.StringVar()
         imTypeOptionsText.set('Image data type')
         imTypeOptionsLabel = tk.Label(optionsFrame,textvariable=imTypeOptionsText,anchor=tk.E,justify=tk.LEFT,width=textWidth)
         imTypeOptionsLabel.grid(column=4,row=2, sticky=tk.NSEW)
-        imTypeOptionsMenu = tk.OptionMenu(optionsFrame,self.imageType,'tif','png','jpg')
+        imTypeOptionsMenu = tk.OptionMenu(optionsFrame,self.imageType,'tif','png','jpg','tif stack')
         imTypeOptionsMenu.grid(column=5,row=2, sticky=tk.NSEW)
 
             #--------- Colormap ---------
@@ -265,6 +369,10 @@ class Window():
         colorMapOptionsLabel.grid(column=4,row=3, sticky=tk.NSEW)
         colorMapOptionsMenu = tk.OptionMenu(optionsFrame,self.colorMap,'gray','blue','green','jet','hot')
         colorMapOptionsMenu.grid(column=5,row=3, sticky=tk.NSEW)   
+
+            #--------- Stage timing [ms per call] ---------
+        stageTimesLabel = tk.Label(ControlFrame,textvariable=self.stageTimes,anchor=tk.W,justify=tk.LEFT)
+        stageTimesLabel.grid(column=0,row=5,columnspan=4, sticky=tk.NSEW)
         
         #------------------------ Main Figure Frame ---------------------------
         
@@ -286,6 +394,8 @@ class Window():
         self.canvas['Main'].get_tk_widget().pack(expand=1)
         self.cidPress['Main'] = self.canvas['Main'].mpl_connect('button_press_event', self.onPressMain)
         self.cidPress['Main2'] = self.canvas['Main'].mpl_connect('button_release_event', self.onReleaseMain)
+        self.cidPress['MainDraw'] = self.canvas['Main'].mpl_connect('draw_event', self.onDraw)
+        self.cidPress['MainResize'] = self.canvas['Main'].mpl_connect('resize_event', self.onResize)
         
         #------------------- Data + Analysed Figure Frame ---------------------
         subFigureFrame = tk.Frame(mainFigureFrame)
@@ -320,6 +430,8 @@ class Window():
         self.canvas['Data'].get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
         #self.canvas['Data']._tkcanvas.pack(side=tk.TOP, fill=tk.BOTH, expand=1)
         self.cidPress['Data'] = self.canvas['Data'].mpl_connect('button_press_event', self.onPressData)
+        self.cidPress['DataDraw'] = self.canvas['Data'].mpl_connect('draw_event', self.onDraw)
+        self.cidPress['DataResize'] = self.canvas['Data'].mpl_connect('resize_event', self.onResize)
         plt.tight_layout()
 
              #--------- Analyzed Figure ---------        
@@ -336,6 +448,7 @@ class Window():
         #self.canvas['Flow'].get_tk_widget().grid(row=1, column = 0,sticky=tk.NSEW)
         #self.canvas['Flow'].get_tk_widget().pack()
         #self.cidPress['Flow'] = self.canvas['Flow'].mpl_connect('button_press_event', self.onPressFlow)
+        self.cidPress['FlowResize'] = self.canvas['Flow'].mpl_connect('resize_event', self.onResize)
         plt.tight_layout()
       
     #=========================================================================#
@@ -351,32 +464,44 @@ class Window():
         #=====================================================================#   
     def selectImageFolder(self):
              #--------- Get directory from the user ---------         
-        tmp_file = tfd.askdirectory(parent=root, initialdir='/media/monika/Nak/GCAMp Data/MK00014_160613/MK00014_EF1_160613', title='Select image folder')
+        if self.imageType.get() == 'tif stack':
+            # a single multi-page tif file instead of a folder
+            tmp_file = tfd.askopenfilename(parent=root, initialdir='./', title='Select multi-page tif')
+        else:
+            tmp_file = tfd.askdirectory(parent=root, initialdir='/media/monika/Nak/GCAMp Data/MK00014_160613/MK00014_EF1_160613', title='Select image folder')
         if not os.path.isdir:
             showerror(title = "Image directory error", message = "Not an image directory")
         else:
             self.imageFolder.set(tmp_file)
-                 #--------- Get all images in folder and sort them --------- 
-            tmp = np.array(os.listdir(self.imageFolder.get()))
-            tmpNames = {}
-            tmpTimes = []
-            for item in tmp:
-                if item[-3:] == self.imageType.get():
-                    time = float(item[:-4].split('_')[-1])#float(item[:-4].split('_')[3])
-                    tmpTimes.append(time)
-                    tmpNames[time] = item
-            if len(tmpNames)==0:
+                 #--------- Get all images (or a converted stack) sorted by image number --------- 
+            tmpFrames = piaFrames.openFrames(self.imageFolder.get(), self.imageType.get())
+            if tmpFrames is None:
                 showerror(title = "Images not found", message = "No images found in folder!")
                 return
-            self.imageNames = [tmpNames[x] for x in sorted(tmpTimes)]
+                 #--------- all image decoding goes through the frame source ---------
+            self.stopAutoRun()
+            if self.frames is not None:
+                self.frames.close()
+            self.frames = tmpFrames
+            self.resultCache.clear()
+            self.imageNames = self.frames.imageNames
             self.numOfImages = len(self.imageNames)
             self.status[0] = True
             
                 #--------- make a dummy data file with zeros --------- 
             self.fill_dummy_data()
+            self.shiftEstimate.set('')
+            if piaTrack.isRatio(self.mode.get()):
+                # only a cached estimate is used here, 'Estimate' calculates one
+                estimate = piaShift.cachedShift(self.imageFolder.get(), [self.dualX.get(),self.dualY.get()])
+                if estimate is not None:
+                    self.useShiftEstimate(estimate)
+            resumeIndex = self.openCheckpoint()
                 #--------- Draw main image and set status of main image --------- 
             self.redrawMain()
             self.imSize = self.imageData.shape
+            if resumeIndex is not None:
+                self.resumeAutoRun(resumeIndex)
 
         #=====================================================================#
         # Select button for the data file has been pressed
@@ -391,36 +516,51 @@ class Window():
             showerror(title = "File opening error", message = "File does not exist.")
             self.dataFile.set('')  
             return 
-        #num_lines = sum(1 for line in open(self.dataFile.get(),'r'))
-        
         # the columns are t, bg, f, x, y a for channel 1 and 2 respectively
              #--------- Read data file  --------- 
-        self.data = np.loadtxt(self.dataFile.get())
-#        with open(self.dataFile.get(),'r') as f:
-#            self.data = np.ones((num_lines,self.ncols))
-#            self.data[:,0] = np.arange(num_lines)
-#            lindex = 0
-#            for line in f.readlines():
-#                if line[0]=='#':
-#                    continue
-#                try:
-#                    ln = np.array(line.split(),dtype='float')
-#                except ValueError:
-#                    showerror(title = "File opening error", message = "File is not supported.")
-#                    break
-#                if len(ln) !=self.ncols:
-#                    #tk.Tk.withdraw()
-#                    showerror(title = "File opening error", message = "File does not have the correct number of columns.")
-#                    break
-#                else:
-#                    self.data[lindex] = ln
-#                lindex+=1
-        self.data = self.data.T
+        if piaResults.isBinary(self.dataFile.get()):
+            # binary files are stored with their tracking parameters
+            data, info = piaResults.readResults(self.dataFile.get())
+            self.setLoadedData(data, info)
+        else:
+            self.loadTextData(piaResults.iterTextRows(self.dataFile.get(), self.ncols), [])
+        return
+
+        #=====================================================================#
+        # Text data files are parsed a chunk per mainloop iteration, so the
+        # window stays responsive while large files are loaded
+        #=====================================================================#
+    def loadTextData(self, reader, blocks):
+        try:
+            block = next(reader, None)
+        except (IOError, ValueError) as e:
+            showerror(title = "File opening error", message = "File is not supported. {}".format(e))
+            self.dataFile.set('')
+            return
+        if block is not None:
+            blocks.append(block)
+            root.after(1, lambda: self.loadTextData(reader, blocks))
+            return
+        if sum(len(b) for b in blocks) == 0:
+            showerror(title = "File opening error", message = "File contains no data.")
+            self.dataFile.set('')
+            return
+        self.setLoadedData(np.concatenate(blocks).T)
+        return
+
+    def setLoadedData(self, data, info=None):
+        """use a loaded data set (and its tracking parameters) if it fits the images."""
+        if self.status[0] and data.shape[1] != self.numOfImages:
+            showerror(title = "File opening error", \
+                message = "File has {:d} frames, but the image folder has {:d} images.".format(data.shape[1], self.numOfImages))
+            self.dataFile.set('')
+            return
+        if info is not None:
+            self.applyRunInfo(info)
+        self.data = data
         self.oldData = self.data
         
              #--------- Plot fluorescence profile  --------- 
-        plt.figure('Data')
-        self.ax['Data'].cla()
         self.drawData()
              #--------- Set status of data image ---------         
         self.status[1] = True
@@ -437,7 +577,43 @@ class Window():
         # Write new data file. The old one is being overwritten
         #=====================================================================#  
     def writeControl(self):
-        np.savetxt(self.dataFile.get(), np.around(self.data.T, 2),  delimiter=' ', newline='\n', header='#Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2')
+        if piaResults.isBinary(self.dataFile.get()):
+            piaResults.writeResults(self.dataFile.get(), self.data, self.runInfo())
+        else:
+            np.savetxt(self.dataFile.get(), np.around(self.data.T, 2),  delimiter=' ', newline='\n', header='#Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2')
+        self.clearCheckpoint(self.dataFile.get())
+        return
+        #=====================================================================#
+        # Convert the image folder into a memory mapped stack. Later sessions
+        # read frames from the stack instead of decoding single images
+        #=====================================================================#
+    def convertStack(self):
+        """write the frames into a stack on a worker thread, the stack is used once it is complete."""
+        if not self.status[0] or self.converter is not None or \
+                isinstance(self.frames, (piaFrames.StackFrameSource, piaFrames.TiffFrameSource)):
+            return
+        self.stopAutoRun()
+        self.converter = piaFrames.StackConverter(self.frames, self.imageFolder.get())
+        self.converter.start()
+        self.convertJob = root.after(self.pollInterval, self.pollConversion)
+        return
+
+    def pollConversion(self):
+        self.convertJob = None
+        if self.converter.is_alive():
+            self.convertJob = root.after(self.pollInterval, self.pollConversion)
+            return
+        converter, self.converter = self.converter, None
+        if converter.frames is not self.frames:
+            # another recording was opened meanwhile
+            return
+        if converter.error is not None:
+            showerror(title = "Stack conversion error", message = converter.error)
+            return
+        # --- the tracker must not read from the frame source that is closed
+        self.stopAutoRun()
+        self.frames.close()
+        self.frames = piaFrames.StackFrameSource(self.imageFolder.get())
         return
         #=====================================================================#
         # Reset all changes made to the data or reset to zeros
@@ -469,97 +645,79 @@ class Window():
         """draw video frame, data, lines and location rectangle."""
         self.drawMain()
         self.drawData()
-        self.drawDataLine()
-        #self.updateMain()
-        self.drawRect()
+        self.requestRender('overlays')
         #=====================================================================#
         # An action requires the data to be redrawn
         #=====================================================================#      
             
-    def drawData(self):
-        # draw raw data and background
-        plt.figure('Data')
+    def drawData(self, index=None, redraw=True, end=None):
+        """update the traces for changed frames index..end-1 (all frames if index is None) and redraw them."""
+        if index is None or self.traceMode != self.mode.get() or len(self.traces)==0 \
+                or len(self.traces[0]['values']) != self.data.shape[1]:
+            self.setupTraces()
+        else:
+            self.updateTraces(index, index+1 if end is None else end)
+        if redraw:
+            self.requestRender('raw', 'ratio')
+        return
+
+    def drawTraces(self, name):
+        """rescale and draw a trace figure."""
+        with piaProfile.stage('draw traces'):
+            self.ax[name].relim()
+            self.ax[name].autoscale_view(scalex=False)
+            self.canvas[name].draw()
+        self.lastTraceDraw = time.time()
+        return
+
+    def setupTraces(self):
+        """create the trace artists of the current mode. They are updated in place afterwards."""
         self.ax['Data'].cla()
         self.ax['Data'].set_xlabel('time (frames)')
         self.ax['Data'].set_ylabel('Raw Fluorescence')
-        self.vLine = []
-        #Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2 BG3 F3 X3 Y3 A3 BG4 F4 X4 Y4 A4        
-        
-        time, redBg1, redFl1, _,_,_, greenBg1, greenFl1, _,_,_,  redBg2, redFl2, _,_,_, greenBg2, greenFl2,_,_,_ = self.data
-        if self.mode.get()=='Single Neuron (Ratio)':
-            plt.plot(time,redFl1,c=UCred[2],lw=2, label = 'Red F')
-            plt.plot(time,redBg1,c=UCorange[0],lw=2, linestyle = '--',label = 'Red Bg')
-            plt.plot(time,greenFl1,c=UCgreen[0],lw=2, label = 'Green F')
-            plt.plot(time,greenBg1,c=UCgreen[2],lw=2, linestyle = '--',label = 'Green Bg')
-            ratio = redFl1/redBg1 - 1
-            ratio2 = greenFl1/greenBg1 - 1
-            ratio3 = (greenFl1 - greenBg1)/(redFl1 - redBg1)
-            
-        elif self.mode.get()=='2 Neurons (Ratio)':
-            plt.plot(time,redFl1,c=UCred[2],lw=2, label = 'Red F')
-            plt.plot(time,redBg1,c=UCorange[0],lw=2, linestyle = '--',label = 'Red Bg')
-            plt.plot(time,greenFl1,c=UCgreen[0],lw=2, label = 'Green F')
-            plt.plot(time,greenBg1,c=UCgreen[2],lw=2, linestyle = '--',label = 'Green Bg')
-            offset = 2*np.max(redFl1)
-            plt.plot(time,redFl2+offset,c=UCred[2],lw=2, label = 'Red F 2')
-            plt.plot(time,redBg2+offset,c=UCorange[0],lw=2, linestyle = '--',label = 'Red Bg2')
-            plt.plot(time,greenFl2+offset,c=UCgreen[0],lw=2, label = 'Green F 2')
-            plt.plot(time,greenBg2+offset,c=UCgreen[2],lw=2, linestyle = '--',label = 'Green Bg 2')
-           
-            ratio3 = (greenFl1 - greenBg1)/(redFl1 - redBg1)
-            ratio4 = (greenFl2 - greenBg2)/(redFl2 - redBg2)
-            
-        elif self.mode.get() == '2 Neurons':
-            plt.plot(time,greenFl1,c=UCred[2],lw=2, label = 'F1')
-            plt.plot(time,greenBg1,c=UCorange[0],lw=2, linestyle = '--',label = 'Bg1')
-            plt.plot(time, greenFl2,c=UCmain,lw=2, label = 'F2')
-            plt.plot(time,greenBg2,c=UCorange[1],lw=2, linestyle = '--',label = 'Bg2')
-            ratio = greenFl1/greenBg1 - 1
-            ratio2 = greenFl2/greenBg2 - 1
-            
-        else:
-            plt.plot(time,greenFl1,c=UCred[2],lw=2, label = 'F')
-            plt.plot(time,greenBg1,c=UCorange[0],lw=2, linestyle = '--',label = 'Bg')
-            ratio = greenFl1/greenBg1 - 1
-            
-        #plt.legend(loc = 4, fontsize=10)
-        plt.xlim(min(time),max(time))
-        # smoothin factor for ratio plot
-        n = 10
-        self.canvas['Data'].draw()
-        self.drawDataLine()
-        # draw background subtracted data - (F-Bg)
-        plt.figure('Flow')
         self.ax['Flow'].cla()
         self.ax['Flow'].set_xlabel('time (frames)')
         self.ax['Flow'].set_ylabel('F/Bg')
-        if self.mode.get()=='Single Neuron (Ratio)':
-            plt.plot(time,ratio,c=UCred[0],lw=2, label = 'Channel 1 - Red')
-            plt.plot(time,ratio2,c=UCgreen[0],lw=2, label = 'Channel 2 - Green')
-            plt.plot(time,ratio3,c=UCblue[0],lw=2, label = '(Green-GreenBg)/(Red-RedBg)')
-            plt.plot(time,piaImage.moving_average(ratio, n),c=UCred[2],lw=2)
-            plt.plot(time,piaImage.moving_average(ratio2, n),c=UCgreen[2],lw=2)
-            plt.plot(time,piaImage.moving_average(ratio3, n),c=UCblue[2],lw=2)
-        
-        elif self.mode.get()=='2 Neurons (Ratio)':
-            plt.plot(time,ratio3+0.5,c=UCblue[0],lw=2, label = '(Green1-GreenBg)/(Red1-RedBg)')
-            plt.plot(time,ratio4,c=UCorange[0],lw=2, label = '(Green2-GreenBg)/(Red2-RedBg)')
-            plt.plot(time,piaImage.moving_average(ratio3+0.5, n),c=UCblue[2],lw=2)
-            plt.plot(time,piaImage.moving_average(ratio4, n),c=UCorange[2],lw=2)
-            
-        elif self.mode.get() == '2 Neurons':
-            plt.plot(time,ratio+0.5,c=UCblue[0],lw=2, label = 'Neuron 1 - Green')
-            plt.plot(time,ratio2,c=UCorange[0],lw=2, label = 'Neuron 2 - Green')
-            plt.plot(time,piaImage.moving_average(ratio+0.5, n),c=UCblue[2],lw=2)
-            plt.plot(time,piaImage.moving_average(ratio2, n),c=UCorange[2],lw=2)
-            
-        else:
-            plt.plot(time,ratio,c=UCblue[0],lw=2, label = 'Channel 1 - GCamp')
-            plt.plot(time,piaImage.moving_average(ratio, n),c=UCblue[2],lw=2)
-            
-        plt.xlim(min(time),max(time))
-        #plt.legend(loc=4, fontsize=10)
-        self.canvas['Flow'].draw()
+        self.vLine = []
+        #Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2 BG3 F3 X3 Y3 A3 BG4 F4 X4 Y4 A4
+        frames = self.data[0]
+        self.traceMode = self.mode.get()
+        self.traceOffset = traceOffset(self.traceMode, self.data)
+        self.traces = []
+        for axis, values, style, smoothColor in traceSeries(self.traceMode, self.data, self.traceOffset):
+            trace = {'values': np.array(values, dtype=float), 'smoothValues': None, 'smooth': None}
+            trace['line'], = self.ax[axis].plot(frames, trace['values'], lw=2, **style)
+            if smoothColor is not None:
+                # smoothed overlay for the ratio plot
+                trace['smoothValues'] = piaImage.moving_average(trace['values'], self.smoothing)
+                trace['smooth'], = self.ax[axis].plot(frames, trace['smoothValues'], c=smoothColor, lw=2)
+            self.traces.append(trace)
+        for name in ['Data', 'Flow']:
+            self.ax[name].set_xlim(min(frames),max(frames))
+            self.figure[name].tight_layout()
+        return
+
+    def updateTraces(self, start, stop):
+        """recompute the traces for frames start..stop-1 only and update the artists."""
+        offset = traceOffset(self.traceMode, self.data)
+        if offset != self.traceOffset:
+            # the second neuron's traces move as a whole
+            self.traceOffset = offset
+            start, stop = 0, self.data.shape[1]
+        n = self.smoothing
+        bf = int(0.5*(n-1))
+        nFrames = self.data.shape[1]
+        for trace, (_, values, _, _) in zip(self.traces, traceSeries(self.traceMode, self.data[:,start:stop], offset)):
+            trace['values'][start:stop] = values
+            trace['line'].set_ydata(trace['values'])
+            if trace['smooth'] is not None:
+                # --- moving average over a window around the changed frames, keep the full windows
+                wStart, wStop = max(0, start-n), min(nFrames, stop+n)
+                smooth = piaImage.moving_average(trace['values'][wStart:wStop], n)
+                first = wStart+bf if wStart > 0 else 0
+                last = wStop-(n-bf-1) if wStop < nFrames else nFrames
+                trace['smoothValues'][first:last] = smooth[first-wStart:last-wStart]
+                trace['smooth'].set_ydata(trace['smoothValues'])
         return
 
         #=====================================================================#
@@ -568,9 +726,9 @@ class Window():
     
     def writeNewData(self):
         '''write new data set without overwriting old data.'''
-        headerTxt = '#Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2 BG3 F3 X3 Y3 A3 BG4 F4 X4 Y4 A4'
         if self.status[2] and len(self.data)>0:
-            np.savetxt(self.newFile.get(), self.data.T,fmt ='%f',  delimiter=' ', newline='\n', header=headerTxt)
+            piaResults.saveData(self.newFile.get(), self.data, self.runInfo())
+            self.clearCheckpoint(self.newFile.get())
         return
         #=====================================================================#
         # If active the user may draw another flow rectangular
@@ -584,9 +742,7 @@ class Window():
         self.currentIndex.set(self.startIndex.get())
         if self.status[0]:
                  #--------- Update line position and main image ---------
-            self.drawDataLine()
-            self.updateMain()
-            self.drawRect()
+            self.requestRender('image', 'overlays')
         return
         
         #=====================================================================#
@@ -596,7 +752,7 @@ class Window():
         #=====================================================================#      
     def onPressMain(self,event):
         if self.AutoRunActive:
-            self.AutoRunActive = False
+            self.stopAutoRun()
             return
         if self.newAutoRun:
 #            print self.ROI
@@ -611,9 +767,11 @@ class Window():
             else: # tracking purely green
                 self.data[8][self.currentIndex.get()] = event.xdata
                 self.data[9][self.currentIndex.get()] = event.ydata
-            self.drawRect()
+            self.requestRender('overlays')
             self.getFluoresence()
-            self.drawData()
+            if self.checkpoint is not None:
+                self.checkpoint.flush()
+            self.drawData(self.currentIndex.get())
 
         if self.nextImgOnClick.get() == 1 and not self.newAutoRun and self.currentIndex.get() + 1 + self.skipFrames.get()<self.numOfImages:
             self.currentIndex.set(self.currentIndex.get() + 1 + self.skipFrames.get())
@@ -621,9 +779,7 @@ class Window():
             if self.currentIndex.get() >= self.numOfImages-1:
                 self.currentIndex.set(self.startIndex.get())
                  #--------- Update line position and main image ---------
-            self.drawDataLine()
-            self.updateMain()
-            self.drawRect()
+            self.requestRender('image', 'overlays')
         return
 
         #=====================================================================#
@@ -635,13 +791,9 @@ class Window():
         if self.newAutoRun:
             #self.ROILocationData = [event.xdata,event.ydata]
             self. drawRegionOfInterest()
-            self.canvas['Main'].draw()
-            self.AutoRunActive = True
-            if self.AutoRunActive:
-                index = 0
-                self.updateAutoRun(index)
-                if index > self.numOfImages-1:
-                    self.AutoRunActive = False
+            if self.checkpoint is not None:
+                self.checkpoint.writeInfo(self.runInfo())
+            self.startAutoRun(self.currentIndex.get(), self.ROILocationData)
             self.newAutoRun = False
         return
         
@@ -657,7 +809,7 @@ class Window():
         else:
             xC = int(np.round(self.data[8][self.currentIndex.get()]))
             yC = int(np.round(self.data[9][self.currentIndex.get()]))
-        _tmpImg = self.imageData
+        _tmpImg = self.frames[index]
         self.AutoFluorescenceDetector(_tmpImg, xC, yC, index)
         return   
 
@@ -667,46 +819,232 @@ class Window():
     def drawRegionOfInterest(self):
         plt.figure('Main')
         self.ROI = []
-        self.ROI.append(self.ax['Main'].plot(np.round(self.ROILocationData[0]), np.round(self.ROILocationData[1]), 'o', color=UCorange[0]))
+        self.ROI.append(self.ax['Main'].plot(np.round(self.ROILocationData[0]), np.round(self.ROILocationData[1]), 'o', color=UCorange[0], animated=True))
         #add_patch(Rectangle((np.round(self.flowRegionData[0][0]), np.round(self.flowRegionData[0][1])), self.flowRegionData[1][0]-self.flowRegionData[0][0], self.flowRegionData[1][1]-self.flowRegionData[0][1], edgecolor=UCgreen[4],facecolor='none',alpha=1,lw=2)))
-        self.canvas['Main'].draw()        
+        self.requestRender('overlays')
         return
 
         #=====================================================================#
-        # Update the autotracker results (or create if not run before)
+        # Autorun: the frames are tracked on a worker thread. Its results are
+        # collected at a fixed rate and applied in batches, only the latest
+        # frame is drawn. Stopping takes effect at once, a frame still being
+        # tracked is discarded
         #=====================================================================#          
-    def updateAutoRun(self, index):
-        i = self.currentIndex.get()
-        if index ==0:
-            # read current image
-            _tmpImage = mpimg.imread(os.path.join(self.imageFolder.get(),self.imageNames[i]))
-            # update coordinates
-            tmp_xC, tmp_yC = self.ROILocationData
-            # use same algorithm as manual to get fluorescence
-            self.AutoFluorescenceDetector(_tmpImage, tmp_xC, tmp_yC, i)
-        else:
-             # read current image
-            _tmpImage = mpimg.imread(os.path.join(self.imageFolder.get(),self.imageNames[i]))
-            # update coordinates
-            trackspeed = 0.2
-            if self.mode.get()=='Single Neuron (Ratio)' or self.mode.get()=='2 Neurons (Ratio)':
-                tmp_xC, tmp_yC  = self.data[3][i-1]+(self.data[3][i-1]-self.data[3][i-2])*trackspeed, self.data[4][i-1]+(self.data[4][i-1]-self.data[4][i-2])*trackspeed
-            else:
-                tmp_xC, tmp_yC  = self.data[8][i-1]+(self.data[8][i-1]-self.data[8][i-2])*trackspeed, self.data[9][i-1]+(self.data[9][i-1]-self.data[9][i-2])*trackspeed
-            
-            self.AutoFluorescenceDetector(_tmpImage, tmp_xC, tmp_yC, i)
-        self.drawDataLine()
-        self.updateMain()
-        self.drawRect()
-        self.drawData()
+    def startAutoRun(self, index, seed):
+        """track from frame index on. seed is the location in that frame, predicted from the data if None."""
+        self.stopAutoRun()
+        if index >= self.numOfImages:
+            return
+        self.currentIndex.set(index)
+        self.startStageTiming()
+        self.tracker = piaTrack.TrackingThread(self.frames, self.mode.get(), seed, self.boxBG.get(), self.boxNeuron.get(), \
+                            self.signalThreshold.get(), [self.dualX.get(),self.dualY.get()], index, \
+                            data=np.copy(self.data), cache=self.resultCache, adaptive=self.adaptiveBox.get() == 1, \
+                            boxWide=self.boxWide.get() or None)
+        self.AutoRunActive = True
+        self.tracker.start()
+        self.pollJob = root.after(self.pollInterval, self.pollAutoRun)
+        return
+
+    def pollAutoRun(self):
+        self.pollJob = None
+        results, ended = self.tracker.fetch()
+        self.applyTrackResults(results)
+        if not ended:
+            self.pollJob = root.after(self.pollInterval, self.pollAutoRun)
+            return
+        error = self.tracker.error
+        self.finishAutoRun()
+        if error is not None:
+            showerror(title = "Tracking error", message = error)
+        return
+
+    def applyTrackResults(self, results):
+        """write tracked frames into the data and the journal and show the last one."""
+        if len(results) == 0:
+            return
+        for index, values in results:
+            self.oldData[:,index] = self.data[:,index]
+            self.data[1::,index] = values
+            if self.checkpoint is not None:
+                with piaProfile.stage('checkpoint'):
+                    self.checkpoint.write(index, values)
+        first, last = results[0][0], results[-1][0]
+        # --- traces are updated for every batch but only redrawn at the plot rate
+        redraw = self.plotRate.get() > 0 and time.time()-self.lastTraceDraw >= 1.0/self.plotRate.get()
+        with piaProfile.stage('traces'):
+            self.drawData(first, redraw, last+1)
         if len(self.ROI) > 0:
             for item in self.ROI:
                 self.ax['Main'].lines.remove(item[0])
                 self.ROI = []
-        self.currentIndex.set(i+1)
-        index += 1
-        if self.AutoRunActive and self.currentIndex.get()  < self.numOfImages:
-            root.after(2, lambda: self.updateAutoRun(index))
+        self.currentIndex.set(last)
+        self.requestRender('image', 'overlays')
+        if redraw and piaProfile.enabled:
+            self.stageTimes.set(piaProfile.report())
+        return
+
+    def stopAutoRun(self):
+        """stop tracking at once, the frames tracked so far are kept."""
+        if self.tracker is None:
+            return
+        self.tracker.stop()
+        if self.pollJob is not None:
+            root.after_cancel(self.pollJob)
+        results, _ = self.tracker.fetch()
+        self.applyTrackResults(results)
+        self.finishAutoRun()
+        return
+
+    def finishAutoRun(self):
+        self.tracker = None
+        self.pollJob = None
+        self.AutoRunActive = False
+        if self.checkpoint is not None:
+            self.checkpoint.flush()
+        self.requestRender('raw', 'ratio')
+        self.stopStageTiming()
+        return
+
+    def resumeControl(self):
+        """continue tracking after the current frame, eg. after stopping or correcting it."""
+        if self.status[0] and self.tracker is None and not self.newAutoRun:
+            self.resumeAutoRun(self.currentIndex.get()+1)
+        return
+
+        #=====================================================================#
+        # Stage timing: while 'Time stages' is checked, the stages of an
+        # autorun are timed. The recent times are shown below the options,
+        # all of them are written next to the images when the run stops
+        #=====================================================================#
+    def startStageTiming(self):
+        piaProfile.reset()
+        piaProfile.enable(self.timeStages.get() == 1)
+        self.stageTimes.set('')
+        return
+
+    def stopStageTiming(self):
+        if piaProfile.enabled:
+            self.stageTimes.set(piaProfile.report(recent=False))
+            piaProfile.dump(piaProfile.profileName(self.imageFolder.get()), self.runInfo())
+            piaProfile.enable(False)
+        return
+
+        #=====================================================================#
+        # Every tracked frame is journaled to a checkpoint file next to the
+        # images. When a recording with a checkpoint is opened, the results
+        # can be loaded and an interrupted autorun continues where it stopped.
+        # Saving the data clears the journal, it then only holds the frames
+        # changed since, on top of the saved file
+        #=====================================================================#
+    def runInfo(self):
+        return piaTrack.runInfo(self.mode.get(), self.boxBG.get(), self.boxNeuron.get(), \
+                                self.signalThreshold.get(), [self.dualX.get(),self.dualY.get()], self.imageFolder.get(), \
+                                self.adaptiveBox.get() == 1, self.boxWide.get() or None)
+
+    def estimateShift(self, force=True):
+        """estimate the dual color shift from a few frames of the recording on a worker thread."""
+        if self.frames is None or self.shiftEstimator is not None:
+            return
+        self.shiftEstimator = piaShift.ShiftEstimator(self.frames, self.imageFolder.get(), [self.dualX.get(),self.dualY.get()], force)
+        self.shiftEstimator.start()
+        self.shiftEstimate.set('estimating')
+        self.shiftJob = root.after(self.pollInterval, self.pollShiftEstimate)
+        return
+
+    def pollShiftEstimate(self):
+        self.shiftJob = None
+        if self.shiftEstimator.is_alive():
+            self.shiftJob = root.after(self.pollInterval, self.pollShiftEstimate)
+            return
+        estimator, self.shiftEstimator = self.shiftEstimator, None
+        if estimator.frames is not self.frames:
+            # another recording was opened meanwhile
+            return
+        if estimator.error is not None:
+            self.shiftEstimate.set('')
+            showerror(title = "Shift estimation error", message = estimator.error)
+            return
+        self.useShiftEstimate(estimator.estimate)
+        return
+
+    def useShiftEstimate(self, estimate):
+        """use the shift of an estimate if it is clear, and show it."""
+        x, y = estimate['shift']
+        if piaShift.isClear(estimate):
+            self.dualX.set(x)
+            self.dualY.set(y)
+            self.shiftEstimate.set('estimated ({:d}, {:d})'.format(x, y))
+        else:
+            self.shiftEstimate.set('unclear ({:d}, {:d})'.format(x, y))
+        return
+
+    def applyRunInfo(self, info):
+        """restore the tracking parameters of a checkpoint or result file."""
+        for key, var in [('mode', self.mode), ('boxBG', self.boxBG), ('boxNeuron', self.boxNeuron), ('signalThreshold', self.signalThreshold)]:
+            if key in info:
+                var.set(info[key])
+        if 'shift' in info:
+            self.dualX.set(info['shift'][0])
+            self.dualY.set(info['shift'][1])
+        if 'adaptive' in info:
+            self.adaptiveBox.set(int(info['adaptive']))
+        if 'boxWide' in info:
+            self.boxWide.set(info['boxWide'] or 0)
+        return
+
+    def openCheckpoint(self):
+        """start the journal of the current recording. Returns the frame to resume tracking at, or None."""
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        fname = piaTrack.checkpointName(self.imageFolder.get())
+        resumeIndex = None
+        append = False
+        if os.path.isfile(fname):
+            data = piaTrack.emptyData(self.numOfImages)
+            last, info = piaTrack.readCheckpoint(fname, data)
+            if last is not None and askyesno(title='Checkpoint found', \
+                    message='This recording was tracked up to frame {:d}. Load these results and continue tracking?'.format(last)):
+                saved = self.savedCheckpointData(info.get('savedTo'))
+                if saved is not None:
+                    # the journal holds the frames changed after saving
+                    data = saved
+                    piaTrack.readCheckpoint(fname, data)
+                self.data = data
+                self.applyRunInfo(info)
+                append = True
+                if last+1 < self.numOfImages:
+                    resumeIndex = last+1
+            elif last is not None:
+                # keep the unsaved results of the previous session
+                piaTrack.archiveCheckpoint(fname)
+        self.checkpoint = piaTrack.ResultWriter(fname, append=append)
+        self.checkpoint.writeInfo(self.runInfo())
+        return resumeIndex
+
+    def savedCheckpointData(self, fname):
+        """data set of the result file a journal was cleared after, None if it is gone or does not fit."""
+        if not fname or not os.path.isfile(fname):
+            return None
+        try:
+            data, _ = piaResults.loadData(fname)
+        except (IOError, ValueError):
+            return None
+        if data.shape != (piaTrack.NCOLS, self.numOfImages):
+            return None
+        return data
+
+    def clearCheckpoint(self, fname):
+        """start the journal over once its frames are saved in fname."""
+        if self.checkpoint is not None:
+            info = self.runInfo()
+            info['savedTo'] = os.path.abspath(fname)
+            self.checkpoint.clear(info)
+        return
+
+    def resumeAutoRun(self, index):
+        """continue tracking at frame index, the location is predicted from the loaded results."""
+        self.startAutoRun(index, None)
         return
         
     def AutoFluorescenceDetector(self, img, xC, yC, index):
@@ -714,21 +1052,24 @@ class Window():
         bgSize = int(np.round(self.boxBG.get()/2.0))
         neuronSize = int(np.round(self.boxNeuron.get()/2.0))
         threshold = self.signalThreshold.get()
-        
-        if self.mode.get()=='Single Neuron (Ratio)':
-            trackResult = piaImage.dualFluorescence(img, bgSize,neuronSize, threshold, xC, yC, [self.dualX.get(),self.dualY.get()])
-        elif self.mode.get()=='2 Neurons':
-            trackResult = piaImage.singleFluorescence2Neurons(img, bgSize,neuronSize, threshold, xC, yC, [self.dualX.get(),self.dualY.get()], self.data[[3,4,13,14],index-1])
-        elif self.mode.get()=='2 Neurons (Ratio)':
-            trackResult = piaImage.dualFluorescence2Neurons(img, bgSize,neuronSize, \
-                            threshold, xC, yC, [self.dualX.get(),self.dualY.get()], self.data[[3,4,13,14],index-1])
-        else:
-            trackResult = piaImage.fluorescence(img, bgSize,neuronSize, threshold, xC, yC)
+        shift = [self.dualX.get(),self.dualY.get()]
+        prevLocs = piaTrack.previousLocations(self.data, index, self.mode.get())
+        # a frame tracked before with the same inputs is not tracked again
+        key = self.resultCache.key(index, self.mode.get(), bgSize, neuronSize, threshold, xC, yC, shift, prevLocs)
+        trackResult = self.resultCache.get(key)
+        if trackResult is None:
+            # same tracker as the headless engine in piaTrack
+            trackResult = piaTrack.trackFrame(img, self.mode.get(), bgSize, neuronSize, threshold, xC, yC, \
+                                shift, prevLocs, self.thresholdEstimator)
+            self.resultCache.put(key, trackResult)
         #-----pad trackResult to size 20----
         #trackResult = np.pad(trackResult, (0,20-len(trackResult )), 'constant') 
         # --- Update neuron info in data  ---
         self.oldData[:,index] = self.data[:,index]
         self.data[1::,index] = trackResult
+        if self.checkpoint is not None:
+            with piaProfile.stage('checkpoint'):
+                self.checkpoint.write(index, self.data[1::,index])
 
         #=====================================================================#
         # The user has clicked on the data image frame
@@ -742,7 +1083,7 @@ class Window():
             return
         # ------------stop an autorun -------------
         if self.AutoRunActive:
-            self.AutoRunActive = False
+            self.stopAutoRun()
             
              #--------- Get new image index from click --------- 
         if self.status[0] and self.status[1]:
@@ -757,57 +1098,119 @@ class Window():
                 self.currentIndex.set(int(np.round(event.xdata)))
 
              #--------- Update position indicator and main image ---------     
-            self.drawDataLine()
             self.drawMain()
-            self.drawRect()
+            self.requestRender('overlays')
             
                 
 
         #=====================================================================#
         # Draw a vertical line at the current index position in the data image
         #=====================================================================#  
-    def drawDataLine(self):
+    def drawDataLine(self, index):
              #--------- Update position indicator --------- 
-        plt.figure('Data')
         if len(self.vLine) > 0:
-            for item in self.vLine:
-                item.remove()
-        self.vLine = []
-        self.vLine.append(plt.axvline(self.currentIndex.get(),ls='dashed',c='k'))
-        plt.tight_layout()
-        self.canvas['Data'].draw()        
+            self.vLine[0].set_xdata([index]*2)
+        else:
+            self.vLine.append(self.ax['Data'].axvline(index,ls='dashed',c='k',animated=True))
         return
 
         #=====================================================================#
         # Draw two rectangles in the main frame locating signal and BG regions
+        # The patches are created once and moved afterwards
         #=====================================================================#
-    def drawRect(self):
-        plt.figure('Main')
-        if self.mode.get() =='Single Neuron (Ratio)' or self.mode.get() =='2 Neurons (Ratio)':
-            if len(self.rect) > 0:
-                for item in self.rect:
-                    item.remove()
-            self.rect = []
-            size = self.boxBG.get()/2.0
-            self.rect.append(self.ax['Main'].add_patch(Rectangle((np.round(self.data[3][self.currentIndex.get()]) - size, np.round(self.data[4][self.currentIndex.get()]) - size), 2*size, 2*size, edgecolor=UCblue[2],facecolor='none',alpha=1,lw=2)))
-            self.rect.append(self.ax['Main'].add_patch(Rectangle((np.round(self.data[3][self.currentIndex.get()])+self.dualX.get() - size, np.round(self.data[4][self.currentIndex.get()]) +self.dualY.get() - size), 2*size, 2*size, edgecolor=UCblue[2],facecolor='none',alpha=1,lw=2)))
-            size = self.boxNeuron.get()/2.0#self.boxBG.get()/2.0
-            self.rect.append(self.ax['Main'].add_patch(Rectangle((np.round(self.data[3][self.currentIndex.get()]) - size, np.round(self.data[4][self.currentIndex.get()]) - size), 2*size, 2*size, edgecolor=UCorange[2],facecolor='none',alpha=1,lw=2)))
-            self.rect.append(self.ax['Main'].add_patch(Rectangle((np.round(self.data[3][self.currentIndex.get()]) +self.dualX.get()- size, np.round(self.data[4][self.currentIndex.get()]) +self.dualY.get() - size), 2*size, 2*size, edgecolor=UCorange[2],facecolor='none',alpha=1,lw=2)))
-            self.canvas['Main'].draw()
-        else:
-            if len(self.rect) > 0:
-                for item in self.rect:
-                    item.remove()
-            self.rect = []
-            print np.round(self.data[8][self.currentIndex.get()]), np.round(self.data[9][self.currentIndex.get()])
-            size = self.boxBG.get()/2.0
-            self.rect.append(self.ax['Main'].add_patch(Rectangle((np.round(self.data[8][self.currentIndex.get()]) - size, np.round(self.data[9][self.currentIndex.get()]) - size), 2*size, 2*size, edgecolor=UCblue[2],facecolor='none',alpha=1,lw=2)))
-            size = self.boxNeuron.get()/2.0#self.boxBG.get()/2.0
-            self.rect.append(self.ax['Main'].add_patch(Rectangle((np.round(self.data[8][self.currentIndex.get()]) - size, np.round(self.data[9][self.currentIndex.get()]) - size), 2*size, 2*size, edgecolor=UCorange[2],facecolor='none',alpha=1,lw=2)))
-            self.canvas['Main'].draw()
+    def drawRect(self, index):
+        xCol, yCol = piaTrack.positionColumns(self.mode.get())
+        xC = np.round(self.data[xCol][index])
+        yC = np.round(self.data[yCol][index])
+        centers = [(xC, yC)]
+        if piaTrack.isRatio(self.mode.get()):
+            centers.append((xC+self.dualX.get(), yC+self.dualY.get()))
+        # background boxes first, then the neuron boxes
+        boxes = [(x, y, self.boxBG.get()/2.0, UCblue[2]) for x, y in centers]
+        boxes += [(x, y, self.boxNeuron.get()/2.0, UCorange[2]) for x, y in centers]
+        if len(self.rect) != len(boxes):
+            for item in self.rect:
+                item.remove()
+            self.rect = [self.ax['Main'].add_patch(Rectangle((0, 0), 1, 1, edgecolor=color,facecolor='none',alpha=1,lw=2,animated=True)) \
+                            for _, _, _, color in boxes]
+        for item, (x, y, size, _) in zip(self.rect, boxes):
+            item.set_xy((x - size, y - size))
+            item.set_width(2*size)
+            item.set_height(2*size)
         return
-        
+
+        #=====================================================================#
+        # Render scheduler: handlers mark what changed, the display is
+        # rendered once Tk is idle. Each canvas is drawn at most once per
+        # render, showing the frame of the latest request.
+        #=====================================================================#
+    def requestRender(self, *parts):
+        """mark parts ('image', 'overlays', 'raw', 'ratio') as changed."""
+        self.dirty.update(parts)
+        self.renderIndex = self.currentIndex.get()
+        if self.renderJob is None:
+            self.renderJob = root.after_idle(self.render)
+        return
+
+    def render(self):
+        self.renderJob = None
+        dirty, self.dirty = self.dirty, set()
+        index = self.renderIndex
+        if self.mainImage is not None and dirty & set(['image', 'overlays']):
+            with piaProfile.stage('draw image'):
+                if 'image' in dirty:
+                    self.updateMain(index)
+                self.drawRect(index)
+                self.blitOverlays('Main')
+        if 'raw' in dirty or self.status[1] and 'overlays' in dirty:
+            self.drawDataLine(index)
+            if 'raw' in dirty:
+                # a full draw blits the cursor as well
+                self.drawTraces('Data')
+            else:
+                with piaProfile.stage('draw cursor'):
+                    self.blitOverlays('Data')
+        if 'ratio' in dirty:
+            self.drawTraces('Flow')
+        return
+
+        #=====================================================================#
+        # Blitting: a full draw of a canvas caches its background without the
+        # animated artists (image, boxes and time cursor). Afterwards only
+        # these are redrawn on top of the cached background.
+        #=====================================================================#
+    def overlays(self, name):
+        if name == 'Main':
+            artists = [self.mainImage] if self.mainImage is not None else []
+            return artists + self.rect + [item[0] for item in self.ROI]
+        return self.vLine
+
+    def onDraw(self, event):
+        for name in ['Main', 'Data']:
+            if event.canvas is self.canvas[name]:
+                self.background[name] = self.canvas[name].copy_from_bbox(self.figure[name].bbox)
+                self.blitOverlays(name, restore=False)
+        return
+
+    def blitOverlays(self, name, restore=True):
+        if self.background.get(name) is None:
+            # no background yet, a full draw caches it and draws the overlays
+            self.canvas[name].draw()
+            return
+        if restore:
+            self.canvas[name].restore_region(self.background[name])
+        for artist in self.overlays(name):
+            self.ax[name].draw_artist(artist)
+        self.canvas[name].blit(self.ax[name].bbox)
+        return
+
+    def onResize(self, event):
+        # layout only changes with the window size, the canvas redraws afterwards
+        for name in ['Main', 'Data', 'Flow']:
+            if event.canvas is self.canvas[name]:
+                self.figure[name].tight_layout()
+        return
+
         #=====================================================================#
         # Get new image data. Delete old image and plot a new one. This is
         # necessary when the aspect ratio is being changed, i.e. after cropping
@@ -816,13 +1219,14 @@ class Window():
         #=====================================================================#          
     def drawMain(self):
              #--------- Load image with current index --------- 
-        self.imageData = mpimg.imread(os.path.join(self.imageFolder.get(),self.imageNames[self.currentIndex.get()]))
+        self.imageData = self.frames[self.currentIndex.get()]
              #--------- Delete old image and plot new ---------             
         plt.figure('Main')
         self.ax['Main'].cla()
         self.rect = []
+        self.ROI = []
         self.flowRegion = []
-        self.mainImage = plt.imshow(self.imageData,cmap=cMaps[self.colorMap.get()])
+        self.mainImage = plt.imshow(self.imageData,cmap=cMaps[self.colorMap.get()],animated=True)
         self.ax['Main'].set_aspect('equal', 'datalim')
         plt.setp(self.ax['Main'].get_xticklabels(), visible=False)
         plt.setp(self.ax['Main'].get_yticklabels(), visible=False)
@@ -834,12 +1238,15 @@ class Window():
         # Get new image data and update the image within the main frame.
         # The axis are not being updated. This speeds up the render process.
         #=====================================================================#          
-    def updateMain(self):
-             #--------- Load image with current index --------- 
-        self.imageData = mpimg.imread(os.path.join(self.imageFolder.get(),self.imageNames[self.currentIndex.get()]))
+    def updateMain(self, index):
+             #--------- Load image with index --------- 
+        if self.tracker is not None:
+            # the tracking thread reads ahead, keep its direction
+            self.imageData = self.frames.load(index)
+        else:
+            self.imageData = self.frames[index]
              #--------- Update image data ---------             
         self.mainImage.set_data(self.imageData)
-        self.canvas['Main'].draw()
         return
         
 #    def onPressFlow(self,event):
@@ -879,9 +1286,7 @@ class Window():
         #=====================================================================#  
     def newFrame(self):
              #--------- Update line position and main image ---------
-        self.drawDataLine()
-        self.updateMain()
-        self.drawRect()
+        self.requestRender('image', 'overlays')
         
         self.currentIndex.set(self.currentIndex.get() + 1 + self.skipFrames.get())
              #--------- Increment current index  --------- 
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Batch tracking of many recordings for PIA.
+Recordings are listed in a json manifest and tracked in parallel on a process
+pool, eg.
+    python piaBatch.py manifest.json --out results/
+A manifest is a list of recordings:
+    [{"imageFolder": "/data/animal1", "x": 250, "y": 300,
+      "mode": "Single Neuron (Ratio)", "shift": [-10, -510],
+      "boxBG": 200, "boxNeuron": 50, "signalThreshold": 95}, ...]
+Only imageFolder, x and y are required; the others default to the GUI values.
+Optional keys are imageType, start, end and outFile. An outFile ending in .pia
+is written in the binary piaResults format. Without one, results are named
+after the image folder relative to the folder all recordings share, and a
+manifest in which two recordings would write the same file is rejected.
+A shift of "auto" is estimated from the images (piaShift).
+"""
+import os
+import time
+import json
+import argparse
+import traceback
+import multiprocessing
+import piaFrames
+import piaTrack
+import piaShift
+import piaResults
+
+DEFAULTS = {'mode': 'Single Neuron',
+            'imageType': 'tif',
+            'shift': [-10, -510],
+            'boxBG': 200,
+            'boxNeuron': 50,
+            'signalThreshold': 95,
+            'adaptive': False,
+            'boxWide': None,
+            'start': 0,
+            'end': None,
+            'outFile': None}
+
+
+def commonRoot(folders):
+    """deepest folder containing all of folders."""
+    parts = [os.path.abspath(folder).split(os.sep) for folder in folders]
+    common = []
+    for names in zip(*parts):
+        if any(name != names[0] for name in names):
+            break
+        common.append(names[0])
+    return os.sep.join(common) or os.sep
+
+def outputName(entry, outFolder, root=None):
+    """output file of a recording unless given, named after its image folder relative to root.
+
+    root is the common folder of all recordings in a batch, so day1/worm1
+    and day2/worm1 become day1_worm1_pia.txt and day2_worm1_pia.txt.
+    """
+    if entry.get('outFile'):
+        return entry['outFile']
+    folder = os.path.abspath(entry['imageFolder'])
+    if root is None or os.path.normpath(root) == folder:
+        root = os.path.dirname(folder)
+    name = '_'.join(os.path.relpath(folder, root).split(os.sep))
+    return os.path.join(outFolder, os.path.splitext(name)[0]+'_pia.txt')
+
+def outputNames(recordings, outFolder):
+    """output files of all recordings. Raises ValueError if two recordings would write the same file."""
+    root = commonRoot([entry['imageFolder'] for entry in recordings]) if recordings else None
+    names = [outputName(entry, outFolder, root) for entry in recordings]
+    seen = {}
+    for entry, name in zip(recordings, names):
+        key = os.path.normcase(os.path.abspath(name))
+        if key in seen:
+            raise ValueError('{} and {} both write to {}, set outFile in the manifest'.format(
+                             seen[key], entry['imageFolder'], name))
+        seen[key] = entry['imageFolder']
+    return names
+
+def trackRecording(job):
+    """track a single recording. Runs in a pool worker and never raises."""
+    entry, outFile = job
+    result = {'imageFolder': entry['imageFolder'], 'outFile': outFile, 'frames': 0, 'seconds': 0.0, 'error': None}
+    t0 = time.time()
+    try:
+        frames = piaFrames.openFrames(entry['imageFolder'], entry['imageType'])
+        if frames is None:
+            raise IOError('No images found in folder!')
+        try:
+            shift = entry['shift']
+            if shift == 'auto':
+                estimate = piaShift.recordingShift(frames, entry['imageFolder'], DEFAULTS['shift'])
+                if not piaShift.isClear(estimate):
+                    raise ValueError('no clear dual color shift found, set the shift in the manifest')
+                shift = estimate['shift']
+            result['shift'] = list(shift)
+            data = piaTrack.track(frames, entry['mode'], (entry['x'], entry['y']), entry['boxBG'], entry['boxNeuron'],
+                                  entry['signalThreshold'], shift, entry['start'], entry['end'], adaptive=entry['adaptive'], boxWide=entry['boxWide'])
+            result['frames'] = (entry['end'] or len(frames)) - entry['start']
+        finally:
+            frames.close()
+        piaResults.saveData(outFile, data, piaTrack.runInfo(entry['mode'], entry['boxBG'], entry['boxNeuron'],
+                            entry['signalThreshold'], shift, entry['imageFolder'], entry['adaptive'], entry['boxWide']))
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - t0
+    return result
+
+def readManifest(fname, outFolder='.'):
+    """list of recordings with defaults filled in. Raises ValueError for entries that are invalid or share an output file."""
+    with open(fname, 'r') as f:
+        entries = json.load(f)
+    recordings = []
+    for entry in entries:
+        for key in ('imageFolder', 'x', 'y'):
+            if key not in entry:
+                raise ValueError('manifest entry without {}: {}'.format(key, entry))
+        if entry.get('mode', DEFAULTS['mode']) not in piaTrack.MODES:
+            raise ValueError('unknown tracking mode {}'.format(entry['mode']))
+        recording = dict(DEFAULTS)
+        recording.update(entry)
+        recordings.append(recording)
+    outputNames(recordings, outFolder)
+    return recordings
+
+def runBatch(recordings, outFolder, processes=None):
+    """track all recordings on a process pool. Returns one result per recording."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if not os.path.isdir(outFolder):
+        os.makedirs(outFolder)
+    jobs = zip(recordings, outputNames(recordings, outFolder))
+    pool = multiprocessing.Pool(processes=min(processes, len(jobs)))
+    results = []
+    try:
+        for result in pool.imap_unordered(trackRecording, jobs):
+            status = 'failed' if result['error'] else '{:d} frames'.format(result['frames'])
+            print '{} ({}, {:.1f} s)'.format(result['imageFolder'], status, result['seconds'])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Track a list of recordings in parallel without the PIA window.')
+    parser.add_argument('manifest', help='json list of recordings')
+    parser.add_argument('--out', default='.', help='folder for output files and the summary')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    args = parser.parse_args(args)
+    recordings = readManifest(args.manifest, args.out)
+    if len(recordings) == 0:
+        raise SystemExit('Manifest is empty!')
+    t0 = time.time()
+    results = runBatch(recordings, args.out, args.processes)
+    summary = {'seconds': time.time() - t0,
+               'failed': sum(1 for r in results if r['error']),
+               'recordings': results}
+    with open(os.path.join(args.out, 'pia_batch_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    print 'tracked {:d} recordings in {:.1f} s, {:d} failed'.format(len(results), summary['seconds'], summary['failed'])
+    return summary
+
+
+if __name__ == "__main__":
+    main()
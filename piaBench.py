@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for PIA.
+Generates synthetic GCaMP recordings (moving Gaussian blobs with calcium like
+transients, noise, drift, a dual view channel offset and two neuron
+configurations) and times the piaImage trackers, their batched kernels and
+the full tracking loop for all modes, frame sizes and background box sizes, eg.
+    python piaBench.py --sizes 512 1024 --bg 100 200 --frames 100
+Reports frames/s, the size of the stack and the peak resident memory of the
+process while tracking, and checks the tracked locations against the ground
+truth. Exits with status 1 if tracking lost an object, so speedups can't
+silently break accuracy.
+"""
+import os
+import time
+import json
+import argparse
+import threading
+import numpy as np
+import piaImage
+import piaTrack
+
+# the trackers benchmarked for each mode
+FUNCTIONS = {'Single Neuron': 'fluorescence',
+             'Single Neuron (Ratio)': 'dualFluorescence',
+             '2 Neurons': 'singleFluorescence2Neurons',
+             '2 Neurons (Ratio)': 'dualFluorescence2Neurons'}
+
+
+#=============================================================================#
+#                     Synthetic recordings
+#=============================================================================#
+def calciumTrace(nFrames, rng, rate=0.03, tau=8.):
+    """relative fluorescence change of random transients with exponential decay."""
+    spikes = (rng.rand(nFrames) < rate)*rng.uniform(0.5, 2., nFrames)
+    trace = np.zeros(nFrames)
+    for i in xrange(nFrames):
+        trace[i] = (trace[i-1] if i > 0 else 0)*np.exp(-1./tau) + spikes[i]
+    return trace
+
+def trajectory(nFrames, rng, center, extent, speed, drift):
+    """smooth random walk around center with a constant drift, kept within +-extent."""
+    velocity = np.zeros((nFrames, 2))
+    for i in xrange(1, nFrames):
+        velocity[i] = 0.9*velocity[i-1] + 0.1*rng.normal(0, 1, 2)
+    velocity *= speed/max(np.sqrt((velocity**2).sum(axis=1)).mean(), 1e-9)
+    path = np.cumsum(velocity, axis=0) + np.arange(nFrames)[:,None]*drift
+    return center + np.clip(path, -extent, extent)
+
+def addBlob(frame, x, y, amplitude, sigma):
+    """add a Gaussian blob at x (column), y (row) to a float frame."""
+    r = int(4*sigma)+1
+    yMin, yMax = max(0, int(y)-r), min(frame.shape[0], int(y)+r+1)
+    xMin, xMax = max(0, int(x)-r), min(frame.shape[1], int(x)+r+1)
+    if yMin >= yMax or xMin >= xMax:
+        return
+    Y, X = np.ogrid[yMin:yMax, xMin:xMax]
+    frame[yMin:yMax, xMin:xMax] += amplitude*np.exp(-((X-x)**2+(Y-y)**2)/(2.*sigma**2))
+
+def syntheticStack(mode, nFrames=100, size=512, bgSize=100, sigma=2.5, speed=1.5, drift=0.05, noise=15., seed=0):
+    """synthetic recording for a tracking mode.
+
+    Returns the frames (nFrames x size x size, uint16), the dual view shift and
+    the true locations (nFrames x objects x 2, x and y in the tracked channel).
+    In the ratio modes the tracked (red) channel is the lower half of the
+    frame and the green channel is shifted into the upper half. The second
+    neuron of the two neuron modes moves along with the first one.
+    """
+    rng = np.random.RandomState(seed)
+    ratio = piaTrack.isRatio(mode)
+    nObjects = 2 if mode.startswith('2 Neurons') else 1
+    if ratio:
+        shift = (-10, -(size//2))
+        center = np.array([size/2., 3*size/4.])
+        room = size/4.
+    else:
+        shift = (0, 0)
+        center = np.array([size/2., size/2.])
+        room = size/2.
+    # keep the search box of the green channel inside the image
+    extent = max(room - bgSize - 4*sigma - 20, 0)
+    truth = np.zeros((nFrames, nObjects, 2))
+    truth[:,0] = trajectory(nFrames, rng, center, extent, speed, drift)
+    if nObjects == 2:
+        wobble = trajectory(nFrames, rng, np.zeros(2), 3., 0.3, 0)
+        truth[:,1] = truth[:,0] + [8*sigma, 0] + wobble
+    gcamp = [300*(1+calciumTrace(nFrames, rng)) for k in xrange(nObjects)]
+    # bleaching of the background and a small bank of noise frames
+    background = 100*(1 - 0.2*np.arange(nFrames)/float(nFrames))
+    bank = rng.normal(0, noise, (8, size, size)).astype(np.float32)
+    frames = np.empty((nFrames, size, size), dtype=np.uint16)
+    for i in xrange(nFrames):
+        frame = np.roll(bank[i % len(bank)], rng.randint(size), axis=0) + background[i]
+        for k in xrange(nObjects):
+            x, y = truth[i,k]
+            if ratio:
+                # constant red reference, GCaMP in the green channel
+                addBlob(frame, x, y, 400., sigma)
+                addBlob(frame, x+shift[0], y+shift[1], gcamp[k][i], sigma)
+            else:
+                addBlob(frame, x, y, gcamp[k][i], sigma)
+        frames[i] = np.clip(frame, 0, 65535)
+    return frames, shift, truth
+
+#=============================================================================#
+#                     Measurements
+#=============================================================================#
+def residentMemory():
+    """resident set size of this process in bytes (Linux), None if unknown."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+class PeakMemory():
+    """samples the resident memory in a thread while in use, eg.
+        with PeakMemory() as peak: ...
+        peak.peak, peak.used  # peak and peak increase in bytes
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = np.nan
+        self.used = np.nan
+
+    def sample(self):
+        while not self.done.is_set():
+            rss = residentMemory()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+            self.done.wait(self.interval)
+
+    def __enter__(self):
+        self.start = residentMemory()
+        self.peak = self.start
+        self.done = threading.Event()
+        if self.start is not None:
+            self.thread = threading.Thread(target=self.sample)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            self.done.set()
+            self.thread.join()
+            self.peak = max(self.peak, residentMemory())
+            self.used = self.peak - self.start
+        return False
+
+def trackedLocations(data, mode, nObjects):
+    """tracked x,y of the objects (frames x objects x 2)."""
+    xCol, yCol = piaTrack.positionColumns(mode)
+    return np.dstack([data[[xCol+10*k, yCol+10*k]].T for k in xrange(nObjects)]).transpose(0, 2, 1)
+
+def locationErrors(tracked, truth):
+    """distance of each tracked object to the ground truth. The two neurons may be swapped."""
+    errors = np.sqrt(((tracked-truth)**2).sum(axis=2))
+    if truth.shape[1] == 2:
+        swapped = np.sqrt(((tracked[:,::-1]-truth)**2).sum(axis=2))
+        errors = np.where(errors.sum(axis=1)[:,None] <= swapped.sum(axis=1)[:,None], errors, swapped)
+    return errors
+
+def benchmark(mode, size, boxBG, boxNeuron=30, nFrames=100, threshold=95, seed=0, adaptive=False, boxWide=None):
+    """time the tracker of a mode and the tracking loop on a synthetic recording.
+
+    adaptive and boxWide are the tracking options of piaTrack.track.
+    """
+    bgSize = int(np.round(boxBG/2.0))
+    neuronSize = int(np.round(boxNeuron/2.0))
+    frames, shift, truth = syntheticStack(mode, nFrames, size, bgSize, seed=seed)
+    nObjects = truth.shape[1]
+    function = getattr(piaImage, FUNCTIONS[mode])
+    # --- the tracker alone, searched at the true location of the last frame
+    prevLocs = np.ones(4)
+    t0 = time.time()
+    for i in xrange(nFrames):
+        xC, yC = truth[max(i-1, 0), 0]
+        if mode == 'Single Neuron':
+            function(frames[i], bgSize, neuronSize, threshold, xC, yC)
+        elif mode == 'Single Neuron (Ratio)':
+            function(frames[i], bgSize, neuronSize, threshold, xC, yC, shift)
+        else:
+            function(frames[i], bgSize, neuronSize, threshold, xC, yC, shift, prevLocs)
+    functionTime = time.time() - t0
+    # --- the batched kernels on the boxes at the same locations, single object modes only
+    batchFps = np.nan
+    if nObjects == 1:
+        centers = np.round(truth[np.maximum(np.arange(nFrames)-1, 0), 0])
+        t0 = time.time()
+        boxes = np.array([piaImage.cropImage(frames[i], xC, yC, bgSize, frames[i].shape)[0] for i, (xC, yC) in enumerate(centers)])
+        piaImage.fluorescenceBoxes(boxes, neuronSize, threshold, np.full(nFrames, float(bgSize)), np.full(nFrames, float(bgSize)), frames.shape[1:])
+        batchFps = nFrames/max(time.time() - t0, 1e-9)
+    # --- the full tracking loop from the true start location
+    with PeakMemory() as peak:
+        t0 = time.time()
+        data = piaTrack.track(frames, mode, truth[0,0], boxBG, boxNeuron, threshold, shift, adaptive=adaptive, boxWide=boxWide)
+        trackTime = time.time() - t0
+    errors = locationErrors(trackedLocations(data, mode, nObjects), truth)
+    return {'mode': mode, 'size': size, 'boxBG': boxBG, 'boxNeuron': boxNeuron, 'frames': nFrames,
+            'functionFps': nFrames/max(functionTime, 1e-9), 'batchFps': batchFps, 'trackFps': nFrames/max(trackTime, 1e-9),
+            'stackMB': frames.nbytes/2.**20, 'peakMB': peak.peak/2.**20, 'trackMB': peak.used/2.**20,
+            'meanError': float(errors.mean()), 'maxError': float(errors.max()),
+            'lost': int((errors > neuronSize).any(axis=1).sum())}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PIA trackers on synthetic recordings.')
+    parser.add_argument('--modes', nargs='+', default=piaTrack.MODES, choices=piaTrack.MODES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[256, 512, 1024], help='frame sizes (square)')
+    parser.add_argument('--bg', nargs='+', type=int, default=[100, 200], help='background box sizes')
+    parser.add_argument('--neuron', type=int, default=30, help='neuron box size')
+    parser.add_argument('--frames', type=int, default=100, help='frames per recording')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--adaptive', action='store_true', help='track with an adaptive search box')
+    parser.add_argument('--wide', type=int, default=None, help='track coarse to fine in a box of this size')
+    parser.add_argument('--out', default=None, help='json file for the results')
+    args = parser.parse_args(args)
+    print '{:22s} {:>5s} {:>4s} {:>9s} {:>9s} {:>9s} {:>8s} {:>8s} {:>7s} {:>7s} {:>5s}'.format(
+        'mode', 'size', 'bg', 'func fps', 'batch fps', 'track fps', 'stack MB', 'peak MB', 'err px', 'max px', 'lost')
+    results = []
+    for mode in args.modes:
+        for size in args.sizes:
+            for boxBG in args.bg:
+                # the search boxes of both channels have to fit into the frame
+                if piaTrack.isRatio(mode) and size/4. < boxBG/2. + 40:
+                    continue
+                r = benchmark(mode, size, boxBG, args.neuron, args.frames, seed=args.seed, adaptive=args.adaptive, boxWide=args.wide)
+                print '{mode:22s} {size:5d} {boxBG:4d} {functionFps:9.1f} {batchFps:9.1f} {trackFps:9.1f} {stackMB:8.1f} {peakMB:8.1f} {meanError:7.2f} {maxError:7.2f} {lost:5d}'.format(**r)
+                results.append(r)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    lost = sum(r['lost'] for r in results)
+    if lost > 0:
+        print 'tracking lost the objects in {:d} frames'.format(lost)
+        raise SystemExit(1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Frame access for PIA.
+A FrameSource owns decoding of the images of a recording. Frames are accessed
+by index, kept in a memory bounded LRU cache and read ahead in the direction
+of playback/tracking by a background thread.
+Single file multi-page TIFF stacks are read page by page on demand.
+A folder can also be converted once into a single uncompressed stack that is
+memory mapped by later sessions, eg.
+    python piaFrames.py /path/to/images --type tif
+"""
+import os
+import json
+import argparse
+import threading
+import traceback
+import Queue
+from collections import OrderedDict
+import numpy as np
+import matplotlib.image as mpimg
+import piaProfile
+
+STACKNAME = 'pia_stack'
+
+
+def loadImageNames(imageFolder, imageType):
+    """image names in a folder sorted by their _NNNN timestamp."""
+    tmpNames = {}
+    for item in os.listdir(imageFolder):
+        if item[-3:] == imageType:
+            time = float(item[:-4].split('_')[-1])
+            tmpNames[time] = item
+    return [tmpNames[x] for x in sorted(tmpNames.keys())]
+
+def openFrames(imageFolder, imageType):
+    """frame source for a folder or a multi-page tif; uses a converted stack if there is one. None if empty."""
+    if os.path.isfile(imageFolder):
+        frames = TiffFrameSource(imageFolder)
+        return frames if len(frames) > 0 else None
+    if hasStack(imageFolder):
+        return StackFrameSource(imageFolder)
+    imageNames = loadImageNames(imageFolder, imageType)
+    if len(imageNames) == 0:
+        return None
+    return FrameSource(imageFolder, imageNames)
+
+
+class FrameSource():
+    """index based, cached access to a folder of images."""
+    def __init__(self, imageFolder, imageNames, cacheSize=256, readAhead=10):
+        # cacheSize in MB, readAhead in frames
+        self.imageFolder = imageFolder
+        self.imageNames = list(imageNames)
+        self.cacheSize = cacheSize*2**20
+        self.readAhead = readAhead
+        self.cache = OrderedDict()
+        self.cacheBytes = 0
+        self.loading = set()
+        self.lock = threading.Condition()
+        # the GUI and the tracking thread read frames at the same time,
+        # every thread keeps its own direction
+        self.direction = threading.local()
+        self.requests = Queue.Queue()
+        self.worker = None
+        if self.readAhead > 0:
+            self.worker = threading.Thread(target=self.prefetchWorker)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def __len__(self):
+        return len(self.imageNames)
+
+    @piaProfile.timed('decode')
+    def read(self, index):
+        """decode a single frame, bypassing the cache."""
+        return mpimg.imread(os.path.join(self.imageFolder, self.imageNames[index]))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        img = self.load(index)
+        self.prefetch(index)
+        return img
+
+    def load(self, index):
+        """return a frame from the cache or decode it."""
+        with self.lock:
+            # another thread is decoding this frame, wait for it
+            while index in self.loading:
+                self.lock.wait()
+            if index in self.cache:
+                img = self.cache.pop(index)
+                self.cache[index] = img
+                return img
+            self.loading.add(index)
+        try:
+            img = self.read(index)
+        finally:
+            with self.lock:
+                self.loading.discard(index)
+                self.lock.notify_all()
+        self.store(index, img)
+        return img
+
+    def store(self, index, img):
+        """add a frame to the cache and evict least recently used frames."""
+        with self.lock:
+            if index in self.cache:
+                return
+            self.cache[index] = img
+            self.cacheBytes += img.nbytes
+            while self.cacheBytes > self.cacheSize and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.cacheBytes -= old.nbytes
+
+    def prefetch(self, index):
+        """ask the worker to read ahead of index in the direction the calling thread moves in."""
+        lastIndex = getattr(self.direction, 'lastIndex', None)
+        step = getattr(self.direction, 'step', 1)
+        if lastIndex is not None and index != lastIndex and abs(index-lastIndex) <= self.readAhead:
+            step = index - lastIndex
+        self.direction.lastIndex = index
+        self.direction.step = step
+        if self.readAhead > 0:
+            self.requests.put((index, step))
+
+    def prefetchWorker(self):
+        while True:
+            index, step = self.requests.get()
+            # only serve the most recent request
+            while not self.requests.empty():
+                index, step = self.requests.get()
+            if index is None:
+                return
+            for k in xrange(1, self.readAhead+1):
+                if not self.requests.empty():
+                    break
+                nextIndex = index + k*step
+                if nextIndex < 0 or nextIndex >= len(self):
+                    break
+                with self.lock:
+                    if nextIndex in self.cache or nextIndex in self.loading:
+                        continue
+                try:
+                    self.load(nextIndex)
+                except (IOError, OSError):
+                    break
+
+    def close(self):
+        """stop the read-ahead thread and drop all cached frames."""
+        if self.worker is not None:
+            self.requests.put((None, 0))
+            self.worker.join(1.0)
+        with self.lock:
+            self.cache.clear()
+            self.cacheBytes = 0
+
+
+#=============================================================================#
+#                     Memory mapped frame stacks
+#=============================================================================#
+def stackFiles(imageFolder):
+    """raw stack and sidecar file of a folder."""
+    base = os.path.join(imageFolder, STACKNAME)
+    return base+'.raw', base+'.json'
+
+def hasStack(imageFolder):
+    return all(os.path.isfile(f) for f in stackFiles(imageFolder))
+
+def convertToStack(frames, imageFolder=None):
+    """write all frames into one uncompressed stack next to the images."""
+    if imageFolder is None:
+        imageFolder = frames.imageFolder
+    rawFile, infoFile = stackFiles(imageFolder)
+    first = frames[0]
+    shape = (len(frames),) + first.shape
+    stack = np.memmap(rawFile, dtype=first.dtype, mode='w+', shape=shape)
+    for index in xrange(len(frames)):
+        stack[index] = frames[index]
+    stack.flush()
+    del stack
+    # the sidecar is written last, a partial stack is never picked up
+    info = {'shape': list(shape), 'dtype': first.dtype.str, 'imageNames': list(frames.imageNames)}
+    with open(infoFile, 'w') as f:
+        json.dump(info, f)
+    return rawFile
+
+class StackConverter(threading.Thread):
+    """runs convertToStack on a worker thread. An exception ends the conversion and is kept in error."""
+    def __init__(self, frames, imageFolder=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frames = frames
+        self.imageFolder = imageFolder
+        self.rawFile = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.rawFile = convertToStack(self.frames, self.imageFolder)
+        except Exception:
+            self.error = traceback.format_exc()
+
+class StackFrameSource(FrameSource):
+    """frames sliced from a memory mapped stack written by convertToStack."""
+    def __init__(self, imageFolder):
+        rawFile, infoFile = stackFiles(imageFolder)
+        with open(infoFile, 'r') as f:
+            info = json.load(f)
+        self.stack = np.memmap(rawFile, dtype=np.dtype(str(info['dtype'])), mode='r', shape=tuple(info['shape']))
+        # no decoding, so neither caching nor read-ahead is needed
+        FrameSource.__init__(self, imageFolder, info['imageNames'], cacheSize=0, readAhead=0)
+
+    @piaProfile.timed('decode')
+    def read(self, index):
+        return np.asarray(self.stack[index])
+
+    def __getitem__(self, index):
+        return self.read(index)
+
+    def close(self):
+        FrameSource.close(self)
+        self.stack = None
+
+#=============================================================================#
+#                     Multi-page TIFF stacks
+#=============================================================================#
+class TiffFrameSource(FrameSource):
+    """frames decoded lazily from the pages of a single (multi-page) tif file."""
+    def __init__(self, fileName, cacheSize=256, readAhead=10):
+        from PIL import Image
+        self.image = Image.open(fileName)
+        # PIL image objects are not thread safe
+        self.pageLock = threading.Lock()
+        # counting pages walks the page headers only, no pixel data is read
+        nPages = getattr(self.image, 'n_frames', 1)
+        name = os.path.basename(fileName)
+        imageNames = ['{}[{:d}]'.format(name, page) for page in xrange(nPages)]
+        FrameSource.__init__(self, fileName, imageNames, cacheSize, readAhead)
+
+    @piaProfile.timed('decode')
+    def read(self, index):
+        with self.pageLock:
+            self.image.seek(index)
+            # same conversion as matplotlib.image.imread uses for tif files
+            return mpimg.pil_to_array(self.image)
+
+    def close(self):
+        FrameSource.close(self)
+        with self.pageLock:
+            self.image.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert an image folder into a memory mapped PIA stack.')
+    parser.add_argument('imageFolder')
+    parser.add_argument('--type', default='tif', help='image data type (tif, png, jpg)')
+    args = parser.parse_args()
+    imageNames = loadImageNames(args.imageFolder, args.type)
+    if len(imageNames) == 0:
+        raise SystemExit('No images found in folder!')
+    frames = FrameSource(args.imageFolder, imageNames)
+    print 'wrote', convertToStack(frames)
+    frames.close()
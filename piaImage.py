@@ -7,6 +7,7 @@ image analysis functions for PIA.
 import numpy as np
 from scipy import ndimage
 import matplotlib.pylab as plt
+import piaProfile
 
 
 def rgb2gray(rgb):
@@ -22,56 +23,194 @@ def cropImage(Image, xC, yC, bgSize, imSize):
     xMin = int(max(0,xC-bgSize))
     xMax = int(min(imSize[1],xC+bgSize))
     return Image[yMin:yMax, xMin:xMax], xMin, yMin
+
+@piaProfile.timed('crop')
+def cropGrayImage(Image, xC, yC, bgSize, imSize):
+    """crop a box and convert only its pixels of RGB images to grayscale."""
+    bgImage, xMin, yMin = cropImage(Image, xC, yC, bgSize, imSize)
+    if bgImage.ndim == 3:
+        bgImage = rgb2gray(bgImage)
+    return bgImage, xMin, yMin
+    
+def thresholdsFromCounts(counts, nPixels, threshold):
+    """signal thresholds from a histogram of integer pixel values.
+
+    Same interpolation as np.percentile (numpy <= 1.16, linear), so the
+    values are bit-identical to np.percentile of the pixels.
+    """
+    q = np.true_divide([threshold, (100+threshold)/2.], 100)
+    indices = q*(nPixels-1)
+    below = np.floor(indices).astype(np.intp)
+    above = below + 1
+    above[above > nPixels-1] = nPixels-1
+    weightsAbove = indices - below
+    weightsBelow = 1.0 - weightsAbove
+    # --- the k-th smallest value is the first bin whose cumulative count exceeds k
+    cumulative = np.cumsum(counts)
+    valuesBelow = np.searchsorted(cumulative, below, side='right')
+    valuesAbove = np.searchsorted(cumulative, above, side='right')
+    return valuesBelow*weightsBelow + valuesAbove*weightsAbove
+
+@piaProfile.timed('threshold')
+def boxThreshold(bgImage, threshold):
+    """pixel values below which threshold % and (100+threshold)/2 % of the box are.
+
+    uint8/uint16 boxes use a histogram instead of sorting; other data np.percentile.
+    """
+    if bgImage.dtype in (np.uint8, np.uint16) and bgImage.size > 0:
+        counts = np.bincount(bgImage.ravel())
+        return thresholdsFromCounts(counts, bgImage.size, threshold)
+    return np.percentile(bgImage, [threshold, (100+threshold)/2.])
+
+def boxDifference(box, other):
+    """parts of box (yMin, yMax, xMin, xMax) outside of other as a list of boxes."""
+    yMin, yMax, xMin, xMax = box
+    oyMin, oyMax = max(yMin, other[0]), min(yMax, other[1])
+    oxMin, oxMax = max(xMin, other[2]), min(xMax, other[3])
+    if oyMin >= oyMax or oxMin >= oxMax:
+        return [box]
+    parts = [(yMin, oyMin, xMin, xMax), (oyMax, yMax, xMin, xMax),
+             (oyMin, oyMax, xMin, oxMin), (oyMin, oyMax, oxMax, xMax)]
+    return [p for p in parts if p[0] < p[1] and p[2] < p[3]]
+
+class IncrementalThreshold():
+    """histogram thresholds that are updated instead of recomputed for an overlapping box.
+
+    Only valid for the same frame, eg. when a frame is searched again with a
+    moved or resized box or with other thresholds. A different frame or a
+    box that overlaps less than minOverlap starts a new histogram.
+    """
+    def __init__(self, minOverlap=0.5):
+        self.minOverlap = minOverlap
+        self.image = None
+        self.box = None
+        self.counts = None
+
+    @piaProfile.timed('threshold')
+    def __call__(self, Image, bgImage, xMin, yMin, threshold):
+        if Image.ndim != 2 or Image.dtype not in (np.uint8, np.uint16) or bgImage.size == 0:
+            return boxThreshold(bgImage, threshold)
+        height, width = bgImage.shape
+        box = (yMin, yMin+height, xMin, xMin+width)
+        nBins = np.iinfo(Image.dtype).max+1
+        removed = added = None
+        if self.image is Image:
+            removed = boxDifference(self.box, box)
+            added = boxDifference(box, self.box)
+            changed = sum((b[1]-b[0])*(b[3]-b[2]) for b in removed+added)
+            if changed > (1-self.minOverlap)*bgImage.size:
+                removed = added = None
+        if removed is None:
+            self.counts = np.bincount(bgImage.ravel(), minlength=nBins)
+        else:
+            for b in removed:
+                self.counts -= np.bincount(Image[b[0]:b[1], b[2]:b[3]].ravel(), minlength=nBins)
+            for b in added:
+                self.counts += np.bincount(Image[b[0]:b[1], b[2]:b[3]].ravel(), minlength=nBins)
+        self.image = Image
+        self.box = box
+        return thresholdsFromCounts(self.counts, bgImage.size, threshold)
+
+@piaProfile.timed('average')
+def selectedMean(image, select):
+    '''mean of the selected pixels, nan if none are selected.
     
+    Same as np.ma.average of image masked where select is False: one sum
+    over the image with the other pixels set to 0, in the image dtype.
+    '''
+    count = np.count_nonzero(select)
+    if count == 0:
+        return np.nan
+    return np.where(select, image, 0).sum()*1./count
+
+def objectAverage(bgImage, neuronObject, threshold):
+    '''mean of the object pixels brighter than threshold. neuronObject is True outside the object.'''
+    # --- the masked version summed all pixels brighter than threshold, 0 outside the object
+    bright = bgImage > threshold
+    return selectedMean(bgImage[bright], ~neuronObject[bright])
+
+@piaProfile.timed('background')
 def calculateWithMask(bgImage, xNewNeuron,yNewNeuron,neuronSize,imSize):
     '''calculate a masked quantity'''
-    mask = np.zeros(bgImage.shape, dtype=bool)
     # shade out a box
     yMinSRegion = int(max(0,yNewNeuron-neuronSize))
     yMaxSRegion = int(min(imSize[0],yNewNeuron+neuronSize))
     xMinSRegion = int(max(0,xNewNeuron-neuronSize))
     xMaxSRegion = int(min(imSize[1],xNewNeuron+neuronSize))
-
-    mask[yMinSRegion:yMaxSRegion,xMinSRegion:xMaxSRegion] = True
-        
-    bgLevel = np.ma.average(np.ma.masked_array(bgImage, mask))
+    outside = bgImage.copy('K')
+    outside[yMinSRegion:yMaxSRegion,xMinSRegion:xMaxSRegion] = 0
+    count = bgImage.size - bgImage[yMinSRegion:yMaxSRegion,xMinSRegion:xMaxSRegion].size
+    if count == 0:
+        return np.nan
+    # --- one sum over the frame as np.ma.average, not strip by strip
+    bgLevel = outside.sum()*1./count
     return bgLevel
 
 def calculateWith2Masks(bgImage, xNewNeuron1,yNewNeuron1,xNewNeuron2,yNewNeuron2,neuronSize,imSize):
     '''calculate a masked quantity for two objects'''
-    mask = np.zeros(bgImage.shape, dtype=bool)
-    # shade out two boxes
+    # the box loop always shaded out a single box at (xNewNeuron1, xNewNeuron1).
+    # This is kept to reproduce existing analyses.
     for (xNewNeuron, yNewNeuron) in zip([xNewNeuron1, xNewNeuron2], [xNewNeuron1]):
-        yMinSRegion = max(0,yNewNeuron-neuronSize)
-        yMaxSRegion = min(imSize[0],yNewNeuron+neuronSize)
-        xMinSRegion = max(0,xNewNeuron-neuronSize)
-        xMaxSRegion = min(imSize[1],xNewNeuron+neuronSize)
-    
-        mask[yMinSRegion:yMaxSRegion,xMinSRegion:xMaxSRegion] = True
-        
-    bgLevel = np.ma.average(np.ma.masked_array(bgImage, mask))
+        bgLevel = calculateWithMask(bgImage, xNewNeuron, yNewNeuron, neuronSize, imSize)
     return bgLevel
 
+def labelStatistics(bgImage, label_im, nb_labels):
+    """area, mean brightness and center of mass of every label in one pass over the label image.
+    
+    Gives the same numbers as ndimage.measurements.mean and center_of_mass,
+    but without rescanning the label image per statistic. Areas include
+    the background (label 0).
+    """
+    labels = label_im.ravel()
+    img = bgImage.ravel()
+    yGrid, xGrid = np.ogrid[0:bgImage.shape[0], 0:bgImage.shape[1]]
+    areas = np.bincount(labels, minlength=nb_labels+1)
+    sums = np.bincount(labels, weights=img, minlength=nb_labels+1)
+    ySums = np.bincount(labels, weights=(bgImage*yGrid.astype(float)).ravel(), minlength=nb_labels+1)
+    xSums = np.bincount(labels, weights=(bgImage*xGrid.astype(float)).ravel(), minlength=nb_labels+1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        meanBrightness = sums[1:]/areas[1:].astype(float)
+        centroids = zip(ySums[1:]/sums[1:], xSums[1:]/sums[1:])
+    return areas, meanBrightness, centroids
+
+def filterLargeBlobs(label_im, areas, meanBrightness, maxArea=200):
+    """remove objects larger than maxArea pixels from the label image and the selection.
+
+    Objects are visited in label order and all rows touched by a large object
+    are cleared. Objects sharing these rows lose their pixels, which counts
+    towards their area when they are visited. Only objects with a total area
+    above maxArea can be removed, so only those are looked at.
+    """
+    candidates = np.flatnonzero(areas[1:] > maxArea) + 1
+    if len(candidates) == 0:
+        return label_im
+    boxes = ndimage.find_objects(label_im, max_label=candidates[-1])
+    cleared = np.zeros(label_im.shape[0], dtype=bool)
+    for loc in candidates:
+        rows = boxes[loc-1][0]
+        rowAreas = np.sum(label_im[boxes[loc-1]] == loc, axis=1)
+        if np.sum(rowAreas[~cleared[rows]]) > maxArea:
+            cleared[rows][rowAreas > 0] = True
+            meanBrightness[loc-1] = 0
+    label_im[cleared] = 0
+    return label_im
+
 def findNeuron(bgImage, threshold, xNeuron,  yNeuron):
     """find bright object in small roi image."""
-    mask = np.where(bgImage > threshold[0], 1, 0)
-    mask = ndimage.binary_opening(mask,structure = np.ones((2,2)))
-    mask = ndimage.binary_closing(mask)
-        # --- Individually label all connected regions and get their center of mass
-    label_im, nb_labels = ndimage.label(mask)
-#    plt.figure()
-#    plt.imshow(label_im)
-#    plt.show()
-    centroids = ndimage.measurements.center_of_mass(bgImage, label_im, xrange(1,nb_labels+1))
-    # --- select brightest object by default (mean brightness)
-    meanBrightness = ndimage.measurements.mean(bgImage, label_im, xrange(1,nb_labels+1))
-    #meanArea = [len(np.where(label_im == loc)[0]) if len(np.where(label_im == loc)[0])>200 else np.nan for loc in xrange(1,nb_labels+1) ]
-    # filter large blobs
-    for loc in xrange(1,nb_labels+1):
-        area = np.where(label_im == loc)[0]
-        if len(area)>200:
-            label_im[area] =0
-            meanBrightness[loc-1] = 0
+    with piaProfile.stage('morphology'):
+        mask = bgImage > threshold[0]
+        mask = ndimage.binary_opening(mask,structure = np.ones((2,2)))
+        mask = ndimage.binary_closing(mask)
+    with piaProfile.stage('labels'):
+            # --- Individually label all connected regions and get their center of mass
+        label_im, nb_labels = ndimage.label(mask)
+#        plt.figure()
+#        plt.imshow(label_im)
+#        plt.show()
+        # --- area, center of mass and mean brightness of all objects in one pass
+        areas, meanBrightness, centroids = labelStatistics(bgImage, label_im, nb_labels)
+        # filter large blobs
+        filterLargeBlobs(label_im, areas, meanBrightness)
             
 #        # --- Calculate the distance of each new cms to the old neuron position
 #        # --- and select the new neuron position to be the object closest to
@@ -93,20 +232,116 @@ def findNeuron(bgImage, threshold, xNeuron,  yNeuron):
     else:
         yNewNeuron,xNewNeuron = yNeuron,  xNeuron
         loc = -1  
-    neuronObject = np.where(label_im == loc+1,0,1)
-    neuronArea = np.sum(neuronObject)
+    # --- mask is True outside of the object
+    neuronObject = label_im != loc+1
+    neuronArea = np.count_nonzero(neuronObject)
         # --- Get average of the neuron fluoresence --- 
-    tmp_neuron = np.ma.masked_array(bgImage, neuronObject)
-    newNeuronAverage = np.ma.average(tmp_neuron[tmp_neuron>threshold[1]])
+    newNeuronAverage = objectAverage(bgImage, neuronObject, threshold[1])
         
     return yNewNeuron,xNewNeuron, newNeuronAverage,neuronArea,  neuronObject
     
+def findTwoNeurons(bgImage, threshold, xNeuron, yNeuron, xMin, yMin, prevLocs):
+    """find the two brightest objects in small roi image, keeping their identity from the previous frame."""
+    with piaProfile.stage('morphology'):
+        mask = bgImage > threshold[0]
+        mask = ndimage.binary_opening(mask,structure = np.ones((4,4)))
+        mask = ndimage.binary_closing(mask)
+    with piaProfile.stage('labels'):
+            # --- Individually label all connected regions and get their center of mass
+        label_im, nb_labels = ndimage.label(mask)
+        # --- area, center of mass and mean brightness of all objects in one pass
+        areas, meanBrightness, centroids = labelStatistics(bgImage, label_im, nb_labels)
+#    plt.imshow(label_im)
+#    plt.show()
+    # --- masks are True outside of an object, the area counts the masked pixels
+    if nb_labels > 1:
+        # if at least two are found, use the brightest ones
+        ind = np.argpartition(meanBrightness, -2)[-2:]
+        ind =  ind[np.argsort(meanBrightness[ind])]
+        yNewNeuron1,xNewNeuron1 = centroids[ind[0]]
+        yNewNeuron2,xNewNeuron2 = centroids[ind[1]]
+        neuronObject1 = label_im != ind[0]+1
+        neuronArea1 = label_im.size - areas[ind[0]+1]
+        neuronObject2 = label_im != ind[1]+1
+        neuronArea2 = label_im.size - areas[ind[1]+1]
+        vec1 = np.array([prevLocs[0]-prevLocs[2], prevLocs[1]-prevLocs[3]])
+        vec2 = np.array([xNewNeuron2 - xNewNeuron1, yNewNeuron2- yNewNeuron1])
+        # P2-P1 = direction from P1 to P2- vec2 from neuron1 to neuron2
+        
+        # detect neuron identity via angle
+        angle1 = np.arccos(np.clip(np.dot(vec1/np.linalg.norm(vec1), vec2/np.linalg.norm(vec2)),-1,1))
+        angle2 = np.arccos(np.clip(np.dot(vec1/np.linalg.norm(vec1), -vec2/np.linalg.norm(vec2)),-1,1))
+        # switch idenity
+        if angle2 > angle1:
+            tmp = yNewNeuron2,xNewNeuron2
+            yNewNeuron2,xNewNeuron2= yNewNeuron1,xNewNeuron1
+            yNewNeuron1,xNewNeuron1 = tmp
+            tmp = neuronObject2
+            neuronObject2 = neuronObject1
+            neuronObject1 = tmp
+            
+    if nb_labels == 1:
+        # if only one object found, assign same values to both
+        loc = np.argmax(meanBrightness)
+        yNewNeuron1,xNewNeuron1 = centroids[loc]
+        xNewNeuron2,yNewNeuron2 = prevLocs[-2]-xMin, prevLocs[-1]-yMin
+        neuronObject1 = label_im != loc+1
+        neuronArea1 = label_im.size - areas[loc+1]
+        neuronObject2 = neuronObject1
+        neuronArea2 = neuronArea1
+        
+    elif nb_labels==0:
+        # if nothing is found, use bg
+        yNewNeuron1,xNewNeuron1 = yNeuron,  xNeuron
+        yNewNeuron2,xNewNeuron2 = yNewNeuron1,xNewNeuron1
+        neuronObject1 = label_im != 0
+        neuronArea1 = label_im.size - areas[0]
+        neuronObject2 = neuronObject1
+        neuronArea2 = neuronArea1
+    return yNewNeuron1,xNewNeuron1, neuronArea1, neuronObject1, yNewNeuron2,xNewNeuron2, neuronArea2, neuronObject2
+    
+def searchRegion(shape, xNeuron, yNeuron, searchSize):
+    """slices of the part of a box of shape within searchSize of xNeuron, yNeuron, and its offset."""
+    yMin = int(max(0, yNeuron-searchSize))
+    yMax = int(min(shape[0], yNeuron+searchSize))
+    xMin = int(max(0, xNeuron-searchSize))
+    xMax = int(min(shape[1], xNeuron+searchSize))
+    return (slice(yMin, yMax), slice(xMin, xMax)), xMin, yMin
+
+def embedMask(neuronObject, shape, region):
+    """object mask of a search region as mask of the whole box, True outside of the object."""
+    mask = np.ones(shape, dtype=bool)
+    mask[region] = neuronObject
+    return mask
+
+def findNeuronNear(bgImage, threshold, xNeuron, yNeuron, searchSize=None):
+    """findNeuron within searchSize of xNeuron, yNeuron. Locations, mask and area refer to all of bgImage."""
+    if searchSize is None:
+        return findNeuron(bgImage, threshold, xNeuron, yNeuron)
+    region, x0, y0 = searchRegion(bgImage.shape, xNeuron, yNeuron, searchSize)
+    yNewNeuron,xNewNeuron, newNeuronAverage,neuronArea, neuronObject = \
+        findNeuron(bgImage[region], threshold, xNeuron-x0, yNeuron-y0)
+    # --- pixels outside of the search region are outside of the object
+    neuronArea += bgImage.size - neuronObject.size
+    return yNewNeuron+y0,xNewNeuron+x0, newNeuronAverage,neuronArea, embedMask(neuronObject, bgImage.shape, region)
+
+def findTwoNeuronsNear(bgImage, threshold, xNeuron, yNeuron, xMin, yMin, prevLocs, searchSize=None):
+    """findTwoNeurons within searchSize of xNeuron, yNeuron. Locations, masks and areas refer to all of bgImage."""
+    if searchSize is None:
+        return findTwoNeurons(bgImage, threshold, xNeuron, yNeuron, xMin, yMin, prevLocs)
+    region, x0, y0 = searchRegion(bgImage.shape, xNeuron, yNeuron, searchSize)
+    yNewNeuron1,xNewNeuron1, neuronArea1, neuronObject1, yNewNeuron2,xNewNeuron2, neuronArea2, neuronObject2 = \
+        findTwoNeurons(bgImage[region], threshold, xNeuron-x0, yNeuron-y0, xMin+x0, yMin+y0, prevLocs)
+    outside = bgImage.size - neuronObject1.size
+    return yNewNeuron1+y0,xNewNeuron1+x0, neuronArea1+outside, embedMask(neuronObject1, bgImage.shape, region), \
+        yNewNeuron2+y0,xNewNeuron2+x0, neuronArea2+outside, embedMask(neuronObject2, bgImage.shape, region)
+
 def cropOutOfBoundsRegions(xC, yC, bgSize, neuronObject, width, height, imSize, shift):
     # --- Deal with shift out of image
-    yMin = yC+shift[1]-bgSize
-    yMax = yC+shift[1]+bgSize
-    xMin = xC+shift[0]-bgSize
-    xMax = xC+shift[0]+bgSize
+    yMin = int(yC+shift[1]-bgSize)
+    yMax = int(yC+shift[1]+bgSize)
+    xMin = int(xC+shift[0]-bgSize)
+    xMax = int(xC+shift[0]+bgSize)
     
     if yMin < 0:
         neuronObject = neuronObject[-yMin:,]
@@ -119,14 +354,12 @@ def cropOutOfBoundsRegions(xC, yC, bgSize, neuronObject, width, height, imSize,
     return neuronObject    
     
 
-def fluorescence(Image, bgSize,neuronSize, threshold, xC, yC):
+def fluorescence(Image, bgSize,neuronSize, threshold, xC, yC, estimator=None, searchSize=None):
     """Calculate fluorescene in a larger ROI around coordinates xC and yC."""
     imSize = Image.shape
-    # deal with RGB images
-    if len(imSize) == 3:
-        Image = rgb2gray(Image)
      # -- Check if box needs to be cropped as it's ranging beyond the image
-    bgImage, xMin, yMin = cropImage(Image, xC, yC, bgSize, imSize)
+     # -- RGB images are converted to grayscale after cropping
+    bgImage, xMin, yMin = cropGrayImage(Image, xC, yC, bgSize, imSize)
     # --- Determine position of neuron; might not be centered due to cropping
     height, width = bgImage.shape
     
@@ -134,22 +367,23 @@ def fluorescence(Image, bgSize,neuronSize, threshold, xC, yC):
     yNeuron = yC - yMin
     # --- Get number of total pixels in the BG box and determine an intensity
     # --- threshold at which N % of the pixels have less intensity
-    threshold = np.percentile(bgImage, [threshold, (100+threshold)/2.])
-    yNewNeuron,xNewNeuron, newNeuronAverage, neuronArea,_ = findNeuron(bgImage, threshold, xNeuron,  yNeuron)
+    if estimator is None:
+        threshold = boxThreshold(bgImage, threshold)
+    else:
+        threshold = estimator(Image, bgImage, xMin, yMin, threshold)
+    yNewNeuron,xNewNeuron, newNeuronAverage, neuronArea,_ = findNeuronNear(bgImage, threshold, xNeuron,  yNeuron, searchSize)
     bgLevel = calculateWithMask(bgImage, xNewNeuron,yNewNeuron,neuronSize,imSize)
    
     return 1, 1, 1, 1 ,1,bgLevel, newNeuronAverage, xNewNeuron+xMin, yNewNeuron+yMin, neuronArea,1, 1, 1, 1 ,1,1, 1, 1, 1 ,1,
 
 
     
-def dualFluorescence(Image, bgSize,neuronSize, threshold, xC, yC, shift):
+def dualFluorescence(Image, bgSize,neuronSize, threshold, xC, yC, shift, estimator=None, searchSize=None):
     """Calculate fluorescene in a larger ROI around coordinates xC and yC in two ratiometric images."""
     imSize = Image.shape
-    # deal with RGB images
-    if len(imSize) == 3:
-        Image = rgb2gray(Image)
      # -- Check if box needs to be cropped as it's ranging beyond the image
-    bgImage, xMin, yMin = cropImage(Image, xC, yC, bgSize, imSize)
+     # -- RGB images are converted to grayscale after cropping
+    bgImage, xMin, yMin = cropGrayImage(Image, xC, yC, bgSize, imSize)
     # --- Determine position of neuron; might not be centered due to cropping
     height, width = bgImage.shape
     
@@ -157,11 +391,14 @@ def dualFluorescence(Image, bgSize,neuronSize, threshold, xC, yC, shift):
     yNeuron = yC - yMin
     # --- Get number of total pixels in the BG box and determine an intensity
     # --- threshold at which N % of the pixels have less intensity
-    threshold = np.percentile(bgImage, [threshold, (100+threshold)/2.])
-    yNewNeuron,xNewNeuron, newNeuronAverage, neuronArea,neuronObject = findNeuron(bgImage, threshold, xNeuron,  yNeuron)
+    if estimator is None:
+        threshold = boxThreshold(bgImage, threshold)
+    else:
+        threshold = estimator(Image, bgImage, xMin, yMin, threshold)
+    yNewNeuron,xNewNeuron, newNeuronAverage, neuronArea,neuronObject = findNeuronNear(bgImage, threshold, xNeuron,  yNeuron, searchSize)
     #threshold = np.sort(bgImage, axis=None)[-int((1-threshold/100.)*height*width)]
     bgLevel = calculateWithMask(bgImage, xNewNeuron,yNewNeuron,neuronSize,imSize)
-    GreenImage, _,_ = cropImage(Image, xC+shift[0], yC+shift[1], bgSize, imSize)
+    GreenImage, _,_ = cropGrayImage(Image, xC+shift[0], yC+shift[1], bgSize, imSize)
     
     neuronObject = cropOutOfBoundsRegions(xC, yC, bgSize, neuronObject, width, height, imSize, shift)
     
@@ -171,98 +408,41 @@ def dualFluorescence(Image, bgSize,neuronSize, threshold, xC, yC, shift):
     if GreenImage.shape!= neuronObject.shape:
         print 'tracker out of bounds', GreenImage.shape, neuronObject.shape
         return bgLevel, newNeuronAverage, xNewNeuron+xMin, yNewNeuron+yMin, neuronArea, 1 , 1, xNewNeuron+xMin+shift[0], yNewNeuron+yMin+shift[1] ,neuronArea,1,1,1,1,1,1,1,1,1,1
-    tmpGreenNeuron = np.ma.masked_array(GreenImage, neuronObject)
-    GreenNeuronAverage = np.ma.average(tmpGreenNeuron)
+    GreenNeuronAverage = selectedMean(GreenImage, ~neuronObject)
     GreenbgLevel = calculateWithMask(GreenImage, xNewNeuron,yNewNeuron,neuronSize,imSize)
     
     return bgLevel, newNeuronAverage, xNewNeuron+xMin, yNewNeuron+yMin, neuronArea, GreenbgLevel , GreenNeuronAverage, xNewNeuron+xMin+shift[0], yNewNeuron+yMin+shift[1] ,neuronArea,1,1,1,1,1,1,1,1,1,1
 
-def dualFluorescence2Neurons(Image, bgSize,neuronSize, threshold, xC, yC, shift, prevLocs):
+def dualFluorescence2Neurons(Image, bgSize,neuronSize, threshold, xC, yC, shift, prevLocs, estimator=None, searchSize=None):
     """Calculate fluorescene for the two brightest objects in two ratiometric images."""
     imSize = Image.shape
-    # deal with RGB images
-    if len(imSize) == 3:
-        Image = rgb2gray(Image)
      # -- Check if box needs to be cropped as it's ranging beyond the image
-    bgImage, xMin, yMin = cropImage(Image, xC, yC, bgSize, imSize)
+     # -- RGB images are converted to grayscale after cropping
+    bgImage, xMin, yMin = cropGrayImage(Image, xC, yC, bgSize, imSize)
     # --- Determine position of neuron; might not be centered due to cropping
     height, width = bgImage.shape
     xNeuron = xC - xMin
     yNeuron = yC - yMin
     # --- Get number of total pixels in the BG box and determine an intensity
     # --- threshold at which N % of the pixels have less intensity
-    threshold = np.percentile(bgImage, [threshold, (100+threshold)/2.])
+    if estimator is None:
+        threshold = boxThreshold(bgImage, threshold)
+    else:
+        threshold = estimator(Image, bgImage, xMin, yMin, threshold)
     # ------ find two objects in the search area
-    mask = np.where(bgImage > threshold[0], 1, 0)
-    mask = ndimage.binary_opening(mask,structure = np.ones((4,4)))
-    mask = ndimage.binary_closing(mask)
-        # --- Individually label all connected regions and get their center of mass
-    label_im, nb_labels = ndimage.label(mask)
-    centroids = ndimage.measurements.center_of_mass(bgImage, label_im, xrange(1,nb_labels+1))
-    # --- select brightest object by default (mean brightness)
-    meanBrightness = ndimage.measurements.mean(bgImage, label_im, xrange(1,nb_labels+1))
-    print 'Number of objects found', nb_labels
-#    plt.imshow(label_im)
-#    plt.show()
-    if nb_labels > 1:
-        # if at least two are found, use the brightest ones
-        ind = np.argpartition(meanBrightness, -2)[-2:]
-        ind =  ind[np.argsort(meanBrightness[ind])]
-        yNewNeuron1,xNewNeuron1 = centroids[ind[0]]
-        yNewNeuron2,xNewNeuron2 = centroids[ind[1]]
-        neuronObject1 = np.where(label_im == ind[0]+1,0,1)
-        neuronArea1 = np.sum(neuronObject1)
-        neuronObject2 = np.where(label_im == ind[1]+1,0,1)
-        neuronArea2 = np.sum(neuronObject2)
-        vec1 = np.array([prevLocs[0]-prevLocs[2], prevLocs[1]-prevLocs[3]])
-        vec2 = np.array([xNewNeuron2 - xNewNeuron1, yNewNeuron2- yNewNeuron1])
-        # P2-P1 = direction from P1 to P2- vec2 from neuron1 to neuron2
-        
-        # detect neuron identity via angle
-        angle1 = np.arccos(np.clip(np.dot(vec1/np.linalg.norm(vec1), vec2/np.linalg.norm(vec2)),-1,1))
-        angle2 = np.arccos(np.clip(np.dot(vec1/np.linalg.norm(vec1), -vec2/np.linalg.norm(vec2)),-1,1))
-        # switch idenity
-        if angle2 > angle1:
-            tmp = yNewNeuron2,xNewNeuron2
-            yNewNeuron2,xNewNeuron2= yNewNeuron1,xNewNeuron1
-            yNewNeuron1,xNewNeuron1 = tmp
-            tmp = neuronObject2
-            neuronObject2 = neuronObject1
-            neuronObject1 = tmp
-            
-    if nb_labels == 1:
-        # if only one object found, assign same values to both
-        loc = np.argmax(meanBrightness)
-        yNewNeuron1,xNewNeuron1 = centroids[loc]
-        xNewNeuron2,yNewNeuron2 = prevLocs[-2]-xMin, prevLocs[-1]-yMin
-        neuronObject1 = np.where(label_im ==loc+1,0,1)
-        neuronArea1 = np.sum(neuronObject1)
-        neuronObject2 = neuronObject1
-        neuronArea2 = neuronArea1
-        
-    elif nb_labels==0:
-        # if nothing is found, use bg
-        yNewNeuron1,xNewNeuron1 = yNeuron,  xNeuron
-        yNewNeuron2,xNewNeuron2 = yNewNeuron1,xNewNeuron1
-        loc = -1
-        neuronObject1 = np.where(label_im ==loc+1,0,1)
-        neuronArea1 = np.sum(neuronObject1)
-        neuronObject2 = np.where(label_im == loc+1,0,1)
-        neuronArea2 = np.sum(neuronObject2)
+    yNewNeuron1,xNewNeuron1, neuronArea1, neuronObject1, yNewNeuron2,xNewNeuron2, neuronArea2, neuronObject2 = \
+        findTwoNeuronsNear(bgImage, threshold, xNeuron, yNeuron, xMin, yMin, prevLocs, searchSize)
     
         # --- Get average of the 2 neurons fluorescence --- 
-    tmp_neuron = np.ma.masked_array(bgImage, neuronObject1)
-    newNeuronAverage1 = np.ma.average(tmp_neuron[tmp_neuron>threshold[1]])
-    
-    tmp_neuron = np.ma.masked_array(bgImage, neuronObject2)
-    newNeuronAverage2 = np.ma.average(tmp_neuron[tmp_neuron>threshold[1]])
+    newNeuronAverage1 = objectAverage(bgImage, neuronObject1, threshold[1])
+    newNeuronAverage2 = objectAverage(bgImage, neuronObject2, threshold[1])
 
     # --- remove both neuron objetcs from field of view, we assume bg is the same
     
     bgLevel = calculateWith2Masks(bgImage, xNewNeuron1,yNewNeuron1,xNewNeuron2,yNewNeuron2,neuronSize,imSize)
     
     # --- Deal with shift
-    GreenImage, _,_ = cropImage(Image, xC+shift[0], yC+shift[1], bgSize, imSize)
+    GreenImage, _,_ = cropGrayImage(Image, xC+shift[0], yC+shift[1], bgSize, imSize)
     
     neuronObject1 = cropOutOfBoundsRegions(xC, yC, bgSize, neuronObject1, width, height, imSize, shift)
     
@@ -272,16 +452,14 @@ def dualFluorescence2Neurons(Image, bgSize,neuronSize, threshold, xC, yC, shift,
         bgLevel, newNeuronAverage2, xNewNeuron2+xMin, yNewNeuron2+yMin, neuronArea2, \
         1 , 1, xNewNeuron2+xMin+shift[0], yNewNeuron2+yMin+shift[1] ,neuronArea2,
     else:
-        tmpGreenNeuron1 = np.ma.masked_array(GreenImage, neuronObject1)
-        GreenNeuronAverage1 = np.ma.average(tmpGreenNeuron1)
+        GreenNeuronAverage1 = selectedMean(GreenImage, ~neuronObject1)
     
     neuronObject2 = cropOutOfBoundsRegions(xC, yC, bgSize, neuronObject2, width, height, imSize, shift)
     if neuronObject2.shape[0]<1 or neuronObject2.shape[1]<1 or GreenImage.shape != neuronObject2.shape:
         GreenNeuronAverage2 = 1
         GreenbgLevel = 1
     else:
-        tmpGreenNeuron2 = np.ma.masked_array(GreenImage, neuronObject2)
-        GreenNeuronAverage2 = np.ma.average(tmpGreenNeuron2)
+        GreenNeuronAverage2 = selectedMean(GreenImage, ~neuronObject2)
     
         GreenbgLevel = calculateWith2Masks(bgImage, xNewNeuron1,yNewNeuron1,xNewNeuron2,yNewNeuron2,neuronSize,imSize)
     # for each of the 2 neuron there are red and green components
@@ -291,85 +469,29 @@ def dualFluorescence2Neurons(Image, bgSize,neuronSize, threshold, xC, yC, shift,
     GreenbgLevel , GreenNeuronAverage2, xNewNeuron2+xMin+shift[0], yNewNeuron2+yMin+shift[1] ,neuronArea2,\
 
 
-def singleFluorescence2Neurons(Image, bgSize,neuronSize, threshold, xC, yC, shift, prevLocs):
+def singleFluorescence2Neurons(Image, bgSize,neuronSize, threshold, xC, yC, shift, prevLocs, estimator=None, searchSize=None):
     """Calculate fluorescene for the two brightest objects in non-ratiometric images."""
     imSize = Image.shape
-    # deal with RGB images
-    if len(imSize) == 3:
-        Image = rgb2gray(Image)
      # -- Check if box needs to be cropped as it's ranging beyond the image
-    bgImage, xMin, yMin = cropImage(Image, xC, yC, bgSize, imSize)
+     # -- RGB images are converted to grayscale after cropping
+    bgImage, xMin, yMin = cropGrayImage(Image, xC, yC, bgSize, imSize)
     # --- Determine position of neuron; might not be centered due to cropping
     height, width = bgImage.shape
     xNeuron = xC - xMin
     yNeuron = yC - yMin
     # --- Get number of total pixels in the BG box and determine an intensity
     # --- threshold at which N % of the pixels have less intensity
-    threshold = np.percentile(bgImage, [threshold, (100+threshold)/2.])
+    if estimator is None:
+        threshold = boxThreshold(bgImage, threshold)
+    else:
+        threshold = estimator(Image, bgImage, xMin, yMin, threshold)
     # ------ find two objects in the search area
-    mask = np.where(bgImage > threshold[0], 1, 0)
-    mask = ndimage.binary_opening(mask,structure = np.ones((4,4)))
-    mask = ndimage.binary_closing(mask)
-        # --- Individually label all connected regions and get their center of mass
-    label_im, nb_labels = ndimage.label(mask)
-    centroids = ndimage.measurements.center_of_mass(bgImage, label_im, xrange(1,nb_labels+1))
-    # --- select brightest object by default (mean brightness)
-    meanBrightness = ndimage.measurements.mean(bgImage, label_im, xrange(1,nb_labels+1))
-    print 'Number of objects found', nb_labels
-#    plt.imshow(label_im)
-#    plt.show()
-    if nb_labels > 1:
-        # if at least two are found, use the brightest ones
-        ind = np.argpartition(meanBrightness, -2)[-2:]
-        ind =  ind[np.argsort(meanBrightness[ind])]
-        yNewNeuron1,xNewNeuron1 = centroids[ind[0]]
-        yNewNeuron2,xNewNeuron2 = centroids[ind[1]]
-        neuronObject1 = np.where(label_im == ind[0]+1,0,1)
-        neuronArea1 = np.sum(neuronObject1)
-        neuronObject2 = np.where(label_im == ind[1]+1,0,1)
-        neuronArea2 = np.sum(neuronObject2)
-        vec1 = np.array([prevLocs[0]-prevLocs[2], prevLocs[1]-prevLocs[3]])
-        vec2 = np.array([xNewNeuron2 - xNewNeuron1, yNewNeuron2- yNewNeuron1])
-        # P2-P1 = direction from P1 to P2- vec2 from neuron1 to neuron2
-        
-        # detect neuron identity via angle
-        angle1 = np.arccos(np.clip(np.dot(vec1/np.linalg.norm(vec1), vec2/np.linalg.norm(vec2)),-1,1))
-        angle2 = np.arccos(np.clip(np.dot(vec1/np.linalg.norm(vec1), -vec2/np.linalg.norm(vec2)),-1,1))
-        # switch idenity
-        if angle2 > angle1:
-            tmp = yNewNeuron2,xNewNeuron2
-            yNewNeuron2,xNewNeuron2= yNewNeuron1,xNewNeuron1
-            yNewNeuron1,xNewNeuron1 = tmp
-            tmp = neuronObject2
-            neuronObject2 = neuronObject1
-            neuronObject1 = tmp
-            
-    if nb_labels == 1:
-        # if only one object found, assign same values to both
-        loc = np.argmax(meanBrightness)
-        yNewNeuron1,xNewNeuron1 = centroids[loc]
-        xNewNeuron2,yNewNeuron2 = prevLocs[-2]-xMin, prevLocs[-1]-yMin
-        neuronObject1 = np.where(label_im ==loc+1,0,1)
-        neuronArea1 = np.sum(neuronObject1)
-        neuronObject2 = neuronObject1
-        neuronArea2 = neuronArea1
-        
-    elif nb_labels==0:
-        # if nothing is found, use bg
-        yNewNeuron1,xNewNeuron1 = yNeuron,  xNeuron
-        yNewNeuron2,xNewNeuron2 = yNewNeuron1,xNewNeuron1
-        loc = -1
-        neuronObject1 = np.where(label_im ==loc+1,0,1)
-        neuronArea1 = np.sum(neuronObject1)
-        neuronObject2 = np.where(label_im == loc+1,0,1)
-        neuronArea2 = np.sum(neuronObject2)
+    yNewNeuron1,xNewNeuron1, neuronArea1, neuronObject1, yNewNeuron2,xNewNeuron2, neuronArea2, neuronObject2 = \
+        findTwoNeuronsNear(bgImage, threshold, xNeuron, yNeuron, xMin, yMin, prevLocs, searchSize)
     
         # --- Get average of the 2 neurons fluorescence --- 
-    tmp_neuron = np.ma.masked_array(bgImage, neuronObject1)
-    newNeuronAverage1 = np.ma.average(tmp_neuron[tmp_neuron>threshold[1]])
-    
-    tmp_neuron = np.ma.masked_array(bgImage, neuronObject2)
-    newNeuronAverage2 = np.ma.average(tmp_neuron[tmp_neuron>threshold[1]])
+    newNeuronAverage1 = objectAverage(bgImage, neuronObject1, threshold[1])
+    newNeuronAverage2 = objectAverage(bgImage, neuronObject2, threshold[1])
 
     # --- remove both neuron objetcs from field of view, we assume bg is the same
     
@@ -391,3 +513,204 @@ def moving_average(a, n=3) :
     # create padding to center
     bf= int(0.5*(n-1))
     return np.pad(ret[n - 1:] / n, (bf, n-bf-1), mode='constant', constant_values=np.nan)
+
+#=============================================================================#
+#                     Coarse to fine localization
+#=============================================================================#
+def downsample(img, factor):
+    """means of blocks of factor x factor pixels, remaining rows and columns are dropped."""
+    height = img.shape[0]//factor*factor
+    width = img.shape[1]//factor*factor
+    blocks = img[:height, :width].reshape(height//factor, factor, width//factor, factor)
+    return blocks.mean(axis=3).mean(axis=1)
+
+def coarseFactor(neuronSize):
+    """downsampling that keeps an object of the neuron box a few pixels wide."""
+    return 4 if neuronSize >= 8 else 2
+
+@piaProfile.timed('coarse')
+def coarseLocation(Image, xC, yC, wideSize, threshold, neuronSize, maxArea=200):
+    """location of the brightest object within wideSize of xC, yC, found on a 2x or 4x downsampled crop.
+
+    The crop is thresholded, opened and closed like a background box in
+    findNeuron. Objects that cover more blocks than an object of maxArea
+    full resolution pixels can are dropped as by filterLargeBlobs (None
+    keeps all, as findTwoNeurons does), and the object with the highest
+    mean brightness is taken. Returns xC, yC if nothing is found.
+    """
+    factor = coarseFactor(neuronSize)
+    wideImage, xMin, yMin = cropGrayImage(Image, xC, yC, wideSize, Image.shape)
+    coarse = downsample(wideImage, factor)
+    if coarse.size == 0:
+        return xC, yC
+    mask = coarse > np.percentile(coarse, threshold)
+    mask = ndimage.binary_opening(mask,structure = np.ones((2,2)))
+    mask = ndimage.binary_closing(mask)
+    label_im, nb_labels = ndimage.label(mask)
+    if nb_labels == 0:
+        return xC, yC
+    areas, meanBrightness, centroids = labelStatistics(coarse, label_im, nb_labels)
+    if maxArea is not None:
+        # --- an object touches the blocks it overlaps, one more per row and column
+        filterLargeBlobs(label_im, areas, meanBrightness, maxArea=(np.sqrt(maxArea)/factor+1)**2)
+        if not np.any(meanBrightness):
+            # only large blobs
+            return xC, yC
+    yCoarse, xCoarse = centroids[np.argmax(meanBrightness)]
+    # --- center of the block in full resolution pixels
+    return xMin + (xCoarse+0.5)*factor - 0.5, yMin + (yCoarse+0.5)*factor - 0.5
+
+#=============================================================================#
+#                     Batched kernels
+#=============================================================================#
+# The same calculations for a stack of search boxes (boxes x height x width),
+# eg. the boxes of many frames at known locations. Every function gives the
+# values of its single box version, applied to each box.
+
+def boxThresholds(bgImages, threshold, maxBins=2**24):
+    """boxThreshold of every box (boxes x 2)."""
+    n = len(bgImages)
+    bgImages = bgImages.reshape(n, -1)
+    if bgImages.dtype not in (np.uint8, np.uint16) or bgImages.shape[1] == 0:
+        return np.percentile(bgImages, [threshold, (100+threshold)/2.], axis=1).T
+    nPixels = bgImages.shape[1]
+    nBins = int(bgImages.max())+1
+    q = np.true_divide([threshold, (100+threshold)/2.], 100)
+    indices = q*(nPixels-1)
+    below = np.floor(indices).astype(np.intp)
+    above = below + 1
+    above[above > nPixels-1] = nPixels-1
+    weightsAbove = indices - below
+    weightsBelow = 1.0 - weightsAbove
+    thresholds = []
+    # one histogram per box, box k counts into the bins k*nBins..(k+1)*nBins-1
+    step = max(1, maxBins//nBins)
+    for first in xrange(0, n, step):
+        boxes = bgImages[first:first+step]
+        binOffsets = np.arange(len(boxes))[:,None]*nBins
+        counts = np.bincount((boxes + binOffsets).ravel(), minlength=len(boxes)*nBins)
+        # box k starts at k*nPixels of the cumulative counts
+        cumulative = np.cumsum(counts)
+        pixelOffsets = np.arange(len(boxes))[:,None]*nPixels
+        valuesBelow = np.searchsorted(cumulative, (below + pixelOffsets).ravel(), side='right').reshape(-1, 2) - binOffsets
+        valuesAbove = np.searchsorted(cumulative, (above + pixelOffsets).ravel(), side='right').reshape(-1, 2) - binOffsets
+        thresholds.append(valuesBelow*weightsBelow + valuesAbove*weightsAbove)
+    return np.concatenate(thresholds)
+
+def labelBoxes(bgImages, thresholds, opening):
+    """opened, closed and labeled pixels above threshold of every box.
+
+    Labels are numbered through all boxes, box k has the labels
+    offsets[k]+1..offsets[k]+counts[k]. Returns labels, offsets and counts.
+    """
+    # structuring elements that don't connect neighboring boxes
+    cross = ndimage.generate_binary_structure(2, 1)
+    connectivity = np.zeros((3, 3, 3), dtype=bool)
+    connectivity[1] = cross
+    with piaProfile.stage('morphology'):
+        mask = bgImages > thresholds[:,None,None]
+        mask = ndimage.binary_opening(mask, structure = np.ones((1,)+opening))
+        mask = ndimage.binary_closing(mask, structure = cross[None])
+    with piaProfile.stage('labels'):
+        label_im, nb_labels = ndimage.label(mask, structure=connectivity)
+    boxMax = label_im.reshape(len(bgImages), -1).max(axis=1)
+    offsets = np.concatenate([[0], np.maximum.accumulate(boxMax)[:-1]]).astype(np.intp)
+    counts = np.maximum(boxMax - offsets, 0)
+    return label_im, offsets, counts
+
+def boxLabelStatistics(bgImages, label_im, nb_labels):
+    """labelStatistics of a stack of boxes, the centers of mass in box coordinates."""
+    labels = label_im.ravel()
+    yGrid = np.arange(bgImages.shape[1], dtype=float)[None,:,None]
+    xGrid = np.arange(bgImages.shape[2], dtype=float)[None,None,:]
+    areas = np.bincount(labels, minlength=nb_labels+1)
+    sums = np.bincount(labels, weights=bgImages.ravel(), minlength=nb_labels+1)
+    ySums = np.bincount(labels, weights=(bgImages*yGrid).ravel(), minlength=nb_labels+1)
+    xSums = np.bincount(labels, weights=(bgImages*xGrid).ravel(), minlength=nb_labels+1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        meanBrightness = sums[1:]/areas[1:].astype(float)
+        yCentroids = ySums[1:]/sums[1:]
+        xCentroids = xSums[1:]/sums[1:]
+    return areas, meanBrightness, yCentroids, xCentroids
+
+def objectAverages(bgImages, neuronObjects, thresholds):
+    """objectAverage of every box, thresholds as from boxThresholds."""
+    n = len(bgImages)
+    if bgImages.dtype.kind not in 'ui':
+        return np.array([objectAverage(bgImages[k], neuronObjects[k], thresholds[k,1]) for k in xrange(n)])
+    # integer sums are exact, so the summation order doesn't matter
+    select = (bgImages > thresholds[:,1,None,None]) & ~neuronObjects
+    counts = select.reshape(n, -1).sum(axis=1)
+    sums = np.where(select, bgImages, 0).reshape(n, -1).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums*1./np.maximum(counts, 1), np.nan)
+
+def findNeurons(bgImages, thresholds, xNeurons, yNeurons):
+    """findNeuron for every box, thresholds as from boxThresholds.
+
+    Returns arrays of the new y and x locations, the object averages and
+    areas, and the object masks (True outside the object).
+    """
+    n = len(bgImages)
+    label_im, offsets, counts = labelBoxes(bgImages, thresholds[:,0], (2, 2))
+    nb_labels = int(counts.sum())
+    with piaProfile.stage('labels'):
+        areas, meanBrightness, yCentroids, xCentroids = boxLabelStatistics(bgImages, label_im, nb_labels)
+        boxOf = np.repeat(np.arange(n), counts)
+        # large blobs are rare, they are removed box by box
+        for k in np.unique(boxOf[np.flatnonzero(areas[1:] > 200)]):
+            first, last = offsets[k], offsets[k]+counts[k]
+            boxLabels = np.where(label_im[k] > 0, label_im[k] - first, 0)
+            filterLargeBlobs(boxLabels, np.concatenate([[0], areas[first+1:last+1]]), meanBrightness[first:last])
+            label_im[k][boxLabels == 0] = 0
+    # the brightest object of every box, the first of equally bright ones as np.argmax
+    order = np.lexsort((np.arange(nb_labels), -meanBrightness, boxOf))
+    found = counts > 0
+    loc = order[(np.cumsum(counts) - counts)[found]]
+    yNewNeurons = np.array(yNeurons, dtype=float)
+    xNewNeurons = np.array(xNeurons, dtype=float)
+    yNewNeurons[found] = yCentroids[loc]
+    xNewNeurons[found] = xCentroids[loc]
+    objects = np.zeros(n, dtype=label_im.dtype)
+    objects[found] = loc+1
+    # --- masks are True outside of the object
+    neuronObjects = label_im != objects[:,None,None]
+    neuronAreas = neuronObjects.reshape(n, -1).sum(axis=1)
+    newNeuronAverages = objectAverages(bgImages, neuronObjects, thresholds)
+    return yNewNeurons, xNewNeurons, newNeuronAverages, neuronAreas, neuronObjects
+
+def calculateWithMasks(bgImages, xNewNeurons, yNewNeurons, neuronSize, imSize):
+    """calculateWithMask for every box."""
+    n, height, width = bgImages.shape
+    if bgImages.dtype.kind not in 'ui':
+        return np.array([calculateWithMask(bgImages[k], xNewNeurons[k], yNewNeurons[k], neuronSize, imSize) for k in xrange(n)])
+    def bounds(center, limit, size):
+        # --- same bounds as the slices of calculateWithMask
+        low = np.maximum(0, center-neuronSize).astype(int)
+        high = np.minimum(limit, center+neuronSize).astype(int)
+        low = np.minimum(low, size)
+        high = np.where(high < 0, np.maximum(high+size, 0), np.minimum(high, size))
+        return low, np.maximum(low, high)
+    yMin, yMax = bounds(np.asarray(yNewNeurons, dtype=float), imSize[0], height)
+    xMin, xMax = bounds(np.asarray(xNewNeurons, dtype=float), imSize[1], width)
+    rows = np.arange(height)[None,:]
+    columns = np.arange(width)[None,:]
+    inside = ((rows >= yMin[:,None]) & (rows < yMax[:,None]))[:,:,None] \
+           & ((columns >= xMin[:,None]) & (columns < xMax[:,None]))[:,None,:]
+    count = height*width - (yMax-yMin)*(xMax-xMin)
+    # integer sums are exact, the same as the sum over the frame
+    bgSums = np.where(inside, 0, bgImages).reshape(n, -1).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, bgSums*1./np.maximum(count, 1), np.nan)
+
+def fluorescenceBoxes(bgImages, neuronSize, threshold, xNeurons, yNeurons, imSize):
+    """fluorescence of a stack of search boxes, as calculated for the box of each frame.
+
+    xNeurons, yNeurons are the search locations in box coordinates. Returns
+    arrays of the background levels, object averages, new x and y locations
+    (in box coordinates) and areas.
+    """
+    thresholds = boxThresholds(bgImages, threshold)
+    yNewNeurons, xNewNeurons, newNeuronAverages, neuronAreas, _ = findNeurons(bgImages, thresholds, xNeurons, yNeurons)
+    bgLevels = calculateWithMasks(bgImages, xNewNeurons, yNewNeurons, neuronSize, imSize)
+    return bgLevels, newNeuronAverages, xNewNeurons, yNewNeurons, neuronAreas
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timing for PIA.
+Times the stages of the tracking loop (frame decoding, cropping, thresholds,
+object detection, background levels, drawing) while enabled, eg.
+    piaProfile.enable()
+    ... track ...
+    print piaProfile.report()
+    piaProfile.dump('profile.json')
+Functions are timed with the timed decorator and blocks of code with
+    with piaProfile.stage('draw traces'): ...
+Disabled (the default), both only check a flag. Stages may be nested, the
+time of a stage includes the stages running within it.
+"""
+import time
+import json
+import os
+import functools
+import threading
+from collections import deque
+
+# number of recent calls of a stage the rolling statistics are taken over
+WINDOW = 100
+
+enabled = False
+stages = {}
+lock = threading.Lock()
+running = threading.local()
+
+
+class StageStats():
+    """call count, total and rolling times of one stage."""
+    def __init__(self, name, window=WINDOW):
+        self.name = name
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.recent = deque(maxlen=window)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.recent.append(duration)
+
+    def summary(self):
+        """statistics in ms."""
+        recent = list(self.recent)
+        return {'stage': self.name, 'count': self.count, 'totalMs': 1e3*self.total,
+                'meanMs': 1e3*self.total/max(self.count, 1), 'maxMs': 1e3*self.max,
+                'recentMeanMs': 1e3*sum(recent)/max(len(recent), 1), 'recentMaxMs': 1e3*max(recent or [0])}
+
+
+def enable(on=True):
+    global enabled
+    enabled = bool(on)
+
+def reset():
+    with lock:
+        stages.clear()
+
+def record(name, duration):
+    with lock:
+        if name not in stages:
+            stages[name] = StageStats(name)
+        stages[name].add(duration)
+
+class StageTimer():
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        active = getattr(running, 'stages', None)
+        if active is None:
+            active = running.stages = set()
+        # a stage running within itself (eg. a recursive fallback) is timed once
+        if self.name not in active:
+            active.add(self.name)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            record(self.name, time.time()-self.start)
+            running.stages.discard(self.name)
+        return False
+
+class NoTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NOTIMER = NoTimer()
+
+def stage(name):
+    """context manager timing a block of code as stage name."""
+    if not enabled:
+        return NOTIMER
+    return StageTimer(name)
+
+def timed(name):
+    """decorator timing every call of a function as stage name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def timedFunction(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with StageTimer(name):
+                return function(*args, **kwargs)
+        return timedFunction
+    return decorate
+
+def summary():
+    """statistics of all stages, the most expensive first."""
+    with lock:
+        result = [s.summary() for s in stages.values()]
+    return sorted(result, key=lambda s: -s['totalMs'])
+
+def report(recent=True):
+    """one line of per call times in ms, of the recent calls or of all."""
+    key = 'recentMeanMs' if recent else 'meanMs'
+    return '  '.join('{}: {:.1f}'.format(s['stage'], s[key]) for s in summary())
+
+def profileName(imageFolder):
+    """timing file of a recording, next to its image folder (or tif file)."""
+    return os.path.normpath(imageFolder)+'_pia_profile.json'
+
+def dump(fname, info=None):
+    """write the statistics and the parameters of the run (info) as json."""
+    with open(fname, 'w') as f:
+        json.dump({'info': info, 'window': WINDOW, 'stages': summary()}, f, indent=1)
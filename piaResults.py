@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Result files for PIA.
+A .pia file is an uncompressed numpy zip archive with one float32 array per
+named data column and the tracking parameters (mode, shift, box sizes,
+threshold, image folder) as json. The columns of the tracking mode and any
+other column holding data are stored, the placeholder ones of the text format
+are not. Columns are memory mapped from the archive, so reading a few columns
+or frames does not load the rest of the file.
+Text files stay the import/export format. They are parsed in chunks, the
+field count of every line is checked before the fast parser is used, and
+chunks it cannot parse are read line by line to name the bad line. Convert between both
+formats with eg.
+    python piaResults.py result.txt result.pia --mode '2 Neurons'
+    python piaResults.py result.pia result.txt
+"""
+import os
+import json
+import zipfile
+import argparse
+import numpy as np
+import piaTrack
+
+EXTENSION = '.pia'
+# Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2 BG3 F3 X3 Y3 A3 BG4 F4 X4 Y4 A4
+COLUMNS = piaTrack.HEADER[1:].split()
+# objects (groups of BG,F,X,Y,A columns) each mode writes
+MODE_OBJECTS = {'Single Neuron': [2],
+                'Single Neuron (Ratio)': [1, 2],
+                '2 Neurons': [2, 4],
+                '2 Neurons (Ratio)': [1, 2, 3, 4]}
+
+
+def isBinary(fname):
+    return os.path.splitext(fname)[1] == EXTENSION
+
+def modeColumns(mode):
+    """names of the data columns a tracking mode uses."""
+    return ['Frame'] + [name+str(obj) for obj in MODE_OBJECTS[mode] for name in ('BG', 'F', 'X', 'Y', 'A')]
+
+def guessMode(data):
+    """smallest mode whose columns hold all non-placeholder values of a data set."""
+    used = [name for name, column in zip(COLUMNS, data) if np.any(column != 1)]
+    for mode in piaTrack.MODES:
+        if set(used) <= set(modeColumns(mode)):
+            return mode
+    return piaTrack.MODES[-1]
+
+def storedColumns(data, mode):
+    """names of the columns of a mode and of all other columns holding non-placeholder values."""
+    return [name for name, column in zip(COLUMNS, data) if name in modeColumns(mode) or np.any(column != 1)]
+
+def writeResults(fname, data, info):
+    """write a data set (NCOLS x frames) as binary result file. info needs at least the mode."""
+    arrays = dict((name, data[COLUMNS.index(name)].astype(np.float32)) for name in storedColumns(data, info['mode']))
+    arrays['info'] = np.array(json.dumps(info))
+    # write next to the target and rename, an old file is never left half written
+    tmpName = fname+'.tmp'
+    with open(tmpName, 'wb') as f:
+        np.savez(f, **arrays)
+    if os.path.isfile(fname):
+        os.remove(fname)
+    os.rename(tmpName, fname)
+
+def readInfo(fname):
+    """tracking parameters of a binary result file."""
+    with np.load(fname) as archive:
+        return json.loads(archive['info'][()])
+
+def mapColumn(fname, archive, name):
+    """read-only memory map of a column stored in an open result archive.
+
+    np.savez stores its arrays uncompressed, so the .npy data of a column is
+    a contiguous part of the file after the zip and .npy headers.
+    """
+    member = archive.getinfo(name+'.npy')
+    if member.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('Column {} is compressed.'.format(name))
+    with open(fname, 'rb') as f:
+        # --- local zip header: 30 bytes, then the file name and extra field
+        f.seek(member.header_offset+26)
+        nameLength, extraLength = np.frombuffer(f.read(4), dtype='<u2')
+        f.seek(member.header_offset+30+nameLength+extraLength)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if len(shape) == 0 or shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortranOrder else 'C')
+
+def readResults(fname, columns=None, start=0, stop=None):
+    """data set (NCOLS x frames) and parameters from a binary result file.
+
+    Only the given columns (all stored ones if None) of the frames
+    start..stop-1 are read from disk, the others are placeholder ones.
+    """
+    archive = zipfile.ZipFile(fname)
+    try:
+        info = readInfo(fname)
+        stored = [os.path.splitext(name)[0] for name in archive.namelist()]
+        frames = np.array(mapColumn(fname, archive, 'Frame')[start:stop])
+        data = np.ones((piaTrack.NCOLS, len(frames)))
+        data[0] = frames
+        if columns is None:
+            columns = stored
+        for name in columns:
+            if name in COLUMNS and name in stored:
+                data[COLUMNS.index(name)] = mapColumn(fname, archive, name)[start:stop]
+    finally:
+        archive.close()
+    return data, info
+
+#=============================================================================#
+#                     Text files
+#=============================================================================#
+def fieldCounts(body):
+    """number of whitespace separated fields on each line of a text."""
+    chars = np.frombuffer(body, dtype=np.uint8)
+    # --- space and control characters separate fields
+    space = chars <= ord(' ')
+    # --- a field starts at a non-space character after a space or the start
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    newlines = np.flatnonzero(chars == ord('\n'))
+    nLines = len(newlines) + (1 if len(chars) and chars[-1] != ord('\n') else 0)
+    return np.bincount(np.searchsorted(newlines, starts), minlength=nLines)
+
+def parseRows(text, ncols, firstLine):
+    """rows (rows x ncols) of complete lines of a text file. Raises ValueError naming the first bad line."""
+    body = text
+    if '#' in text:
+        # headers, only found in the first chunk
+        body = ''.join(line for line in text.splitlines(True) if not line.lstrip().startswith('#'))
+    counts = fieldCounts(body)
+    # --- the fast parser only sees numbers, so every line has to hold a full row
+    if np.all(counts == ncols):
+        values = np.fromstring(body, sep=' ')
+        if values.size == len(counts)*ncols:
+            return values.reshape(len(counts), ncols)
+    # blank or broken lines: parse line by line to find the problem
+    rows = []
+    for k, line in enumerate(text.splitlines()):
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+        try:
+            row = [float(v) for v in line.split()]
+        except ValueError:
+            raise ValueError('Line {:d} is not a row of numbers.'.format(firstLine+k))
+        if len(row) != ncols:
+            raise ValueError('Line {:d} has {:d} columns instead of {:d}.'.format(firstLine+k, len(row), ncols))
+        rows.append(row)
+    return np.array(rows, dtype=float).reshape(-1, ncols)
+
+def iterTextRows(fname, ncols=piaTrack.NCOLS, chunkSize=2**20):
+    """parse a text data file in chunks of about chunkSize bytes. Yields arrays of rows (rows x ncols).
+
+    Comment lines, ie. the headers written by 'Write to new file' and
+    'Overwrite data' are skipped.
+    """
+    firstLine = 1
+    rest = ''
+    with open(fname, 'r') as f:
+        while True:
+            chunk = f.read(chunkSize)
+            text = rest+chunk
+            if chunk:
+                # keep an incomplete last line for the next chunk
+                cut = text.rfind('\n')+1
+                text, rest = text[:cut], text[cut:]
+            if text:
+                yield parseRows(text, ncols, firstLine)
+                firstLine += text.count('\n')
+            if not chunk:
+                return
+
+def readText(fname, ncols=piaTrack.NCOLS):
+    """data set (ncols x frames) from a text data file."""
+    blocks = list(iterTextRows(fname, ncols))
+    if sum(len(block) for block in blocks) == 0:
+        raise ValueError('File contains no data.')
+    return np.concatenate(blocks).T
+
+def loadData(fname):
+    """data set and parameters (empty for text files) from a text or binary result file."""
+    if isBinary(fname):
+        return readResults(fname)
+    return readText(fname), {}
+
+def saveData(fname, data, info):
+    """write a data set in the format given by the file extension."""
+    if isBinary(fname):
+        writeResults(fname, data, info)
+    else:
+        piaTrack.writeData(fname, data)
+
+def convert(source, target, mode=None):
+    """convert a result file between text and binary format."""
+    data, info = loadData(source)
+    if mode is not None:
+        info['mode'] = mode
+    elif 'mode' not in info:
+        info['mode'] = guessMode(data)
+    saveData(target, data, info)
+    return info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert PIA result files between text and binary (.pia) format.')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--mode', default=None, choices=piaTrack.MODES, help='tracking mode of a text file (guessed from the data if not given)')
+    args = parser.parse_args()
+    info = convert(args.source, args.target, args.mode)
+    print 'wrote', args.target, '({})'.format(info['mode'])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Dual color shift estimation for PIA.
+Estimates the shift between the two halves of a split (dual color) view, ie.
+the offset dualX, dualY of the green channel to the tracked one, by phase
+correlation of a few frames sampled across the recording, eg.
+    python piaShift.py /path/to/images --type tif
+The estimate of a recording is cached next to its image folder
+(*imageFolder*_pia_shift.json) and only calculated again with --force, or
+when the guess splits the view along another axis or swaps the halves.
+"""
+import os
+import json
+import argparse
+import threading
+import traceback
+import numpy as np
+import piaImage
+import piaFrames
+
+# frames sampled evenly across the recording
+SAMPLES = 5
+# a clear correlation peak is this many standard deviations above the rest
+MIN_SHARPNESS = 15.
+
+
+def shiftName(imageFolder):
+    """shift estimate of a recording, next to its image folder (or tif file)."""
+    return os.path.normpath(imageFolder)+'_pia_shift.json'
+
+def sampleIndices(nFrames, nSamples=SAMPLES):
+    """frames spread evenly across a recording."""
+    return sorted(set(np.linspace(0, nFrames-1, nSamples).astype(int)))
+
+def splitAxis(guess):
+    """image axis the view is split along, the one of the larger component of a shift (x, y)."""
+    return 0 if abs(guess[1]) >= abs(guess[0]) else 1
+
+def splitHalves(img, guess):
+    """green and red half of a split view image.
+
+    The green half lies in the direction of the guessed shift (x, y) from
+    the red one.
+    """
+    if img.ndim == 3:
+        img = piaImage.rgb2gray(img)
+    img = img.astype(float)
+    axis = splitAxis(guess)
+    half = img.shape[axis]//2
+    first = np.take(img, np.arange(half), axis=axis)
+    second = np.take(img, np.arange(half, 2*half), axis=axis)
+    if guess[1-axis] < 0:
+        return first, second
+    return second, first
+
+def crossPower(green, red):
+    """cross power spectrum of two images normalized to unit magnitude, a Hann window hides their edges."""
+    window = np.outer(np.hanning(green.shape[0]), np.hanning(green.shape[1]))
+    spectrum = np.fft.rfft2((green-green.mean())*window)*np.conj(np.fft.rfft2((red-red.mean())*window))
+    return spectrum/np.maximum(np.abs(spectrum), 1e-12)
+
+def estimateShift(images, guess=(-10, -510)):
+    """shift (x, y) of the green to the red channel of split view images and the sharpness of the estimate.
+
+    The phase correlation of the halves of all images is averaged, its peak
+    is the shift between the halves. guess only decides along which axis the
+    view is split and which half is green. The sharpness is the height of
+    the peak in standard deviations of the correlation.
+    """
+    total = 0
+    for img in images:
+        green, red = splitHalves(img, guess)
+        total = total + crossPower(green, red)
+    correlation = np.fft.irfft2(total, s=green.shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    # --- peaks past the middle are negative shifts
+    dy, dx = [p - n if p > n//2 else p for p, n in zip(peak, correlation.shape)]
+    axis = splitAxis(guess)
+    half = green.shape[axis]
+    # --- the halves are offset by half of the image along the split
+    if axis == 0:
+        shift = (dx, dy - half if guess[1] < 0 else dy + half)
+    else:
+        shift = (dx - half if guess[0] < 0 else dx + half, dy)
+    sharpness = (correlation.max() - correlation.mean())/correlation.std()
+    return (int(shift[0]), int(shift[1])), float(sharpness)
+
+def isClear(estimate):
+    """whether the correlation peak of an estimate stands out clearly."""
+    return estimate['sharpness'] >= MIN_SHARPNESS
+
+def splitLayout(guess):
+    """split axis and whether the green half comes first, the only parts of a guess splitHalves uses."""
+    axis = splitAxis(guess)
+    return axis, guess[1-axis] < 0
+
+def cachedShift(imageFolder, guess=(-10, -510)):
+    """shift estimate of a recording from its cache file, None if there is none for the split view of guess."""
+    fname = shiftName(imageFolder)
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            estimate = json.load(f)
+    except ValueError:
+        # a damaged cache file is calculated again
+        return None
+    # --- an estimate for another split axis or green half is calculated again
+    if 'guess' not in estimate or splitLayout(estimate['guess']) != splitLayout(guess):
+        return None
+    return estimate
+
+def recordingShift(frames, imageFolder, guess=(-10, -510), nSamples=SAMPLES, force=False):
+    """shift estimate of a recording, read from its cache file unless force or the guess splits the view differently.
+
+    Returns a dict with the shift, the sharpness and the frames it was
+    estimated from.
+    """
+    fname = shiftName(imageFolder)
+    if not force:
+        estimate = cachedShift(imageFolder, guess)
+        if estimate is not None:
+            return estimate
+    indices = sampleIndices(len(frames), nSamples)
+    shift, sharpness = estimateShift([frames[i] for i in indices], guess)
+    estimate = {'shift': list(shift), 'sharpness': sharpness, 'frames': indices, 'guess': list(guess)}
+    try:
+        with open(fname, 'w') as f:
+            json.dump(estimate, f)
+    except IOError:
+        print 'could not cache the shift estimate in', fname
+    return estimate
+
+class ShiftEstimator(threading.Thread):
+    """runs recordingShift on a worker thread. An exception ends the estimation and is kept in error."""
+    def __init__(self, frames, imageFolder, guess=(-10, -510), force=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.frames = frames
+        self.imageFolder = imageFolder
+        self.guess = guess
+        self.force = force
+        self.estimate = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.estimate = recordingShift(self.frames, self.imageFolder, self.guess, force=self.force)
+        except Exception:
+            self.error = traceback.format_exc()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Estimate the dual color shift of a split view recording.')
+    parser.add_argument('imageFolder', help='folder with images ending in a _NNNN timestamp')
+    parser.add_argument('--type', default='tif', help='image data type (tif, png, jpg)')
+    parser.add_argument('--guess', type=int, nargs=2, default=[-10, -510], metavar=('X', 'Y'),
+                        help='rough shift, sets the split axis and the green half')
+    parser.add_argument('--samples', type=int, default=SAMPLES, help='number of frames to use')
+    parser.add_argument('--force', action='store_true', help='ignore a cached estimate')
+    args = parser.parse_args(args)
+    frames = piaFrames.openFrames(args.imageFolder, args.type)
+    if frames is None:
+        raise SystemExit('No images found in folder!')
+    try:
+        estimate = recordingShift(frames, args.imageFolder, args.guess, args.samples, args.force)
+    finally:
+        frames.close()
+    print 'dual color shift {} {} (sharpness {:.1f}{})'.format(estimate['shift'][0], estimate['shift'][1],
+                                                          estimate['sharpness'], '' if isClear(estimate) else ', unclear')
+    return estimate
+
+
+if __name__ == "__main__":
+    main()
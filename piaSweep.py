@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps for PIA.
+Tracks one recording with every combination of signal thresholds and box
+sizes in a single pass over the images, eg.
+    python piaSweep.py /path/to/images -x 250 -y 300 --threshold 90 95 98 --bg 150 200 --neuron 30 50 --out sweep/
+Each frame is decoded once and tracked with all combinations, each following
+its own trajectory. The result of every combination is written like a piaTrack
+output, the summary (pia_sweep_summary.json) compares the combinations by
+    lost    frames in which no object was found
+    jumps   frames in which an object moved further than half the neuron box
+    jitter  rms change of the frame to frame motion of the objects [px]
+    signal  mean F/BG of the objects
+"""
+import os
+import time
+import json
+import argparse
+import itertools
+import numpy as np
+import piaImage
+import piaFrames
+import piaTrack
+import piaResults
+
+
+def parameterGrid(thresholds, boxBGs, boxNeurons):
+    """all combinations of the parameters as dicts of signalThreshold, boxBG and boxNeuron."""
+    return [{'signalThreshold': threshold, 'boxBG': boxBG, 'boxNeuron': boxNeuron}
+            for threshold, boxBG, boxNeuron in itertools.product(thresholds, boxBGs, boxNeurons)]
+
+def sweep(frames, mode, seed, shift, combinations, start=0, end=None):
+    """track the frames start..end-1 with every combination. Returns one data set per combination.
+
+    Gives the same data sets as a piaTrack.track run per combination.
+    """
+    if end is None:
+        end = len(frames)
+    sizes = [(int(np.round(c['boxBG']/2.0)), int(np.round(c['boxNeuron']/2.0))) for c in combinations]
+    results = [piaTrack.emptyData(len(frames)) for c in combinations]
+    # all combinations search boxes of the same frame near the same location,
+    # so the threshold histogram is mostly updated instead of recomputed
+    estimator = piaImage.IncrementalThreshold()
+    motions = [piaTrack.MotionModel(mode) for c in combinations]
+    for index in xrange(start, end):
+        img = frames[index]
+        for c, (bgSize, neuronSize), data, motion in zip(combinations, sizes, results, motions):
+            xC, yC, prevLocs = motion.searchLocation(data, index, seed if index == start else None)
+            data[1:, index] = piaTrack.trackFrame(img, mode, bgSize, neuronSize, c['signalThreshold'], xC, yC, shift,
+                                                  prevLocs, estimator)
+            motion.observe(data, index)
+    return results
+
+def trackStatistics(data, mode, boxNeuron, start=0, end=None):
+    """lost frames, jumps, position jitter and mean signal of a tracked data set."""
+    xCol, yCol = piaTrack.positionColumns(mode)
+    nObjects = 2 if mode.startswith('2 Neurons') else 1
+    nFrames = data[0, start:end].size
+    lost = np.zeros(nFrames, dtype=bool)
+    jumps = np.zeros(nFrames, dtype=bool)
+    jitter, signal = [], []
+    for k in xrange(nObjects):
+        # BG, F, X, Y of the tracked channel of object k
+        bg, f, x, y = data[xCol-2+10*k:yCol+1+10*k, start:end]
+        positions = np.column_stack([x, y])
+        # nothing above the threshold, the fluorescence is not defined
+        lost |= np.isnan(f)
+        steps = np.sqrt((np.diff(positions, axis=0)**2).sum(axis=1))
+        jumps[1:] |= steps > boxNeuron/2.0
+        changes = np.diff(positions, 2, axis=0)
+        jitter.append(np.sqrt(np.mean((changes**2).sum(axis=1))) if len(changes) > 0 else 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = f/bg
+        valid = np.isfinite(ratio)
+        signal.append(ratio[valid].mean() if valid.any() else np.nan)
+    return {'lost': int(lost.sum()), 'jumps': int(jumps.sum()),
+            'jitter': float(np.mean(jitter)), 'signal': float(np.mean(signal))}
+
+def outputName(combination, outFolder, extension='.txt'):
+    name = 'sweep_th{signalThreshold}_bg{boxBG}_n{boxNeuron}'.format(**combination)
+    return os.path.join(outFolder, name+extension)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Track a recording with a grid of parameters in one pass.')
+    parser.add_argument('imageFolder', help='folder with images ending in a _NNNN timestamp')
+    parser.add_argument('-x', type=float, required=True, help='x location of the object in the first frame')
+    parser.add_argument('-y', type=float, required=True, help='y location of the object in the first frame')
+    parser.add_argument('--mode', default='Single Neuron', choices=piaTrack.MODES)
+    parser.add_argument('--type', default='tif', help='image data type (tif, png, jpg)')
+    parser.add_argument('--shift', type=int, nargs=2, default=[-10, -510], metavar=('X', 'Y'), help='dual color shift')
+    parser.add_argument('--threshold', type=int, nargs='+', default=[95], help='signal thresholds [%%]')
+    parser.add_argument('--bg', type=int, nargs='+', default=[200], help='background box sizes')
+    parser.add_argument('--neuron', type=int, nargs='+', default=[50], help='neuron box sizes')
+    parser.add_argument('--start', type=int, default=0, help='first frame to track')
+    parser.add_argument('--end', type=int, default=None, help='stop before this frame')
+    parser.add_argument('--out', default='.', help='folder for the results and the summary')
+    parser.add_argument('--format', default='txt', choices=['txt', 'pia'], help='format of the result files')
+    args = parser.parse_args(args)
+    frames = piaFrames.openFrames(args.imageFolder, args.type)
+    if frames is None:
+        raise SystemExit('No images found in folder!')
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    combinations = parameterGrid(args.threshold, args.bg, args.neuron)
+    t0 = time.time()
+    try:
+        results = sweep(frames, args.mode, (args.x, args.y), args.shift, combinations, args.start, args.end)
+    finally:
+        frames.close()
+    duration = time.time() - t0
+    for c, data in zip(combinations, results):
+        c.update(trackStatistics(data, args.mode, c['boxNeuron'], args.start, args.end))
+        c['outFile'] = outputName(c, args.out, '.'+args.format)
+        piaResults.saveData(c['outFile'], data, piaTrack.runInfo(args.mode, c['boxBG'], c['boxNeuron'],
+                            c['signalThreshold'], args.shift, args.imageFolder))
+    # fewest problems first
+    combinations.sort(key=lambda c: (c['lost'], c['jumps'], c['jitter']))
+    nFrames = max((args.end or len(frames)) - args.start, 0)
+    summary = {'imageFolder': args.imageFolder, 'mode': args.mode, 'shift': args.shift,
+               'frames': nFrames, 'seconds': duration, 'combinations': combinations}
+    with open(os.path.join(args.out, 'pia_sweep_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    print '{:>9s} {:>5s} {:>6s} {:>5s} {:>5s} {:>7s} {:>7s}'.format('threshold', 'bg', 'neuron', 'lost', 'jumps', 'jitter', 'signal')
+    for c in combinations:
+        print '{signalThreshold:9d} {boxBG:5d} {boxNeuron:6d} {lost:5d} {jumps:5d} {jitter:7.2f} {signal:7.2f}'.format(**c)
+    print 'tracked {:d} frames with {:d} combinations in {:.1f} s'.format(nFrames, len(combinations), duration)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
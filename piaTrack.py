@@ -0,0 +1,768 @@
+# -*- coding: utf-8 -*-
+"""
+Headless tracking engine for PIA.
+Runs the piaImage trackers over an image folder without the Tk window, eg.
+    python piaTrack.py /path/to/images result.txt -x 250 -y 300 --mode '2 Neurons'
+The output is the same 21 column file that PIA writes with 'Write to new file',
+or a binary piaResults file if outFile ends in .pia.
+The GUI runs the same loop on a worker thread (TrackingThread).
+With --checkpoint every tracked frame is also journaled as it is produced and
+an interrupted run continues from the last checkpointed frame with --resume.
+--profile FILE writes the time spent in each stage of the tracker (piaProfile).
+--adaptive searches in a box that shrinks while the object is found cleanly.
+--wide SIZE first locates the object on a downsampled crop of a wider box.
+--auto-shift estimates the dual color shift from the images (piaShift).
+--requantify DATAFILE measures the frames of a tracked data file again at
+their tracked locations, eg. with another threshold, instead of tracking.
+"""
+import os
+import time
+import json
+import argparse
+import threading
+import traceback
+import Queue
+from collections import OrderedDict
+import numpy as np
+# load image analysis module
+import piaImage
+import piaFrames
+import piaProfile
+import piaShift
+
+#=============================================================================#
+#                     Tracking modes and data layout
+#=============================================================================#
+MODES = ['Single Neuron', 'Single Neuron (Ratio)', '2 Neurons', '2 Neurons (Ratio)']
+NCOLS = 21
+HEADER = '#Frame BG1 F1 X1 Y1 A1 BG2 F2 X2 Y2 A2 BG3 F3 X3 Y3 A3 BG4 F4 X4 Y4 A4'
+
+
+def isRatio(mode):
+    """true for the dual color (ratiometric) modes."""
+    return mode == 'Single Neuron (Ratio)' or mode == '2 Neurons (Ratio)'
+
+def positionColumns(mode):
+    """data rows that hold the tracked x,y location of the first object."""
+    if isRatio(mode):
+        return 3, 4
+    return 8, 9
+
+def maxObjectArea(mode):
+    """largest object the tracker of a mode accepts [px], None if it takes objects of any size."""
+    if mode.startswith('2 Neurons'):
+        return None
+    return 200
+
+def emptyData(numOfImages):
+    """dummy data set: frame numbers and ones everywhere else."""
+    data = np.ones((NCOLS, numOfImages))
+    data[0] = np.arange(numOfImages)
+    return data
+
+def writeData(fname, data):
+    """write a data set (NCOLS x frames) as PIA text file."""
+    np.savetxt(fname, data.T, fmt ='%f',  delimiter=' ', newline='\n', header=HEADER)
+
+#=============================================================================#
+#                     Checkpointing
+#=============================================================================#
+def checkpointName(imageFolder):
+    """journal of a recording, next to its image folder (or tif file)."""
+    return os.path.normpath(imageFolder)+'_pia_checkpoint.txt'
+
+def archiveCheckpoint(fname):
+    """move a journal aside under a timestamped name instead of overwriting it. Returns the new name."""
+    root, ext = os.path.splitext(fname)
+    archived = root+time.strftime('_%Y%m%d-%H%M%S')+ext
+    os.rename(fname, archived)
+    return archived
+
+def runInfo(mode, boxBG, boxNeuron, signalThreshold, shift, imageFolder=None, adaptive=False, boxWide=None):
+    """tracking parameters stored with a journal or a binary result file."""
+    return {'mode': mode, 'boxBG': boxBG, 'boxNeuron': boxNeuron, 'signalThreshold': signalThreshold,
+            'shift': list(shift), 'imageFolder': imageFolder, 'adaptive': bool(adaptive), 'boxWide': boxWide}
+
+class ResultWriter():
+    """append-only journal of tracked frames.
+
+    Each frame is one row of the PIA data file format. Rows are buffered and
+    flushed to disk in batches, a crash loses at most the last batch.
+    A journal is replayed into a data set with readCheckpoint. Once its
+    frames are saved in a result file, clear starts it over.
+    """
+    def __init__(self, fname, batchSize=50, append=True):
+        self.fname = fname
+        self.batchSize = batchSize
+        self.append = append
+        self.f = None
+        self.buffer = []
+        self.pending = 0
+
+    def open(self):
+        if self.append and os.path.isfile(self.fname):
+            self.f = open(self.fname, 'a+')
+            self.f.seek(0, os.SEEK_END)
+            if self.f.tell() > 0:
+                # an interrupted write leaves an incomplete last row, cut it off
+                size = self.f.tell()
+                self.f.seek(max(0, size-4096))
+                tail = self.f.read()
+                if not tail.endswith('\n'):
+                    self.f.truncate(size-len(tail)+tail.rfind('\n')+1)
+                    self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(self.fname, 'w')
+            self.f.write('# '+HEADER+'\n')
+
+    def writeInfo(self, info):
+        """record the parameters of the following rows."""
+        self.buffer.append('#'+json.dumps(info))
+
+    def write(self, index, values):
+        """add the 20 values of frame index."""
+        self.buffer.append(' '.join(['%f' % index] + ['%f' % v for v in values]))
+        self.pending += 1
+        if self.pending >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        if self.f is None:
+            self.open()
+        self.f.write('\n'.join(self.buffer)+'\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.buffer = []
+        self.pending = 0
+
+    def clear(self, info=None):
+        """start the journal over with only a parameter record, eg. after its frames have been saved."""
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        self.buffer = []
+        self.pending = 0
+        self.append = False
+        self.open()
+        if info is not None:
+            self.writeInfo(info)
+        self.flush()
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def readCheckpoint(fname, data):
+    """replay a journal into data. Returns the last tracked frame (None if empty) and the latest parameters.
+
+    Parameter records update the earlier ones, so eg. savedTo, the result
+    file the journal was cleared after, is kept by later records.
+    """
+    last, info = None, {}
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.startswith('#{'):
+                try:
+                    info.update(json.loads(line[1:]))
+                except ValueError:
+                    pass
+                continue
+            values = line.split()
+            # skip comments, broken rows and the torn last row of an interrupted write
+            if line.startswith('#') or not line.endswith('\n') or len(values) != NCOLS:
+                continue
+            try:
+                row = [float(v) for v in values]
+            except ValueError:
+                continue
+            index = int(row[0])
+            if 0 <= index < data.shape[1]:
+                # later rows (manual corrections) replace earlier ones
+                data[1:, index] = row[1:]
+                last = index if last is None else max(last, index)
+    return last, info
+
+#=============================================================================#
+#                     Tracking
+#=============================================================================#
+@piaProfile.timed('track')
+def trackFrame(img, mode, bgSize, neuronSize, threshold, xC, yC, shift, prevLocs, estimator=None, searchSize=None, wideSize=None):
+    """run the tracker of a mode on one image. Returns the 20 values of a frame.
+
+    estimator optionally replaces the per box threshold calculation, eg. a
+    piaImage.IncrementalThreshold when the same frame is tracked repeatedly.
+    With a searchSize objects are only searched within that distance of
+    xC, yC, thresholds and background levels still come from the bgSize box.
+    With a wideSize the object is first located on a downsampled crop within
+    wideSize of xC, yC (piaImage.coarseLocation) and then tracked at full
+    resolution in the bgSize box around that location.
+    """
+    if wideSize is not None:
+        xC, yC = piaImage.coarseLocation(img, xC, yC, wideSize, threshold, neuronSize, maxObjectArea(mode))
+    if mode == 'Single Neuron (Ratio)':
+        return piaImage.dualFluorescence(img, bgSize, neuronSize, threshold, xC, yC, shift, estimator=estimator, searchSize=searchSize)
+    elif mode == '2 Neurons':
+        return piaImage.singleFluorescence2Neurons(img, bgSize, neuronSize, threshold, xC, yC, shift, prevLocs, estimator=estimator, searchSize=searchSize)
+    elif mode == '2 Neurons (Ratio)':
+        return piaImage.dualFluorescence2Neurons(img, bgSize, neuronSize, threshold, xC, yC, shift, prevLocs, estimator=estimator, searchSize=searchSize)
+    return piaImage.fluorescence(img, bgSize, neuronSize, threshold, xC, yC, estimator=estimator, searchSize=searchSize)
+
+class ResultCache():
+    """bounded memo of tracked frames, least recently used ones are evicted first.
+
+    A frame is keyed by its index, the search location, the tracking
+    parameters and, in the two neuron modes, the locations in the previous
+    frame that decide which object is which. Locations are rounded to
+    1/10**precision pixels. A cache belongs to one recording, clear it when
+    another one is opened. It can be shared between threads.
+    """
+    def __init__(self, maxEntries=100000, precision=3):
+        self.maxEntries = maxEntries
+        self.precision = precision
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, index, mode, bgSize, neuronSize, threshold, xC, yC, shift, prevLocs, searchSize=None):
+        locations = [xC, yC]
+        if mode.startswith('2 Neurons'):
+            locations += list(prevLocs)
+        return (index, mode, bgSize, neuronSize, threshold, tuple(shift), searchSize) \
+                + tuple(round(float(v), self.precision) for v in locations)
+
+    def coarseKey(self, index, mode, wideSize, threshold, neuronSize, xC, yC):
+        """key of the coarse location of a frame (see coarseCached)."""
+        return (index, mode, 'coarse', wideSize, threshold, neuronSize, round(float(xC), self.precision), round(float(yC), self.precision))
+
+    def get(self, key):
+        """the 20 values of a frame, None if not cached."""
+        with self.lock:
+            values = self.entries.pop(key, None)
+            if values is None:
+                self.misses += 1
+                return None
+            self.entries[key] = values
+            self.hits += 1
+            return values
+
+    def put(self, key, values):
+        values = np.array(values, dtype=float)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = values
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+#=============================================================================#
+#                     Motion model
+#=============================================================================#
+# variance of the change of velocity between frames [px**2/frame**2]
+PROCESS_NOISE = 9.
+# variance of a tracked location [px**2]
+MEASUREMENT_NOISE = 1.
+# variance of the unknown velocity of an object seen once [px**2/frame**2]
+VELOCITY_VARIANCE = 25.
+
+class LocationFilter():
+    """constant velocity Kalman filter of the x,y location of one object.
+
+    Both axes are filtered independently with the same noise, so they share
+    the 2x2 covariance of location and velocity.
+    """
+    def __init__(self, processNoise=PROCESS_NOISE, measurementNoise=MEASUREMENT_NOISE, velocityVariance=VELOCITY_VARIANCE):
+        self.q = processNoise
+        self.r = measurementNoise
+        self.velocityVariance = velocityVariance
+        self.initialized = False
+
+    def reset(self, location):
+        """start at a location with an unknown velocity."""
+        self.location = np.array(location, dtype=float)
+        self.velocity = np.zeros(2)
+        self.P = np.array([[self.r, 0.], [0., self.velocityVariance]])
+        self.initialized = True
+
+    def predict(self):
+        """advance by one frame. Returns the expected location."""
+        P, q = self.P, self.q
+        self.location = self.location + self.velocity
+        self.P = np.array([[P[0,0]+2*P[0,1]+P[1,1]+q/4., P[0,1]+P[1,1]+q/2.],
+                           [P[0,1]+P[1,1]+q/2., P[1,1]+q]])
+        return self.location.copy()
+
+    def update(self, location):
+        """correct the state with a tracked location."""
+        P = self.P
+        s = P[0,0] + self.r
+        k0, k1 = P[0,0]/s, P[0,1]/s
+        innovation = np.asarray(location, dtype=float) - self.location
+        self.location = self.location + k0*innovation
+        self.velocity = self.velocity + k1*innovation
+        self.P = np.array([[(1-k0)*P[0,0], (1-k0)*P[0,1]],
+                           [(1-k0)*P[0,1], P[1,1]-k1*P[0,1]]])
+
+    def hold(self):
+        """the object was not found where it was expected, keep it there with an unknown velocity."""
+        self.velocity = np.zeros(2)
+        self.P = np.array([[self.P[0,0], 0.], [0., max(self.P[1,1], self.velocityVariance)]])
+
+    def uncertainty(self):
+        """standard deviation of the location [px]."""
+        return np.sqrt(self.P[0,0])
+
+class MotionModel():
+    """Kalman filters of the tracked objects of a mode, two in the two neuron modes.
+
+    For each frame searchLocation predicts where to search and where both
+    objects are expected, observe then corrects the filters with the tracked
+    frame. Objects that were not found (a nan fluorescence, or the location
+    the tracker fell back to) keep their predicted location, their
+    uncertainty grows until they are found again.
+    """
+    def __init__(self, mode, processNoise=PROCESS_NOISE, measurementNoise=MEASUREMENT_NOISE):
+        self.mode = mode
+        nObjects = 2 if mode.startswith('2 Neurons') else 1
+        self.filters = [LocationFilter(processNoise, measurementNoise) for k in xrange(nObjects)]
+        self.searched = None
+        self.fallback = None
+
+    def predict(self):
+        """expected locations of the objects in the next frame, None for objects not seen yet."""
+        return [f.predict() if f.initialized else None for f in self.filters]
+
+    def searchLocation(self, data, index, seed=None):
+        """search location xC, yC in frame index and the expected locations of both objects (prevLocs).
+
+        Objects not seen yet are expected at their location in the frame
+        before, the search location is the seed if given.
+        """
+        prevLocs = previousLocations(data, index, self.mode)
+        for k, location in enumerate(self.predict()):
+            if location is not None:
+                prevLocs[2*k:2*k+2] = location
+        if seed is not None:
+            xC, yC = seed
+        else:
+            xC, yC = prevLocs[:2]
+        # where the objects are expected, and where the trackers place objects they don't find
+        self.searched = np.array(prevLocs)
+        self.searched[:2] = xC, yC
+        self.fallback = self.searched.copy()
+        return xC, yC, prevLocs
+
+    def recenter(self, xC, yC):
+        """the tracker searches at xC, yC instead of the search location, eg. coarse to fine. Returns xC, yC.
+
+        Objects are still expected at the predicted locations, only a
+        tracked location equal to xC, yC now means not found.
+        """
+        self.fallback[:2] = xC, yC
+        return xC, yC
+
+    def found(self, data, index):
+        """for each object whether the tracker found it in frame index of data."""
+        xCol, yCol = positionColumns(self.mode)
+        found = []
+        for k in xrange(len(self.filters)):
+            value, x, y = data[xCol-1+10*k:yCol+1+10*k, index]
+            # not found, the tracker returned the expected location
+            found.append(np.isfinite(value) and np.isfinite(x+y) and
+                         not np.allclose([x, y], self.fallback[2*k:2*k+2], rtol=0, atol=1e-6))
+        return found
+
+    def observe(self, data, index):
+        """correct the filters with the tracked frame index of data."""
+        xCol, yCol = positionColumns(self.mode)
+        for k, (f, found) in enumerate(zip(self.filters, self.found(data, index))):
+            value, x, y = data[xCol-1+10*k:yCol+1+10*k, index]
+            if value == 1 and x == 1 and y == 1:
+                # placeholder of an untracked frame (see emptyData)
+                f.initialized = False
+            elif not found:
+                if f.initialized:
+                    f.hold()
+            elif f.initialized:
+                f.update((x, y))
+            else:
+                f.reset((x, y))
+
+    def replay(self, data, end, window=50):
+        """learn the motion from the tracked frames before end, eg. to continue a run."""
+        for index in xrange(max(end-window, 0), end):
+            self.searchLocation(data, index)
+            self.observe(data, index)
+
+    def uncertainty(self):
+        """standard deviation of the predicted location of each object [px], nan if not seen yet."""
+        return [f.uncertainty() if f.initialized else np.nan for f in self.filters]
+
+#=============================================================================#
+#                     Adaptive search box
+#=============================================================================#
+# free space between an expected object and the edge of the search box [px]
+SEARCH_MARGIN = 5
+# objects found cleanly are brighter than this times their background
+MIN_CONTRAST = 1.2
+
+class SearchBox():
+    """size of the box objects are searched in by track in the adaptive mode.
+
+    While objects are found cleanly (inside the box, not larger than the
+    neuron box, brighter than their background and close to where they
+    were expected) the box shrinks towards the smallest one that holds the
+    expected objects with 3 times their uncertainty. Otherwise the frame is
+    searched again in the whole background box, which is used until the
+    objects are found cleanly again. Thresholds and background levels always
+    come from the background box, so the results stay comparable.
+    imSize is the shape of the frames.
+    """
+    def __init__(self, bgSize, neuronSize, imSize, shrink=0.75):
+        self.bgSize = bgSize
+        self.neuronSize = neuronSize
+        self.imSize = imSize
+        self.shrink = shrink
+        self.size = bgSize
+
+    def searchSize(self, motion, xC, yC):
+        """half width of the search box around xC, yC, None for the whole background box."""
+        size = self.size
+        expected = motion.searched[:2*len(motion.filters)].reshape(-1, 2)
+        for (x, y), sigma in zip(expected, motion.uncertainty()):
+            if not np.isfinite(sigma):
+                # the motion of the object is not known yet
+                return None
+            distance = max(abs(x-xC), abs(y-yC))
+            size = max(size, distance + self.neuronSize + SEARCH_MARGIN + 3*sigma)
+        size = int(np.ceil(size))
+        if size >= self.bgSize:
+            return None
+        return size
+
+    def boxShape(self, xC, yC):
+        """shape of the background box around xC, yC as cropped by piaImage.cropImage, and its offset."""
+        (rows, columns), xBox, yBox = piaImage.searchRegion(self.imSize, xC, yC, self.bgSize)
+        return (rows.stop-rows.start, columns.stop-columns.start), xBox, yBox
+
+    def innerEdges(self, xC, yC, searchSize):
+        """image coordinates (xMin, xMax, yMin, yMax) of the search box edges, None for edges of the background box.
+
+        The search box is cut from the background box as in
+        piaImage.findNeuronNear. Where it ends with the background box (or
+        the image), searching the whole background box finds nothing more.
+        """
+        if searchSize is None:
+            return None, None, None, None
+        boxShape, xBox, yBox = self.boxShape(xC, yC)
+        (rows, columns), _, _ = piaImage.searchRegion(boxShape, xC-xBox, yC-yBox, searchSize)
+        def inner(edge, boxEdge, offset):
+            return None if edge == boxEdge else edge+offset
+        return inner(columns.start, 0, xBox), inner(columns.stop, boxShape[1], xBox), \
+               inner(rows.start, 0, yBox), inner(rows.stop, boxShape[0], yBox)
+
+    def clean(self, data, index, motion, xC, yC, searchSize):
+        """whether all objects were found cleanly in frame index of data."""
+        xCol, yCol = positionColumns(motion.mode)
+        xMin, xMax, yMin, yMax = self.innerEdges(xC, yC, searchSize)
+        # boxes at the image border are cropped
+        height, width = self.boxShape(xC, yC)[0]
+        for k, found in enumerate(motion.found(data, index)):
+            bg, value, x, y, area = data[xCol-2+10*k:yCol+2+10*k, index]
+            xE, yE = motion.searched[2*k:2*k+2]
+            if not found or not value > MIN_CONTRAST*bg:
+                return False
+            # the area counts the pixels of the background box outside of the object
+            if height*width - area > (2*self.neuronSize)**2:
+                return False
+            # objects near an edge inside the background box may reach beyond the search box
+            for low, v, high in [(xMin, x, xMax), (yMin, y, yMax)]:
+                if (low is not None and v - low < self.neuronSize) or (high is not None and high - v < self.neuronSize):
+                    return False
+            if np.hypot(x-xE, y-yE) > self.neuronSize:
+                return False
+        return True
+
+    def update(self, clean):
+        if clean:
+            self.size = self.size*self.shrink
+        else:
+            self.size = self.bgSize
+
+def previousLocations(data, index, mode):
+    """locations of both objects in the frame before index, used to keep the identity of two neurons."""
+    if index == 0:
+        # placeholders as in an empty data set, not the last frame
+        return np.ones(4)
+    xCol, yCol = positionColumns(mode)
+    return data[[xCol, yCol, xCol+10, yCol+10], index-1]
+
+def trackCached(frames, index, mode, bgSize, neuronSize, signalThreshold, xC, yC, shift, prevLocs, cache=None, searchSize=None):
+    """trackFrame on frame index, taken from cache if it was tracked before with the same inputs."""
+    if cache is not None:
+        key = cache.key(index, mode, bgSize, neuronSize, signalThreshold, xC, yC, shift, prevLocs, searchSize)
+        values = cache.get(key)
+        if values is not None:
+            return values
+    values = trackFrame(frames[index], mode, bgSize, neuronSize, signalThreshold, xC, yC, shift, prevLocs,
+                        searchSize=searchSize)
+    if cache is not None:
+        cache.put(key, values)
+    return values
+
+def coarseCached(frames, index, mode, wideSize, signalThreshold, neuronSize, xC, yC, cache=None):
+    """piaImage.coarseLocation on frame index, taken from cache if it was located before with the same inputs."""
+    if cache is not None:
+        key = cache.coarseKey(index, mode, wideSize, signalThreshold, neuronSize, xC, yC)
+        location = cache.get(key)
+        if location is not None:
+            return tuple(location)
+    location = piaImage.coarseLocation(frames[index], xC, yC, wideSize, signalThreshold, neuronSize, maxObjectArea(mode))
+    if cache is not None:
+        cache.put(key, location)
+    return location
+
+def track(frames, mode, seed, boxBG, boxNeuron, signalThreshold, shift, start=0, end=None, data=None, writer=None, cache=None, stop=None, adaptive=False, boxWide=None):
+    """track an object from a seed location through the frames start..end-1.
+
+    frames is a piaFrames.FrameSource (or any indexable of images). Box sizes
+    are the full widths as entered in the GUI. Frames are written into data
+    (a new dummy data set if None), which is returned. Search locations are
+    predicted by a MotionModel, without a seed also the first one from the
+    frames tracked before start, eg. when resuming a run.
+    Tracked frames are also passed to writer (a ResultWriter) if given.
+    With a ResultCache, frames tracked before with the same inputs are
+    taken from the cache without decoding them. Tracking ends before the
+    next frame once stop (a threading.Event) is set. With adaptive, objects
+    are searched in a box that shrinks while they are found cleanly
+    (see SearchBox), the background box keeps its size. With boxWide (a full
+    width) objects are located coarse to fine, first on a downsampled crop
+    of the wide box around the search location (see trackFrame). The
+    background and search boxes are then placed around the coarse location,
+    objects are still expected where the motion model predicts them.
+    """
+    if data is None:
+        data = emptyData(len(frames))
+    if end is None:
+        end = len(frames)
+    bgSize = int(np.round(boxBG/2.0))
+    neuronSize = int(np.round(boxNeuron/2.0))
+    wideSize = int(np.round(boxWide/2.0)) if boxWide else None
+    motion = MotionModel(mode)
+    if seed is None:
+        motion.replay(data, start)
+    search = SearchBox(bgSize, neuronSize, frames[start].shape) if adaptive and start < end else None
+    for index in xrange(start, end):
+        if stop is not None and stop.is_set():
+            break
+        xC, yC, prevLocs = motion.searchLocation(data, index, seed if index == start else None)
+        if wideSize is not None:
+            xC, yC = motion.recenter(*coarseCached(frames, index, mode, wideSize, signalThreshold, neuronSize, xC, yC, cache))
+        searchSize = None if search is None else search.searchSize(motion, xC, yC)
+        data[1:, index] = trackCached(frames, index, mode, bgSize, neuronSize, signalThreshold, xC, yC, shift, prevLocs, cache,
+                                      searchSize)
+        if search is not None:
+            clean = search.clean(data, index, motion, xC, yC, searchSize)
+            if not clean and searchSize is not None:
+                # lost or ambiguous in the small box, search the whole background box
+                data[1:, index] = trackCached(frames, index, mode, bgSize, neuronSize, signalThreshold, xC, yC, shift, prevLocs, cache)
+            search.update(clean)
+        motion.observe(data, index)
+        if writer is not None:
+            writer.write(index, data[1:, index])
+    return data
+
+class TrackingThread(threading.Thread):
+    """runs track on a worker thread and streams the tracked frames through a queue.
+
+    Takes the arguments of track. data is only used by the thread, pass a
+    copy. Tracked frames are collected with fetch, stop ends tracking
+    before the next frame. An exception ends tracking and is kept in error.
+    """
+    def __init__(self, frames, mode, seed, boxBG, boxNeuron, signalThreshold, shift, start=0, end=None, data=None, cache=None, adaptive=False, boxWide=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.args = (frames, mode, seed, boxBG, boxNeuron, signalThreshold, shift, start, end, data)
+        self.cache = cache
+        self.adaptive = adaptive
+        self.boxWide = boxWide
+        self.results = Queue.Queue()
+        self.stopped = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            track(*self.args, writer=self, cache=self.cache, stop=self.stopped, adaptive=self.adaptive, boxWide=self.boxWide)
+        except Exception:
+            self.error = traceback.format_exc()
+        finally:
+            # end of tracking
+            self.results.put(None)
+
+    def write(self, index, values):
+        self.results.put((index, np.array(values)))
+
+    def stop(self):
+        self.stopped.set()
+
+    def fetch(self):
+        """frames tracked since the last call as (index, values), and whether tracking has ended."""
+        results = []
+        while True:
+            try:
+                item = self.results.get_nowait()
+            except Queue.Empty:
+                return results, False
+            if item is None:
+                return results, True
+            results.append(item)
+
+#=============================================================================#
+#                     Re-quantification
+#=============================================================================#
+def isTracked(data, index, mode):
+    """whether frame index of data holds a tracked location, not the placeholder of emptyData."""
+    xCol, yCol = positionColumns(mode)
+    value, x, y = data[xCol-1:yCol+1, index]
+    return np.isfinite(x+y) and not (value == 1 and x == 1 and y == 1)
+
+def measureBoxes(result, batch, neuronSize, threshold, imSize):
+    """write the Single Neuron values of a batch of (index, box, xMin, yMin, xC, yC) into result."""
+    indices, boxes, xMins, yMins, xCs, yCs = [np.array(column) for column in zip(*batch)]
+    bgLevels, averages, xNew, yNew, areas = piaImage.fluorescenceBoxes(boxes, neuronSize, threshold, xCs-xMins, yCs-yMins, imSize)
+    # --- same layout as piaImage.fluorescence
+    result[1:, indices] = 1
+    result[6:11, indices] = [bgLevels, averages, xNew+xMins, yNew+yMins, areas]
+
+def requantify(frames, data, mode, boxBG, boxNeuron, signalThreshold, shift, start=0, end=None, batchSize=64):
+    """measure the tracked frames start..end-1 of data again, eg. with another threshold or box size.
+
+    Each frame is tracked with its tracked location as search location and
+    the locations of the frame before as previous ones, frames without a
+    tracked location keep their values. Returns a new data set. In the
+    Single Neuron mode the boxes inside the image are measured batchSize at
+    a time by piaImage.fluorescenceBoxes, with the same results as
+    trackFrame.
+    """
+    if end is None:
+        end = len(frames)
+    bgSize = int(np.round(boxBG/2.0))
+    neuronSize = int(np.round(boxNeuron/2.0))
+    xCol, yCol = positionColumns(mode)
+    result = data.copy()
+    batch, imSize = [], None
+    for index in xrange(start, end):
+        if not isTracked(data, index, mode):
+            continue
+        img = frames[index]
+        imSize = img.shape
+        xC, yC = data[xCol, index], data[yCol, index]
+        if mode == 'Single Neuron':
+            box, xMin, yMin = piaImage.cropGrayImage(img, xC, yC, bgSize, img.shape)
+            if box.shape == (2*bgSize, 2*bgSize):
+                batch.append((index, box, xMin, yMin, xC, yC))
+                if len(batch) == batchSize:
+                    measureBoxes(result, batch, neuronSize, signalThreshold, imSize)
+                    batch = []
+                continue
+        result[1:, index] = trackFrame(img, mode, bgSize, neuronSize, signalThreshold, xC, yC, shift,
+                                       previousLocations(data, index, mode))
+    if batch:
+        measureBoxes(result, batch, neuronSize, signalThreshold, imSize)
+    return result
+
+#=============================================================================#
+#                     Command line interface
+#=============================================================================#
+def parseArguments(args=None):
+    parser = argparse.ArgumentParser(description='Track fluorescent objects in an image folder without the PIA window.')
+    parser.add_argument('imageFolder', help='folder with images ending in a _NNNN timestamp')
+    parser.add_argument('outFile', help='PIA data file to write (text, or binary if it ends in .pia)')
+    parser.add_argument('-x', type=float, default=None, help='x location of the object in the first frame')
+    parser.add_argument('-y', type=float, default=None, help='y location of the object in the first frame')
+    parser.add_argument('--mode', default='Single Neuron', choices=MODES)
+    parser.add_argument('--type', default='tif', help='image data type (tif, png, jpg)')
+    parser.add_argument('--bg', type=int, default=200, help='background box size')
+    parser.add_argument('--neuron', type=int, default=50, help='neuron box size')
+    parser.add_argument('--threshold', type=int, default=95, help='signal threshold [%%]')
+    parser.add_argument('--shift', type=int, nargs=2, default=[-10, -510], metavar=('X', 'Y'), help='dual color shift')
+    parser.add_argument('--auto-shift', action='store_true', help='estimate the dual color shift from the images (piaShift)')
+    parser.add_argument('--start', type=int, default=0, help='first frame to track')
+    parser.add_argument('--end', type=int, default=None, help='stop before this frame')
+    parser.add_argument('--adaptive', action='store_true', help='search in a smaller box while the object is found cleanly')
+    parser.add_argument('--wide', type=int, default=None, help='locate the object coarse to fine in a box of this size')
+    parser.add_argument('--checkpoint', default=None, help='journal file written while tracking')
+    parser.add_argument('--resume', action='store_true', help='continue after the last frame in the checkpoint')
+    parser.add_argument('--profile', default=None, help='json file for the per stage tracking times')
+    parser.add_argument('--requantify', default=None, metavar='DATAFILE',
+                        help='measure the frames of a tracked data file again at their locations instead of tracking')
+    args = parser.parse_args(args)
+    if args.requantify is None and (args.x is None or args.y is None):
+        parser.error('the seed location -x and -y is required for tracking')
+    return args
+
+def main(args=None):
+    # the result formats build on the data layout defined here
+    import piaResults
+    args = parseArguments(args)
+    frames = piaFrames.openFrames(args.imageFolder, args.type)
+    if frames is None:
+        raise SystemExit('No images found in folder!')
+    writer = None
+    try:
+        if args.auto_shift:
+            estimate = piaShift.recordingShift(frames, args.imageFolder, args.shift)
+            if not piaShift.isClear(estimate):
+                raise SystemExit('No clear dual color shift found, set it with --shift.')
+            args.shift = estimate['shift']
+            print 'estimated dual color shift', args.shift[0], args.shift[1]
+        data, seed, start = None, (args.x, args.y), args.start
+        if args.requantify:
+            data, _ = piaResults.loadData(args.requantify)
+            if data.shape[1] != len(frames):
+                raise SystemExit('{} has {:d} frames, but the image folder has {:d} images.'.format(args.requantify, data.shape[1], len(frames)))
+        elif args.checkpoint:
+            if args.resume and os.path.isfile(args.checkpoint):
+                data = emptyData(len(frames))
+                last, _ = readCheckpoint(args.checkpoint, data)
+                if last is not None:
+                    seed, start = None, last+1
+            if not args.resume and os.path.isfile(args.checkpoint):
+                print 'moved the previous checkpoint to', archiveCheckpoint(args.checkpoint)
+            writer = ResultWriter(args.checkpoint, append=args.resume)
+            writer.writeInfo(runInfo(args.mode, args.bg, args.neuron, args.threshold, args.shift, args.imageFolder, args.adaptive, args.wide))
+        piaProfile.enable(args.profile is not None)
+        t0 = time.time()
+        if args.requantify:
+            data = requantify(frames, data, args.mode, args.bg, args.neuron, args.threshold, args.shift, start, args.end)
+        else:
+            data = track(frames, args.mode, seed, args.bg, args.neuron,
+                         args.threshold, args.shift, start, args.end, data, writer, adaptive=args.adaptive, boxWide=args.wide)
+    finally:
+        if writer is not None:
+            writer.close()
+        frames.close()
+    duration = time.time() - t0
+    info = runInfo(args.mode, args.bg, args.neuron, args.threshold, args.shift, args.imageFolder, args.adaptive, args.wide)
+    piaResults.saveData(args.outFile, data, info)
+    nFrames = max((args.end or len(frames)) - start, 0)
+    print '{} {:d} frames in {:.1f} s ({:.1f} frames/s)'.format('measured' if args.requantify else 'tracked', nFrames, duration, nFrames/max(duration, 1e-9))
+    if args.profile:
+        piaProfile.dump(args.profile, info)
+        print 'ms per call', piaProfile.report(recent=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence checks for the image statistics of PIA.
+calculateWithMask, calculateWith2Masks and findNeuron are compared to the
+masked array versions they replaced, and the batched kernels and
+piaTrack.requantify to the per frame calls, on fixed synthetic frames, eg.
+    python -m unittest testPiaImage
+"""
+import unittest
+import numpy as np
+from scipy import ndimage
+import piaImage
+import piaTrack
+
+
+#=============================================================================#
+#                   masked array reference versions
+#=============================================================================#
+
+def referenceWithMask(bgImage, xNewNeuron,yNewNeuron,neuronSize,imSize):
+    """masked average outside of the neuron box."""
+    mask = np.zeros(bgImage.shape, dtype=bool)
+    yMinSRegion = int(max(0,yNewNeuron-neuronSize))
+    yMaxSRegion = int(min(imSize[0],yNewNeuron+neuronSize))
+    xMinSRegion = int(max(0,xNewNeuron-neuronSize))
+    xMaxSRegion = int(min(imSize[1],xNewNeuron+neuronSize))
+    mask[yMinSRegion:yMaxSRegion,xMinSRegion:xMaxSRegion] = True
+    return np.ma.average(np.ma.masked_array(bgImage, mask))
+
+def referenceWith2Masks(bgImage, xNewNeuron1,yNewNeuron1,xNewNeuron2,yNewNeuron2,neuronSize,imSize):
+    """masked average outside of the box its zip() loop shades out, bounds truncated to integers."""
+    mask = np.zeros(bgImage.shape, dtype=bool)
+    for (xNewNeuron, yNewNeuron) in zip([xNewNeuron1, xNewNeuron2], [xNewNeuron1]):
+        yMinSRegion = int(max(0,yNewNeuron-neuronSize))
+        yMaxSRegion = int(min(imSize[0],yNewNeuron+neuronSize))
+        xMinSRegion = int(max(0,xNewNeuron-neuronSize))
+        xMaxSRegion = int(min(imSize[1],xNewNeuron+neuronSize))
+        mask[yMinSRegion:yMaxSRegion,xMinSRegion:xMaxSRegion] = True
+    return np.ma.average(np.ma.masked_array(bgImage, mask))
+
+def referenceFindNeuron(bgImage, threshold, xNeuron,  yNeuron):
+    """findNeuron with ndimage measurements and masked averages."""
+    mask = np.where(bgImage > threshold[0], 1, 0)
+    mask = ndimage.binary_opening(mask,structure = np.ones((2,2)))
+    mask = ndimage.binary_closing(mask)
+    label_im, nb_labels = ndimage.label(mask)
+    centroids = ndimage.center_of_mass(bgImage, label_im, xrange(1,nb_labels+1))
+    meanBrightness = np.array(ndimage.mean(bgImage, label_im, xrange(1,nb_labels+1)))
+    # filter large blobs
+    for loc in xrange(1,nb_labels+1):
+        area = np.where(label_im == loc)[0]
+        if len(area)>200:
+            label_im[area] =0
+            meanBrightness[loc-1] = 0
+    if nb_labels >= 1:
+        loc = np.argmax(meanBrightness)
+        yNewNeuron,xNewNeuron = centroids[loc]
+    else:
+        yNewNeuron,xNewNeuron = yNeuron,  xNeuron
+        loc = -1
+    neuronObject = np.where(label_im == loc+1,0,1)
+    neuronArea = np.sum(neuronObject)
+    tmp_neuron = np.ma.masked_array(bgImage, neuronObject)
+    newNeuronAverage = np.ma.average(tmp_neuron[tmp_neuron>threshold[1]])
+    return yNewNeuron,xNewNeuron, newNeuronAverage,neuronArea,  neuronObject
+
+
+#=============================================================================#
+#                   fixed synthetic frames
+#=============================================================================#
+
+def syntheticFrame(seed, shape=(120, 160), dtype=np.uint16):
+    """noisy frame with a few small bright spots and one large blob."""
+    random = np.random.RandomState(seed)
+    yGrid, xGrid = np.mgrid[0:shape[0], 0:shape[1]]
+    img = random.normal(100, 10, shape)
+    for _ in range(4):
+        y, x = random.uniform(10, shape[0]-10), random.uniform(10, shape[1]-10)
+        img += random.uniform(200, 800)*np.exp(-((yGrid-y)**2+(xGrid-x)**2)/(2*random.uniform(1.5, 3)**2))
+    # --- a blob larger than 200 pixels, removed by findNeuron
+    y, x = random.uniform(20, shape[0]-20), random.uniform(20, shape[1]-20)
+    img += 300*np.exp(-((yGrid-y)**2+(xGrid-x)**2)/(2*10.**2))
+    if np.issubdtype(dtype, np.integer):
+        img = np.clip(img, 0, np.iinfo(dtype).max)
+    return img.astype(dtype)
+
+def syntheticRGB(seed, dtype=np.float32):
+    """color frame as read from a png (floats in 0..1) or a jpg (uint8), converted to gray like the search boxes."""
+    img = np.dstack([syntheticFrame(seed+k, dtype=np.float64) for k in range(3)])/1000.
+    if np.issubdtype(dtype, np.integer):
+        img = np.clip(img*255, 0, 255)
+    return piaImage.rgb2gray(img.astype(dtype))
+
+FRAMES = [syntheticFrame(seed, dtype=dtype) for seed in range(6) for dtype in (np.uint8, np.uint16, np.float32, np.float64)] \
+       + [syntheticRGB(seed, dtype=dtype) for seed in range(3) for dtype in (np.uint8, np.float32)]
+
+
+class StatisticsTest(unittest.TestCase):
+    """direct reductions against the masked array versions."""
+
+    def assertSame(self, value, reference):
+        # --- an empty masked average is nan in the direct reductions
+        if not isinstance(reference, tuple):
+            reference = (reference,)
+        reference = [np.nan if r is np.ma.masked else r for r in reference]
+        np.testing.assert_array_equal(np.ravel(value), np.array(reference, dtype=float))
+
+    def testCalculateWithMask(self):
+        for img in FRAMES:
+            # --- boxes inside the frame, at its edges, partly and fully outside
+            for x, y in [(80, 60), (3.5, 7.2), (158.9, 119.1), (-20, 60), (80, 200), (500, 500)]:
+                for neuronSize in (5, 30.5, 300):
+                    reference = referenceWithMask(img, x, y, neuronSize, img.shape)
+                    value = piaImage.calculateWithMask(img, x, y, neuronSize, img.shape)
+                    self.assertSame(value, reference)
+
+    def testCalculateWith2Masks(self):
+        for img in FRAMES:
+            for x1, y1, x2, y2 in [(80, 60, 20, 30), (3.5, 7.2, 150.5, 100.1), (120, 10, 120, 10)]:
+                reference = referenceWith2Masks(img, x1, y1, x2, y2, 20, img.shape)
+                value = piaImage.calculateWith2Masks(img, x1, y1, x2, y2, 20, img.shape)
+                self.assertSame(value, reference)
+
+    def testFindNeuron(self):
+        for img in FRAMES:
+            for percentile in (90, 95, 99):
+                threshold = np.percentile(img, [percentile, (100+percentile)/2.])
+                reference = referenceFindNeuron(img, threshold, 80, 60)
+                value = piaImage.findNeuron(img, threshold, 80, 60)
+                # --- location, object average, area and object mask
+                self.assertSame(value[:3], reference[:3])
+                self.assertEqual(value[3], reference[3])
+                np.testing.assert_array_equal(value[4], reference[4].astype(bool))
+
+    def testFindNeuronWithoutObjects(self):
+        img = np.full((40, 40), 100, dtype=np.uint16)
+        threshold = np.percentile(img, [95, 97.5])
+        reference = referenceFindNeuron(img, threshold, 20, 25)
+        value = piaImage.findNeuron(img, threshold, 20, 25)
+        self.assertEqual(value[:2], reference[:2])
+        self.assertTrue(np.isnan(value[2]))
+        self.assertEqual(value[3], reference[3])
+
+
+class BatchTest(unittest.TestCase):
+    """batched kernels against the per frame calls."""
+
+    def testFluorescenceBoxes(self):
+        centers = [(80, 60), (70.5, 50.2), (90, 65), (81.7, 59.9), (75, 70), (85, 55)]
+        for dtype in (np.uint8, np.uint16, np.float32, np.float64):
+            frames = [syntheticFrame(seed, dtype=dtype) for seed in range(len(centers))]
+            crops = [piaImage.cropImage(img, xC, yC, 40, img.shape) for img, (xC, yC) in zip(frames, centers)]
+            boxes = np.array([box for box, _, _ in crops])
+            xMins, yMins = np.array([[xMin, yMin] for _, xMin, yMin in crops]).T
+            xCs, yCs = np.array(centers, dtype=float).T
+            bgLevels, averages, xNew, yNew, areas = piaImage.fluorescenceBoxes(boxes, 10, 95, xCs-xMins, yCs-yMins, frames[0].shape)
+            values = np.array([bgLevels, averages, xNew+xMins, yNew+yMins, areas]).T
+            # --- background level, object average, location and area of piaImage.fluorescence
+            expected = [piaImage.fluorescence(img, 40, 10, 95, xC, yC)[5:10] for img, (xC, yC) in zip(frames, centers)]
+            np.testing.assert_array_equal(values, np.array(expected, dtype=float))
+
+    def testRequantify(self):
+        frames = [syntheticFrame(seed) for seed in range(12)]
+        data = piaTrack.track(frames, 'Single Neuron', (80, 60), 80, 20, 95, [0, 0])
+        # --- frames near the image edge are measured one by one
+        data[8:10, 3] = 5, 5
+        # --- untracked frames keep their values
+        data[1:, 7] = 1
+        expected = data.copy()
+        for index in xrange(len(frames)):
+            if index != 7:
+                expected[1:, index] = piaTrack.trackFrame(frames[index], 'Single Neuron', 50, 10, 90,
+                                                          data[8, index], data[9, index], [0, 0], None)
+        result = piaTrack.requantify(frames, data, 'Single Neuron', 100, 20, 90, [0, 0], batchSize=4)
+        np.testing.assert_array_equal(np.nan_to_num(result), np.nan_to_num(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()